@@ -1,11 +1,30 @@
 import os
+import sys
+import atexit
 import json
+import re
 import time
 import random
 import asyncio
 import datetime
 import hashlib
-from typing import List, Tuple, Type, Dict, Any, Optional, Set
+import heapq
+import math
+import bisect
+import zlib
+import marshal
+import cProfile
+import pstats
+import queue
+import threading
+import logging
+import logging.handlers
+import multiprocessing
+import concurrent.futures
+from array import array
+from collections import deque
+from types import SimpleNamespace
+from typing import List, Tuple, Type, Dict, Any, Optional, Set, NamedTuple
 from enum import Enum
 from src.plugin_system import (
     BasePlugin,
@@ -17,6 +36,110 @@ from src.plugin_system import (
 from src.plugin_system.apis import send_api, chat_api
 from src.plugin_system.apis import person_api
 
+try:
+    import numpy as np
+except ImportError:  # NumPy 为可选依赖，缺失时统计退化为逐行累加
+    np = None
+
+# 数据目录（玩家档案 users/ 与对局文件 games/），基准测试时可指向临时目录
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ==================== 日志 ====================
+LOGGER_NAME = "werewolf"
+# 子系统名即 logger 名后缀，可在 [logging] levels 中单独设置级别
+LOG_SUBSYSTEMS = ("message", "storage", "game", "command", "events", "spectator", "shard", "cleanup", "monitor")
+# 附加在日志行末尾的结构化字段（通过 extra= 传入）
+LOG_FIELDS = ("room", "phase", "command", "user", "group", "latency_ms", "path")
+
+class StructuredFormatter(logging.Formatter):
+    """时间 级别 子系统 消息 key=value ...，由后台写线程格式化"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = " ".join(f"{key}={getattr(record, key)}" for key in LOG_FIELDS
+                          if getattr(record, key, None) is not None)
+        return f"{text} {fields}" if fields else text
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+_log_settings: Dict[str, Any] = {"level": "INFO", "levels": [], "file": ""}
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """获取子系统 logger"""
+    return logging.getLogger(f"{LOGGER_NAME}.{subsystem}")
+
+def parse_log_levels(entries: List[str]) -> Dict[str, int]:
+    """解析 ["storage=DEBUG", ...] 形式的子系统级别，无法识别的项忽略"""
+    levels = {}
+    for entry in entries:
+        subsystem, _, level = str(entry).partition("=")
+        level_value = logging.getLevelName(level.strip().upper())
+        if subsystem.strip() in LOG_SUBSYSTEMS and isinstance(level_value, int):
+            levels[subsystem.strip()] = level_value
+    return levels
+
+def configure_logging(level: str = "INFO", levels: Optional[List[str]] = None, file: str = ""):
+    """日志经队列交给后台线程写出，调用方只做一次入队，不会因 stdout/磁盘阻塞事件循环
+
+    fork 出的分片进程需要重新调用以启动自己的写线程。
+    """
+    global _log_listener
+    _log_settings.update(level=level, levels=list(levels or []), file=file)
+    if _log_listener is not None:
+        try:
+            _log_listener.stop()
+        except Exception:
+            pass
+        _log_listener = None
+
+    root = logging.getLogger(LOGGER_NAME)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root_level = logging.getLevelName(str(level).upper())
+    root.setLevel(root_level if isinstance(root_level, int) else logging.INFO)
+    # 不传给宿主的根 logger，避免在调用线程中同步输出一次
+    root.propagate = False
+
+    for subsystem in LOG_SUBSYSTEMS:
+        get_logger(subsystem).setLevel(logging.NOTSET)
+    for subsystem, level_value in parse_log_levels(levels or []).items():
+        get_logger(subsystem).setLevel(level_value)
+
+    if file:
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        target = logging.handlers.RotatingFileHandler(file, maxBytes=10 * 1024 * 1024,
+                                                      backupCount=3, encoding="utf-8")
+    else:
+        target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(StructuredFormatter())
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(log_queue, target)
+    _log_listener.start()
+
+def shutdown_logging():
+    """写出队列中剩余的日志并停止写线程"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+configure_logging()
+atexit.register(shutdown_logging)
+
+message_logger = get_logger("message")
+storage_logger = get_logger("storage")
+game_logger = get_logger("game")
+command_logger = get_logger("command")
+events_logger = get_logger("events")
+spectator_logger = get_logger("spectator")
+shard_logger = get_logger("shard")
+cleanup_logger = get_logger("cleanup")
+monitor_logger = get_logger("monitor")
+
 # ==================== 枚举定义 ====================
 class GamePhase(Enum):
     SETUP = "setup"
@@ -40,6 +163,7 @@ class DeathReason(Enum):
     SUICIDE = "suicide"
     WHITE_WOLF = "white_wolf"
     LOVER_SUICIDE = "lover_suicide"
+    SKILL = "skill"  # 自定义角色的夜晚技能
 
 class Camp(Enum):
     VILLAGE = "village"
@@ -185,67 +309,2247 @@ ROLES = {
     }
 }
 
+# 角色夜晚行动键（多名狼人共用同一个行动键）
+NIGHT_ACTION_KEYS = {
+    "seer": "seer",
+    "witch": "witch_poison",  # 女巫毒药行动键
+    "wolf": "wolf_kill",
+    "guard": "guard",
+    "magician": "magician",
+    "spiritualist": "spiritualist",
+    "cupid": "cupid",
+    "painter": "painter"
+}
+
+# 夜晚行动结算顺序 (优先级, 行动键)，数值小的先结算；自定义角色按配置的优先级插入
+NIGHT_RESOLUTION_ORDER = [
+    (10, "cupid"),
+    (20, "guard"),
+    (30, "wolf_kill"),
+    (40, "seer"),
+    (50, "witch_poison"),
+    (60, "spiritualist"),
+    (70, "magician"),
+    (80, "painter")
+]
+
+# 阵营查验（预言家等）看到的阵营，自定义角色可通过 check_mask 伪装
+CHECK_CAMPS = {role_id: role_info["camp"] for role_id, role_info in ROLES.items()}
+
+# 夜晚行动可选的目标：alive 存活玩家，other 除自己外的存活玩家，dead 已出局玩家
+ROLE_TARGETS = {"painter": "dead"}
+
+# 自定义角色的夜晚行动：行动键 -> CustomRoleAction
+CUSTOM_ROLE_ACTIONS: Dict[str, "CustomRoleAction"] = {}
+
+# 各人数的默认角色配置（匹配队列自动建房时使用）
+ROLE_PRESETS = {
+    6: {"villager": 2, "seer": 1, "witch": 1, "wolf": 2},
+    7: {"villager": 2, "seer": 1, "witch": 1, "hunter": 1, "wolf": 2},
+    8: {"villager": 3, "seer": 1, "witch": 1, "hunter": 1, "wolf": 2},
+    9: {"villager": 3, "seer": 1, "witch": 1, "hunter": 1, "wolf": 3},
+    10: {"villager": 3, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "wolf": 3},
+    11: {"villager": 4, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "wolf": 3},
+    12: {"villager": 4, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "wolf": 3, "white_wolf": 1},
+    13: {"villager": 4, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "magician": 1,
+         "wolf": 3, "white_wolf": 1},
+    14: {"villager": 5, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "magician": 1,
+         "wolf": 3, "white_wolf": 1},
+    15: {"villager": 5, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "magician": 1,
+         "wolf": 3, "white_wolf": 1, "hidden_wolf": 1},
+    16: {"villager": 5, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "magician": 1, "spiritualist": 1,
+         "wolf": 3, "white_wolf": 1, "hidden_wolf": 1},
+    17: {"villager": 5, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "magician": 1, "spiritualist": 1,
+         "wolf": 3, "white_wolf": 1, "hidden_wolf": 1, "painter": 1},
+    18: {"villager": 6, "seer": 1, "witch": 1, "hunter": 1, "guard": 1, "magician": 1, "spiritualist": 1,
+         "wolf": 3, "white_wolf": 1, "hidden_wolf": 1, "painter": 1}
+}
+
+def get_acting_role(game: Dict[str, Any], player: Dict[str, Any]) -> str:
+    """获取玩家当前实际行使能力的角色（觉醒的隐狼按狼人行动）"""
+    if player["role"] == "hidden_wolf" and game.get("hidden_wolf_awakened"):
+        return "wolf"
+    return player["role"]
+
+def get_player_camp(player: Dict[str, Any]) -> Camp:
+    """结算阵营：情侣不论原阵营都按情侣阵营计算"""
+    return Camp.LOVER if player["is_lover"] else ROLES[player["original_role"]]["camp"]
+
+def generate_room_id() -> str:
+    """生成房间号"""
+    return f"WWG{int(time.time()) % 1000000:06d}"
+
+# ==================== 消息模板 ====================
+def _escape_template(text: str) -> str:
+    """转义模板中的花括号"""
+    return text.replace("{", "{{").replace("}", "}}")
+
+def _compile_role_templates(roles: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """加载时为每个角色预编译开局身份卡与夜晚行动消息模板"""
+    card_templates = {}
+    night_templates = {}
+
+    for role_id, role_info in roles.items():
+        name = _escape_template(role_info["name"])
+        description = _escape_template(role_info["description"])
+        command = _escape_template(role_info["command"] or "")
+
+        # 开局身份卡
+        card = (
+            "🎮 游戏开始！\n\n"
+            "📍 房间号: {room_id}\n"
+            f"🎯 你的身份: {name}\n"
+            "🔢 你的号码: {number}号\n\n"
+            f"📖 角色描述: {description}\n\n"
+            "{teammates}"
+        )
+        if role_info["command"]:
+            if role_id == "magician":
+                card += f"📝 使用命令: /wwg {command} <号码1> <号码2>\n"
+                card += "💡 示例: /wwg swap 3 5 （交换3号和5号）"
+            elif role_id == "cupid":
+                card += f"📝 使用命令: /wwg {command} <号码1> <号码2>\n"
+                card += "💡 示例: /wwg choose 2 4 （选择2号和4号成为情侣）"
+            else:
+                card += f"📝 使用命令: /wwg {command} <目标号码>\n"
+                card += "💡 示例: /wwg check 3 （查验3号玩家）"
+        card_templates[role_id] = card
+
+        # 夜晚行动消息
+        night = (
+            "🌙 第 {day_count} 夜行动\n"
+            f"你的身份：{name}\n"
+            "你的号码：{number}号\n\n"
+            f"🎯 角色能力：{description}\n\n"
+            "{extra}"
+            "📊 当前进度：{acted_count}/{total_players} 位玩家已完成行动\n\n"
+            f"📝 使用命令：/wwg {command} <目标号码>\n"
+        )
+        if role_id == "magician":
+            night += "💡 示例：/wwg swap 3 5 （交换3号和5号）"
+        elif role_id == "cupid":
+            night += "💡 示例：/wwg choose 2 4 （选择2号和4号成为情侣）"
+        else:
+            night += "💡 示例：/wwg check 3 （查验3号玩家）"
+        night_templates[role_id] = night
+
+    return card_templates, night_templates
+
+ROLE_CARD_TEMPLATES, NIGHT_ROLE_TEMPLATES = _compile_role_templates(ROLES)
+
+def render_player_reveal(game: Dict[str, Any]) -> str:
+    """渲染玩家身份揭示列表"""
+    lines = []
+    for player in game["players"].values():
+        role_name = ROLES[player["original_role"]]["name"]
+        status = "存活" if player["status"] == PlayerStatus.ALIVE.value else "死亡"
+        lines.append(f"{player['number']}号 {player['name']} - {role_name} ({status})\n")
+    return "".join(lines)
+
+# ==================== 自定义角色 ====================
+# 自定义角色可用的夜晚行动类型
+CUSTOM_ACTION_KINDS = ("none", "check", "protect", "kill")
+
+# 内置角色与预设，重新注册自定义角色时据此还原
+BUILTIN_ROLE_IDS = frozenset(ROLES)
+BUILTIN_ROLE_PRESETS = {size: dict(preset) for size, preset in ROLE_PRESETS.items()}
+BUILTIN_NIGHT_RESOLUTION_ORDER = tuple(NIGHT_RESOLUTION_ORDER)
+
+# 内置的游戏子命令，自定义角色的命令不能与之重名
+BUILTIN_SUBCOMMANDS = {"host", "join", "queue", "leave", "watch", "unwatch", "status", "settings", "start",
+                       "profile", "archive", "rank", "stats", "test_private", "name", "export", "profiler",
+                       "health", "destroy", "vote", "skip", "save", "poison"}
+
+class CustomRoleAction(NamedTuple):
+    role: str
+    kind: str  # check / protect / kill
+    reveal: str  # check 的结果：camp 只看阵营，role 看具体身份
+
+def _parse_custom_role(entry: Dict[str, Any], taken_commands: Set[str]) -> Tuple[Dict[str, Any], str, str, int]:
+    """校验一项自定义角色配置，返回 (角色信息, 目标范围, 查验阵营, 优先级)，不合法时抛出 ValueError"""
+    role_id = str(entry.get("id", ""))
+    if not re.fullmatch(r"[a-z][a-z0-9_]*", role_id):
+        raise ValueError(f"角色代号不合法: {role_id!r}")
+    if role_id in ROLES:
+        raise ValueError(f"角色代号已存在: {role_id}")
+
+    name = str(entry.get("name", "")).strip()
+    if not name:
+        raise ValueError(f"{role_id}: 缺少角色名称")
+
+    camps = {camp.value: camp for camp in (Camp.VILLAGE, Camp.WOLF, Camp.THIRD_PARTY)}
+    camp = camps.get(entry.get("camp"))
+    if camp is None:
+        raise ValueError(f"{role_id}: 阵营必须是 {'/'.join(camps)}")
+    check_mask = camps.get(entry.get("check_mask", camp.value))
+    if check_mask is None:
+        raise ValueError(f"{role_id}: check_mask 必须是 {'/'.join(camps)}")
+
+    kind = entry.get("action", "none")
+    if kind not in CUSTOM_ACTION_KINDS:
+        raise ValueError(f"{role_id}: 行动类型必须是 {'/'.join(CUSTOM_ACTION_KINDS)}")
+    command = None
+    if kind != "none":
+        command = str(entry.get("command", ""))
+        if not re.fullmatch(r"[a-z][a-z0-9_]*", command):
+            raise ValueError(f"{role_id}: 行动命令不合法: {command!r}")
+        if command in taken_commands:
+            raise ValueError(f"{role_id}: 行动命令与已有命令重名: {command}")
+
+    targets = entry.get("targets", "alive")
+    if targets not in ("alive", "other", "dead"):
+        raise ValueError(f"{role_id}: 目标范围必须是 alive/other/dead")
+    reveal = entry.get("reveal", "camp")
+    if reveal not in ("camp", "role"):
+        raise ValueError(f"{role_id}: 查验结果必须是 camp/role")
+    priority = entry.get("priority", 100)
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        raise ValueError(f"{role_id}: 优先级必须是整数")
+
+    role_info = {
+        "name": name,
+        "camp": camp,
+        "is_sub": False,
+        "night_action": kind != "none",
+        "day_action": False,
+        "command": command,
+        "description": str(entry.get("description") or name),
+        "action": CustomRoleAction(role_id, kind, reveal) if kind != "none" else None
+    }
+    return role_info, targets, check_mask, priority
+
+def _parse_role_preset(entry: Dict[str, Any]) -> Tuple[int, Dict[str, int]]:
+    """校验一项人数预设，返回 (人数, 角色配置)，不合法时抛出 ValueError"""
+    size = entry.get("size")
+    if not isinstance(size, int) or not 6 <= size <= 18:
+        raise ValueError(f"预设人数必须在6-18之间: {size!r}")
+    roles = entry.get("roles")
+    if not isinstance(roles, dict) or not roles:
+        raise ValueError(f"{size}人预设: 缺少角色配置")
+    preset = {}
+    for role_id, count in roles.items():
+        if role_id not in ROLES:
+            raise ValueError(f"{size}人预设: 未知角色 {role_id}")
+        if not isinstance(count, int) or count < 0:
+            raise ValueError(f"{size}人预设: {role_id} 数量不合法")
+        if count:
+            preset[role_id] = count
+    if sum(preset.values()) != size:
+        raise ValueError(f"{size}人预设: 角色总数 {sum(preset.values())} 与人数不符")
+    if not any(ROLES[role_id]["camp"] == Camp.WOLF for role_id in preset):
+        raise ValueError(f"{size}人预设: 至少需要一名狼人阵营角色")
+    return size, preset
+
+def register_custom_roles(role_entries: List[Dict[str, Any]], preset_entries: List[Dict[str, Any]]) -> List[str]:
+    """把配置中的自定义角色和人数预设编译进 ROLES 等查找表，返回被跳过的配置项的错误说明
+
+    加载时执行；编译后自定义角色与内置角色走相同的查表路径，运行时没有额外开销。
+    重复调用时先清除上次注册的自定义角色和预设。
+    """
+    for role_id in set(ROLES) - BUILTIN_ROLE_IDS:
+        for table in (ROLES, CHECK_CAMPS, ROLE_TARGETS, NIGHT_ACTION_KEYS, CUSTOM_ROLE_ACTIONS,
+                      ROLE_CARD_TEMPLATES, NIGHT_ROLE_TEMPLATES):
+            table.pop(role_id, None)
+    NIGHT_RESOLUTION_ORDER[:] = BUILTIN_NIGHT_RESOLUTION_ORDER
+    ROLE_PRESETS.clear()
+    ROLE_PRESETS.update({size: dict(preset) for size, preset in BUILTIN_ROLE_PRESETS.items()})
+
+    errors = []
+    taken_commands = set(BUILTIN_SUBCOMMANDS)
+    for role_info in ROLES.values():
+        taken_commands.update((role_info["command"] or "").split("/"))
+
+    added = {}
+    for entry in role_entries:
+        try:
+            if not isinstance(entry, dict):
+                raise ValueError(f"角色配置必须是表: {entry!r}")
+            role_info, targets, check_mask, priority = _parse_custom_role(entry, taken_commands)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+
+        role_id = entry["id"]
+        action = role_info.pop("action")
+        ROLES[role_id] = role_info
+        CHECK_CAMPS[role_id] = check_mask
+        if targets != "alive":
+            ROLE_TARGETS[role_id] = targets
+        if action:
+            taken_commands.add(role_info["command"])
+            NIGHT_ACTION_KEYS[role_id] = role_id
+            CUSTOM_ROLE_ACTIONS[role_id] = action
+            NIGHT_RESOLUTION_ORDER.append((priority, role_id))
+        added[role_id] = role_info
+
+    # 守护类行动（守卫与 protect 自定义角色）提前到所有击杀类行动之前，否则优先级排在击杀之后的守护挡不住当晚的刀；
+    # 其余按优先级稳定排序：同优先级时内置角色在前，自定义角色按配置顺序
+    def kind_of(action_key: str) -> Optional[str]:
+        if action_key in ("wolf_kill", "witch_poison"):
+            return "kill"
+        if action_key == "guard":
+            return "protect"
+        action = CUSTOM_ROLE_ACTIONS.get(action_key)
+        return action.kind if action else None
+
+    first_kill = min(priority for priority, action_key in NIGHT_RESOLUTION_ORDER if kind_of(action_key) == "kill")
+
+    def resolution_key(item: Tuple[int, str]) -> Tuple[int, int]:
+        priority, action_key = item
+        if kind_of(action_key) == "protect":
+            return (min(priority, first_kill), 0)
+        return (priority, 1)
+    NIGHT_RESOLUTION_ORDER.sort(key=resolution_key)
+    card_templates, night_templates = _compile_role_templates(added)
+    ROLE_CARD_TEMPLATES.update(card_templates)
+    NIGHT_ROLE_TEMPLATES.update(night_templates)
+
+    for entry in preset_entries:
+        try:
+            if not isinstance(entry, dict):
+                raise ValueError(f"预设配置必须是表: {entry!r}")
+            size, preset = _parse_role_preset(entry)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+        ROLE_PRESETS[size] = preset
+
+    return errors
+
+# ==================== 对局快照 ====================
+# 快照格式版本：1 为旧版缩进 JSON（无版本字段），2 起为紧凑编码并写入 snapshot_version
+SNAPSHOT_VERSION = 2
+
+# 快照中可能出现的枚举类型
+SNAPSHOT_ENUMS = {cls.__name__: cls for cls in (GamePhase, PlayerStatus, DeathReason, Camp, WitchStatus)}
+
+# 以元组形式保存在内存中的字段（JSON 只能还原为列表）
+SNAPSHOT_TUPLE_FIELDS = ("magician_swap",)
+
+def _encode_snapshot_value(value: Any) -> Any:
+    """编码 JSON 不支持的类型：集合与枚举"""
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": sorted(value, key=str)}
+    if isinstance(value, Enum):
+        return {"__enum__": type(value).__name__, "value": value.value}
+    raise TypeError(f"快照不支持的类型: {type(value).__name__}")
+
+def _decode_snapshot_object(obj: Dict[str, Any]) -> Any:
+    """还原编码过的集合与枚举"""
+    if "__set__" in obj:
+        return set(obj["__set__"])
+    if "__enum__" in obj:
+        return SNAPSHOT_ENUMS[obj["__enum__"]](obj["value"])
+    return obj
+
+def _migrate_snapshot_v1(game: Dict[str, Any]) -> Dict[str, Any]:
+    """v1 -> v2：补齐新增字段，集合字段由列表还原"""
+    game["saved_players"] = set(game.get("saved_players") or [])
+    game.setdefault("state_version", 0)
+    for player in game.get("players", {}).values():
+        if isinstance(player.get("camp"), str):
+            player["camp"] = Camp(player["camp"])
+    return game
+
+# 从某个版本升级到下一版本的迁移函数
+SNAPSHOT_MIGRATIONS = {
+    1: _migrate_snapshot_v1
+}
+
+def encode_game_snapshot(game: Dict[str, Any]) -> bytes:
+    """将游戏状态编码为紧凑的版本化快照"""
+    game["snapshot_version"] = SNAPSHOT_VERSION
+    return json.dumps(game, ensure_ascii=False, separators=(",", ":"),
+                      default=_encode_snapshot_value).encode("utf-8")
+
+def decode_game_snapshot(data: bytes) -> Dict[str, Any]:
+    """解码快照，旧版本逐级迁移到当前版本"""
+    game = json.loads(data, object_hook=_decode_snapshot_object)
+
+    version = game.get("snapshot_version", 1)
+    if version > SNAPSHOT_VERSION:
+        raise ValueError(f"快照版本 {version} 高于当前支持的版本 {SNAPSHOT_VERSION}")
+    while version < SNAPSHOT_VERSION:
+        game = SNAPSHOT_MIGRATIONS[version](game)
+        version += 1
+    game["snapshot_version"] = SNAPSHOT_VERSION
+
+    for field in SNAPSHOT_TUPLE_FIELDS:
+        if isinstance(game.get(field), list):
+            game[field] = tuple(game[field])
+    return game
+
+# ==================== 归档导出 ====================
+# 导出只包含归档序号早于该秒数的对局：归档文件经多线程 I/O 写入，稍晚归档的对局可能先落盘，
+# 留出时间让更早的对局写完，游标才不会越过尚未出现的文件
+ARCHIVE_SETTLE_SECONDS = 30
+
+def _parse_export_time(value: Optional[str]) -> Optional[datetime.datetime]:
+    """解析导出时间过滤条件（YYYY-MM-DD 或 ISO 时间），带时区的时间换算为本地时间"""
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        # 归档中的 ended_time 是不带时区的本地时间
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+def iter_archived_games(since: Optional[str] = None, until: Optional[str] = None,
+                        group_id: Optional[str] = None, cursor: Optional[str] = None,
+                        settle: float = 0):
+    """按归档先后逐个产出 (游标, 对局)，同一时间只读取一局
+
+    游标为 "<归档序号>:<对局码>"，归档序号在事件循环中归档时分配、单调递增（旧归档没有序号，
+    以文件修改时间代替）；传入上次导出的游标即可从其后继续。settle 秒内归档的对局留到下次。
+    """
+    finished_dir = os.path.join(DATA_DIR, "games", "finished")
+    if not os.path.isdir(finished_dir):
+        return
+
+    since_time = _parse_export_time(since)
+    until_time = _parse_export_time(until)
+
+    after = None
+    if cursor:
+        seq, _, game_code = cursor.partition(":")
+        after = (int(seq), game_code[:-5] if game_code.endswith(".json") else game_code)
+    horizon = time.time_ns() - int(settle * 1e9) if settle else None
+
+    # 文件在分配序号之后才写入，修改时间不早于序号，据此跳过游标之前的文件而不读取内容；
+    # 按修改时间排序只是近似的归档顺序，游标取已产出的最大序号
+    entries = sorted((entry.stat().st_mtime_ns, entry.name)
+                     for entry in os.scandir(finished_dir)
+                     if entry.is_file() and entry.name.endswith(".json")
+                     and (after is None or entry.stat().st_mtime_ns >= after[0]))
+
+    for mtime_ns, filename in entries:
+        try:
+            with open(os.path.join(finished_dir, filename), 'rb') as f:
+                game = decode_game_snapshot(f.read())
+        except Exception as e:
+            storage_logger.warning("读取归档游戏 %s 失败: %s", filename, e)
+            continue
+
+        key = (game.get("archive_seq") or mtime_ns, game.get("game_code") or filename[:-5])
+        if (after and key <= after) or (horizon and key[0] > horizon):
+            continue
+        entry_cursor = f"{key[0]}:{key[1]}"
+
+        if group_id and str(game.get("group_id")) != group_id:
+            continue
+        if since_time or until_time:
+            if not game.get("ended_time"):
+                continue
+            ended_time = datetime.datetime.fromisoformat(game["ended_time"])
+            if (since_time and ended_time < since_time) or (until_time and ended_time >= until_time):
+                continue
+
+        yield entry_cursor, game
+
+def _encode_export_value(value: Any) -> Any:
+    """导出时集合转为列表、枚举转为取值，便于下游直接使用"""
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"无法导出的类型: {type(value).__name__}")
+
+def export_archive_ndjson(output, since: Optional[str] = None, until: Optional[str] = None,
+                          group_id: Optional[str] = None, cursor: Optional[str] = None) -> Tuple[int, Optional[str]]:
+    """将已归档对局以 NDJSON 逐行写入 output，返回 (导出数量, 续传游标)"""
+    count = 0
+    last_cursor = cursor
+    last_key = None
+    for entry_cursor, game in iter_archived_games(since, until, group_id, cursor, ARCHIVE_SETTLE_SECONDS):
+        output.write(json.dumps(game, ensure_ascii=False, separators=(",", ":"),
+                                default=_encode_export_value))
+        output.write("\n")
+        count += 1
+        seq, _, game_code = entry_cursor.partition(":")
+        if last_key is None or (int(seq), game_code) > last_key:
+            last_key = (int(seq), game_code)
+            last_cursor = entry_cursor
+    return count, last_cursor
+
+# ==================== 玩家档案 ====================
+PROFILE_SCHEMA_VERSION = 2
+
+# 最近对局环形缓冲区大小
+RECENT_GAMES_SIZE = 10
+
+# 由对局统计得出、离线重建档案时重新计算的字段；其余字段（昵称、评分、创建时间等）保留原值
+REBUILT_PROFILE_FIELDS = ("total_games", "wins", "losses", "kills", "votes", "recent_win_rate", "recent_games",
+                          "recent_index", "recent_wins", "role_stats", "camp_stats", "group_stats")
+
+# 月度汇总中为每名玩家保存的档案字段
+ROLLUP_PROFILE_FIELDS = ("name", "total_games", "wins", "losses", "kills", "votes",
+                         "role_stats", "camp_stats", "group_stats")
+
+def _add_profile_counters(into: Dict[str, Any], part: Dict[str, Any]):
+    """把 part 的对局计数加到 into 上（不含最近对局）"""
+    for key in ("total_games", "wins", "losses", "kills", "votes"):
+        into[key] += part[key]
+    for field in ("role_stats", "camp_stats", "group_stats"):
+        for key, counter in part[field].items():
+            target = into[field].setdefault(key, dict.fromkeys(counter, 0))
+            for name, value in counter.items():
+                target[name] = target.get(name, 0) + value
+
+def new_profile(qq: str, name: str) -> Dict[str, Any]:
+    """新玩家档案"""
+    return {
+        "schema_version": PROFILE_SCHEMA_VERSION,
+        "qq": qq,
+        "name": name,
+        "total_games": 0,
+        "wins": 0,
+        "losses": 0,
+        "kills": 0,
+        "votes": 0,
+        "recent_win_rate": 0,
+        "recent_games": [],  # 环形缓冲区，recent_index 为下一个写入位置
+        "recent_index": 0,
+        "recent_wins": 0,
+        "role_stats": {},
+        "camp_stats": {},
+        "group_stats": {},  # 群号 -> 群内战绩，用于分群排行榜
+        "rating": _rating_settings["initial"],
+        "rated_games": 0,
+        "created_time": datetime.datetime.now().isoformat()
+    }
+
+def _new_stat_counter() -> Dict[str, int]:
+    """角色/阵营战绩计数器"""
+    return {"games": 0, "wins": 0, "losses": 0, "survived": 0}
+
+def migrate_profile(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """将 v1 档案迁移为 v2：最近对局改为环形缓冲区，补齐角色/阵营战绩"""
+    if profile.get("schema_version", 1) >= PROFILE_SCHEMA_VERSION:
+        return profile
+
+    recent_games = profile.get("recent_games", [])[-RECENT_GAMES_SIZE:]
+    profile["recent_games"] = recent_games
+    profile["recent_index"] = len(recent_games) % RECENT_GAMES_SIZE
+    profile["recent_wins"] = sum(1 for g in recent_games if g["won"])
+    # v1 没有角色/阵营维度的记录，从迁移后开始统计
+    profile.setdefault("role_stats", {})
+    profile.setdefault("camp_stats", {})
+    profile["schema_version"] = PROFILE_SCHEMA_VERSION
+    return profile
+
+def record_profile_game(profile: Dict[str, Any], entry: Dict[str, Any], camp: str, survived: bool):
+    """记录一局结果，所有统计均为 O(1) 增量更新"""
+    won = entry["won"]
+    profile["total_games"] += 1
+    profile["wins" if won else "losses"] += 1
+
+    # 写入环形缓冲区，被覆盖的旧记录从最近胜场中扣除
+    recent_games = profile["recent_games"]
+    index = profile["recent_index"]
+    if len(recent_games) < RECENT_GAMES_SIZE:
+        recent_games.append(entry)
+    else:
+        if recent_games[index]["won"]:
+            profile["recent_wins"] -= 1
+        recent_games[index] = entry
+    if won:
+        profile["recent_wins"] += 1
+    profile["recent_index"] = (index + 1) % RECENT_GAMES_SIZE
+    profile["recent_win_rate"] = profile["recent_wins"] / len(recent_games)
+
+    for stats, key in ((profile["role_stats"], entry["role"]), (profile["camp_stats"], camp)):
+        counter = stats.setdefault(key, _new_stat_counter())
+        counter["games"] += 1
+        counter["wins" if won else "losses"] += 1
+        if survived:
+            counter["survived"] += 1
+
+def iter_recent_games(profile: Dict[str, Any]):
+    """按时间先后遍历最近对局"""
+    recent_games = profile["recent_games"]
+    if len(recent_games) < RECENT_GAMES_SIZE:
+        return iter(recent_games)
+    index = profile["recent_index"]
+    return iter(recent_games[index:] + recent_games[:index])
+
+def has_unknown_roles(game: Dict[str, Any]) -> bool:
+    """对局中是否有当前未注册的角色（如已从配置中移除的自定义角色），这类对局无法计算阵营"""
+    return any(player["original_role"] and player["original_role"] not in ROLES
+               for player in game["players"].values())
+
+def credit_archived_game(game: Dict[str, Any], get_profile) -> Set[str]:
+    """把一局已结束的对局计入玩家档案：胜负、角色/阵营战绩、最近对局、群内战绩、击杀与票杀
+
+    get_profile(QQ) 返回要更新的档案，返回 None 的玩家跳过。归档和离线重建档案共用此函数，
+    保证两者统计口径一致。返回被改动档案的QQ（含击杀者/投票者）。
+    """
+    touched = set()
+    group_id = game.get("group_id")
+
+    def group_counter(profile: Dict[str, Any]) -> Dict[str, int]:
+        return profile.setdefault("group_stats", {}).setdefault(group_id, _new_rank_counter())
+
+    for player_qq, player in game["players"].items():
+        # 未开局就被归档的房间没有分配身份，不计入档案
+        if not player["original_role"]:
+            continue
+        profile = get_profile(player_qq)
+        if profile is None:
+            continue
+        touched.add(player_qq)
+
+        player_camp = get_player_camp(player)
+        is_winner = game["winner"] == player_camp.value
+        record_profile_game(profile, {
+            "game_code": game["game_code"],
+            "role": player["original_role"],
+            "won": is_winner,
+            "timestamp": game["ended_time"]
+        }, player_camp.value, player["status"] == PlayerStatus.ALIVE.value)
+        if group_id:
+            counter = group_counter(profile)
+            counter["total_games"] += 1
+            if is_winner:
+                counter["wins"] += 1
+
+        # 统计击杀和票杀
+        if player["killer"] == player_qq:  # 自杀不算
+            pass
+        elif player["death_reason"] in [DeathReason.HUNTER_SHOOT.value, DeathReason.POISON.value,
+                                        DeathReason.SKILL.value]:
+            killer_profile = get_profile(player["killer"])
+            if killer_profile:
+                killer_profile["kills"] += 1
+                if group_id:
+                    group_counter(killer_profile)["kills"] += 1
+                touched.add(player["killer"])
+        elif player["death_reason"] == DeathReason.VOTE.value:
+            # 票杀统计给所有投票的玩家
+            for voter_qq, vote_number in game.get("votes", {}).items():
+                if vote_number == player["number"]:
+                    voter_profile = get_profile(voter_qq)
+                    if voter_profile:
+                        voter_profile["votes"] += 1
+                        if group_id:
+                            group_counter(voter_profile)["votes"] += 1
+                        touched.add(voter_qq)
+    return touched
+
+# ==================== 排行榜 ====================
+# 榜单指标 -> 显示名称
+RANK_METRICS = {
+    "wins": "胜场",
+    "winrate": "胜率",
+    "kills": "击杀",
+    "votes": "票杀"
+}
+
+# 全服榜单的作用域名
+RANK_GLOBAL_SCOPE = "global"
+
+def _new_rank_counter() -> Dict[str, int]:
+    """群内战绩计数器，字段名与档案顶层一致，方便榜单共用取分逻辑"""
+    return {"total_games": 0, "wins": 0, "kills": 0, "votes": 0}
+
+def get_rank_counter(profile: Dict[str, Any], scope: str) -> Optional[Dict[str, Any]]:
+    """取玩家在某个作用域（全服或群号）下的战绩"""
+    if scope == RANK_GLOBAL_SCOPE:
+        return profile
+    return profile.get("group_stats", {}).get(scope)
+
+class Leaderboard:
+    """增量维护的 Top-K 榜单
+
+    entries 按排序键升序保存前 capacity 名（capacity = 2K，多出的部分作为缓冲），
+    始终满足“entries 就是当前真实的前 len(entries) 名”。分数变化时只在缓冲区内
+    O(K) 调整；只有胜率下降等情况把缓冲区挤到不足 K 名时，才在查询时全量重建。
+    """
+
+    def __init__(self, metric: str, k: int, min_games: int):
+        self.metric = metric
+        self.k = k
+        self.min_games = min_games
+        self.capacity = k * 2
+        self.entries: List[Tuple[Tuple[float, ...], str]] = []
+        self.members: Dict[str, Tuple[Tuple[float, ...], str]] = {}
+        # 缓冲区是否包含了所有上榜玩家（从未因超出容量而截断）
+        self.complete = True
+
+    def score(self, counter: Optional[Dict[str, Any]]) -> Optional[Tuple[float, ...]]:
+        """计算分数，返回 None 表示不上榜"""
+        if not counter:
+            return None
+        games = counter["total_games"]
+        if self.metric == "winrate":
+            if games < self.min_games or games <= 0:
+                return None
+            # 胜率相同时对局数多者靠前
+            return (counter["wins"] / games, games)
+        value = counter[self.metric]
+        return (value,) if value > 0 else None
+
+    def update(self, qq: str, score: Optional[Tuple[float, ...]]):
+        """玩家分数变化后调整缓冲区"""
+        old_key = self.members.pop(qq, None)
+        if old_key is not None:
+            # 移出后剩余成员仍是其他玩家中的真实前几名
+            del self.entries[bisect.bisect_left(self.entries, old_key)]
+        if score is None:
+            return
+
+        key = (tuple(-value for value in score), qq)
+        # 缓冲区外的玩家都不优于末位，只有优于末位（或缓冲区完整）时才能确定其名次
+        if not self.complete and (not self.entries or key > self.entries[-1]):
+            return
+        bisect.insort(self.entries, key)
+        self.members[qq] = key
+        if len(self.entries) > self.capacity:
+            _, dropped = self.entries.pop()
+            del self.members[dropped]
+            self.complete = False
+
+    def rebuild(self, counters):
+        """从 (qq, 战绩) 全量重建缓冲区"""
+        keys = []
+        for qq, counter in counters:
+            score = self.score(counter)
+            if score is not None:
+                keys.append((tuple(-value for value in score), qq))
+        self.entries = heapq.nsmallest(self.capacity, keys)
+        self.members = {key[1]: key for key in self.entries}
+        self.complete = len(keys) <= self.capacity
+
+    def is_ready(self) -> bool:
+        """缓冲区是否足以给出准确的前 K 名"""
+        return self.complete or len(self.entries) >= self.k
+
+    def top(self) -> List[str]:
+        """前 K 名玩家QQ"""
+        return [qq for _, qq in self.entries[:self.k]]
+
+# ==================== 平衡性统计 ====================
+# 阵营编号即 Camp 的定义顺序，对局胜方也用同一编号
+CAMP_ORDER = [camp.value for camp in Camp]
+
+# 首夜死亡列取值：旧归档没有记录首夜死亡名单时为未知
+FIRST_NIGHT_UNKNOWN = 2
+
+def _grouped_sum(keys: array, values: array, size: int, mask=None) -> Tuple[List[int], List[int]]:
+    """按 keys 分组统计行数与 values 之和，mask 为可选的行筛选条件"""
+    if np is not None:
+        key_column = np.frombuffer(keys, dtype=np.uint8)
+        value_column = np.frombuffer(values, dtype=np.uint8)
+        if mask is not None:
+            key_column = key_column[mask]
+            value_column = value_column[mask]
+        totals = np.bincount(key_column, minlength=size)
+        sums = np.bincount(key_column, weights=value_column, minlength=size)
+        return totals.tolist(), sums.astype(int).tolist()
+
+    totals = [0] * size
+    sums = [0] * size
+    for index, key in enumerate(keys):
+        if mask is None or mask[index]:
+            totals[key] += 1
+            sums[key] += values[index]
+    return totals, sums
+
+def balance_rows(game: Dict[str, Any]):
+    """逐名玩家产出平衡性统计的一行 (角色, 阵营编号, 人数, 座位, 是否获胜, 首夜死亡)"""
+    first_night_deaths = game.get("first_night_deaths")
+    player_count = len(game["players"])
+    for player_qq, player in game["players"].items():
+        camp = get_player_camp(player).value
+        if first_night_deaths is None:
+            first_night = FIRST_NIGHT_UNKNOWN
+        else:
+            first_night = int(player_qq in first_night_deaths)
+        yield (player["original_role"], CAMP_ORDER.index(camp), player_count, player["number"],
+               int(camp == game["winner"]), first_night)
+
+class RoleBalanceStats:
+    """角色平衡性统计
+
+    每局每名玩家一行，按列存放在 uint8 数组中；对局另有一张按局的表。
+    归档时增量追加，查询时对整列做分组聚合（有 NumPy 时用 bincount）。
+    超过保留期限、已并入月度汇总的对局以汇总计数的形式加到查询结果上。
+    """
+
+    PLAYER_COLUMNS = ("role", "camp", "player_count", "seat", "won", "first_night")
+    GAME_COLUMNS = ("player_count", "winner")
+
+    def __init__(self):
+        self.players = {name: array("B") for name in self.PLAYER_COLUMNS}
+        self.games = {name: array("B") for name in self.GAME_COLUMNS}
+        self.role_keys: List[str] = []
+        self.role_index: Dict[str, int] = {}
+        self.game_codes: Set[str] = set()
+        # 月度汇总中的计数，键为 (人数, 角色) / (人数, 座位) / (人数, 胜方编号)
+        self.rolled_roles: Dict[Tuple[int, str], List[int]] = {}
+        self.rolled_seats: Dict[Tuple[int, int], List[int]] = {}
+        self.rolled_winners: Dict[Tuple[int, int], int] = {}
+        self.rollups_loaded = False
+        # 归档扫描在线程池中执行，可能与事件循环中的增量追加并发
+        self.lock = threading.Lock()
+
+    def _role_id(self, role: str) -> int:
+        if role not in self.role_index:
+            self.role_index[role] = len(self.role_keys)
+            self.role_keys.append(role)
+        return self.role_index[role]
+
+    def ingest(self, game: Dict[str, Any]) -> bool:
+        """追加一局已结束的对局，重复或无胜方的对局会被忽略"""
+        if game.get("winner") not in CAMP_ORDER:
+            return False
+
+        with self.lock:
+            if game["game_code"] in self.game_codes:
+                return False
+            self.game_codes.add(game["game_code"])
+            self.games["player_count"].append(len(game["players"]))
+            self.games["winner"].append(CAMP_ORDER.index(game["winner"]))
+
+            for role, camp, player_count, seat, won, first_night in balance_rows(game):
+                self.players["role"].append(self._role_id(role))
+                self.players["camp"].append(camp)
+                self.players["player_count"].append(player_count)
+                self.players["seat"].append(seat)
+                self.players["won"].append(won)
+                self.players["first_night"].append(first_night)
+        return True
+
+    def ingest_rollup(self, rollup: Dict[str, Any]):
+        """加入一个月度汇总的计数"""
+        with self.lock:
+            self.game_codes.update(rollup["game_codes"])
+            for key, values in rollup["roles"].items():
+                player_count, _, role = key.partition(":")
+                counts = self.rolled_roles.setdefault((int(player_count), role), [0, 0, 0, 0])
+                for index, value in enumerate(values):
+                    counts[index] += value
+            for key, values in rollup["seats"].items():
+                player_count, _, seat = key.partition(":")
+                counts = self.rolled_seats.setdefault((int(player_count), int(seat)), [0, 0])
+                for index, value in enumerate(values):
+                    counts[index] += value
+            for key, count in rollup["winners"].items():
+                player_count, _, winner = key.partition(":")
+                winner_key = (int(player_count), CAMP_ORDER.index(winner))
+                self.rolled_winners[winner_key] = self.rolled_winners.get(winner_key, 0) + count
+
+    def sync_archive(self) -> int:
+        """读取尚未统计的归档文件（按文件名中的对局码跳过已统计的），返回新增局数
+
+        首次调用时先读入月度汇总；之后新产生的汇总只包含此前已作为明细统计过的对局，无需再读。
+        """
+        finished_dir = os.path.join(DATA_DIR, "games", "finished")
+        # 与归档汇总互斥，避免对局在读取过程中从明细移入汇总而被漏掉
+        with _archive_lock:
+            if not self.rollups_loaded:
+                for rollup in load_archive_rollups():
+                    self.ingest_rollup(rollup)
+                self.rollups_loaded = True
+            if not os.path.isdir(finished_dir):
+                return 0
+            return self._sync_finished(finished_dir)
+
+    def _sync_finished(self, finished_dir: str) -> int:
+        added = 0
+        for filename in os.listdir(finished_dir):
+            if not filename.endswith(".json") or filename[:-5] in self.game_codes:
+                continue
+            try:
+                with open(os.path.join(finished_dir, filename), 'rb') as f:
+                    game = decode_game_snapshot(f.read())
+            except Exception as e:
+                storage_logger.warning("读取归档游戏 %s 失败: %s", filename, e)
+                continue
+            game.setdefault("game_code", filename[:-5])
+            if self.ingest(game):
+                added += 1
+        return added
+
+    @staticmethod
+    def _equals(column: array, value: int):
+        """生成 column == value 的行筛选条件"""
+        if np is not None:
+            return np.frombuffer(column, dtype=np.uint8) == value
+        return [item == value for item in column]
+
+    def role_summary(self, player_count: Optional[int] = None) -> List[Tuple[str, int, int, int, int]]:
+        """按角色汇总 (角色, 出场数, 胜场, 首夜记录数, 首夜死亡数)，可限定人数配置"""
+        with self.lock:
+            players = self.players
+            size = len(self.role_keys)
+            mask = None if player_count is None else self._equals(players["player_count"], player_count)
+            totals, wins = _grouped_sum(players["role"], players["won"], size, mask)
+
+            # 首夜死亡率只统计记录了首夜死亡名单的对局
+            unknown = self._equals(players["first_night"], FIRST_NIGHT_UNKNOWN)
+            if np is not None:
+                known = ~unknown if mask is None else ~unknown & mask
+            else:
+                known = [not u and (mask is None or mask[i]) for i, u in enumerate(unknown)]
+            known_totals, first_night = _grouped_sum(players["role"], players["first_night"], size, known)
+
+            summary = {self.role_keys[i]: [totals[i], wins[i], known_totals[i], first_night[i]] for i in range(size)}
+            for (rolled_count, role), counts in self.rolled_roles.items():
+                if player_count is None or rolled_count == player_count:
+                    summary[role] = [a + b for a, b in zip(summary.get(role, [0, 0, 0, 0]), counts)]
+            return [(role, *counts) for role, counts in summary.items() if counts[0]]
+
+    def seat_summary(self, player_count: int) -> List[Tuple[int, int, int]]:
+        """某人数配置下按座位号汇总 (座位, 出场数, 胜场)"""
+        with self.lock:
+            mask = self._equals(self.players["player_count"], player_count)
+            totals, wins = _grouped_sum(self.players["seat"], self.players["won"], 256, mask)
+            for (rolled_count, seat), (games, won) in self.rolled_seats.items():
+                if rolled_count == player_count:
+                    totals[seat] += games
+                    wins[seat] += won
+            return [(seat, totals[seat], wins[seat]) for seat in range(256) if totals[seat]]
+
+    def winner_summary(self, player_count: int) -> List[int]:
+        """某人数配置下各阵营获胜局数，下标对应 CAMP_ORDER"""
+        with self.lock:
+            mask = self._equals(self.games["player_count"], player_count)
+            totals, _ = _grouped_sum(self.games["winner"], self.games["player_count"], len(CAMP_ORDER), mask)
+            for (rolled_count, winner), count in self.rolled_winners.items():
+                if rolled_count == player_count:
+                    totals[winner] += count
+            return totals
+
+# ==================== 归档保留 ====================
+# 归档目录的扫描（平衡性统计）与并入汇总互斥
+_archive_lock = threading.Lock()
+
+def _rollup_dir() -> str:
+    return os.path.join(DATA_DIR, "games", "rollups")
+
+def _new_rollup(month: str) -> Dict[str, Any]:
+    """月度汇总：足以支撑档案重建、排行榜与平衡性统计的聚合计数"""
+    return {
+        "month": month,
+        "games": 0,
+        "game_codes": [],  # 已并入的对局码，防止重复计入
+        "winners": {},  # "人数:胜方" -> 局数
+        "roles": {},  # "人数:角色" -> [出场, 胜场, 首夜有记录, 首夜死亡]
+        "seats": {},  # "人数:座位" -> [出场, 胜场]
+        "groups": {},  # 群号 -> {"games": 局数, "winners": {胜方: 局数}}
+        "players": {}  # QQ -> 档案中的统计字段（不含最近对局）
+    }
+
+def load_archive_rollups() -> List[Dict[str, Any]]:
+    """按月份先后读取全部月度汇总"""
+    rollup_dir = _rollup_dir()
+    if not os.path.isdir(rollup_dir):
+        return []
+    rollups = []
+    for filename in sorted(os.listdir(rollup_dir)):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(rollup_dir, filename), 'r', encoding='utf-8') as f:
+                rollups.append(json.load(f))
+        except Exception as e:
+            storage_logger.warning("读取归档汇总 %s 失败: %s", filename, e)
+    return rollups
+
+def fold_game_into_rollup(rollup: Dict[str, Any], game: Dict[str, Any]):
+    """把一局对局的统计并入月度汇总"""
+    rollup["games"] += 1
+    rollup["game_codes"].append(game["game_code"])
+    winner = game.get("winner")
+    group_id = game.get("group_id")
+    if group_id:
+        group = rollup["groups"].setdefault(str(group_id), {"games": 0, "winners": {}})
+        group["games"] += 1
+        group["winners"][winner] = group["winners"].get(winner, 0) + 1
+
+    # 玩家统计与归档时的口径相同
+    partial: Dict[str, Dict[str, Any]] = {}
+    credit_archived_game(game, lambda qq: partial.setdefault(qq, new_profile(qq, qq)))
+    for qq, part in partial.items():
+        player = game["players"].get(qq)
+        if player:
+            part["name"] = player["name"]
+        if qq in rollup["players"]:
+            _add_profile_counters(rollup["players"][qq], part)
+            rollup["players"][qq]["name"] = part["name"]
+        else:
+            rollup["players"][qq] = {key: part[key] for key in ROLLUP_PROFILE_FIELDS}
+
+    if winner not in CAMP_ORDER:
+        return
+    player_count = len(game["players"])
+    rollup["winners"][f"{player_count}:{winner}"] = rollup["winners"].get(f"{player_count}:{winner}", 0) + 1
+    for role, _, _, seat, won, first_night in balance_rows(game):
+        counts = rollup["roles"].setdefault(f"{player_count}:{role}", [0, 0, 0, 0])
+        counts[0] += 1
+        counts[1] += won
+        if first_night != FIRST_NIGHT_UNKNOWN:
+            counts[2] += 1
+            counts[3] += first_night
+        seat_counts = rollup["seats"].setdefault(f"{player_count}:{seat}", [0, 0])
+        seat_counts[0] += 1
+        seat_counts[1] += won
+
+class ArchiveRetention:
+    """归档保留：完成超过保留天数的对局按月并入 games/rollups/ 下的月度汇总，再删除明细文件
+
+    后台任务每批只处理少量文件，读写与汇总在线程中执行，批次之间让出事件循环。
+    汇总先落盘再删除明细；中途退出时残留的明细会因对局码已在汇总中而直接删除，不会重复计入。
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.max_age = 0.0
+            cls._instance.batch_size = 200
+            cls._instance.task = None
+            cls._instance.stats = {"folded": 0, "removed": 0, "last_pass": None}
+        return cls._instance
+
+    def start(self, max_age_days: float, batch_size: int, interval: float):
+        self.max_age = max_age_days * 86400
+        self.batch_size = max(1, batch_size)
+        self.task = asyncio.create_task(self._run(interval))
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self, interval: float):
+        while True:
+            try:
+                await self.run_pass()
+                await asyncio.sleep(interval)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                storage_logger.exception("归档汇总错误: %s", e)
+                await asyncio.sleep(interval)
+
+    async def run_pass(self) -> int:
+        """处理一轮：找出全部过期明细，分批并入汇总，返回并入的局数"""
+        loop = asyncio.get_running_loop()
+        expired = await loop.run_in_executor(None, self.find_expired, time.time())
+        folded = 0
+        for i in range(0, len(expired), self.batch_size):
+            folded += await loop.run_in_executor(None, self.fold_batch, expired[i:i + self.batch_size])
+            # 批次之间短暂让出，不与命令处理争抢
+            await asyncio.sleep(0.1)
+        self.stats["last_pass"] = time.time()
+        if expired:
+            storage_logger.info("归档汇总完成：%d 个过期明细，并入 %d 局", len(expired), folded)
+        return folded
+
+    def find_expired(self, now: float) -> List[str]:
+        """按归档时间先后列出过期的明细文件名（只看文件修改时间，不读取内容）"""
+        finished_dir = os.path.join(DATA_DIR, "games", "finished")
+        if not os.path.isdir(finished_dir):
+            return []
+        cutoff = now - self.max_age
+        return [name for _, name in sorted((entry.stat().st_mtime, entry.name)
+                                           for entry in os.scandir(finished_dir)
+                                           if entry.is_file() and entry.name.endswith(".json")
+                                           and entry.stat().st_mtime < cutoff)]
+
+    def fold_batch(self, filenames: List[str]) -> int:
+        """把一批明细并入各自月份的汇总（在线程中执行），返回新并入的局数"""
+        finished_dir = os.path.join(DATA_DIR, "games", "finished")
+        io_executor = get_io_executor()
+        by_month: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+        for filename in filenames:
+            path = os.path.join(finished_dir, filename)
+            try:
+                with open(path, 'rb') as f:
+                    game = decode_game_snapshot(f.read())
+                ended_time = game.get("ended_time") or \
+                    datetime.datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+            except Exception as e:
+                # 无法读取的明细保留原样，留待人工处理
+                storage_logger.warning("读取归档游戏 %s 失败: %s", filename, e)
+                continue
+            if has_unknown_roles(game):
+                # 角色已不在配置中时无法计算阵营，明细保留原样，重新注册该角色后下一轮再并入
+                storage_logger.warning("归档游戏 %s 含未注册的角色，暂不并入汇总", filename)
+                continue
+            game.setdefault("game_code", filename[:-5])
+            by_month.setdefault(ended_time[:7], []).append((filename, game))
+
+        folded = 0
+        with _archive_lock:
+            for month, games in by_month.items():
+                path = os.path.join(_rollup_dir(), f"{month}.json")
+                data = io_executor.read(path).result()
+                rollup = json.loads(data.decode("utf-8")) if data else _new_rollup(month)
+                known = set(rollup["game_codes"])
+                for _, game in games:
+                    if game["game_code"] not in known:
+                        fold_game_into_rollup(rollup, game)
+                        known.add(game["game_code"])
+                        folded += 1
+
+                # 汇总落盘后才删除明细
+                io_executor.write(path, json.dumps(rollup, ensure_ascii=False,
+                                                   separators=(",", ":")).encode("utf-8")).result()
+                for filename, _ in games:
+                    io_executor.remove(os.path.join(finished_dir, filename))
+                self.stats["removed"] += len(games)
+        self.stats["folded"] += folded
+        return folded
+
+# ==================== 技术评分 ====================
+_rating_settings = {"k_factor": 24.0, "initial": 1500.0}
+
+def configure_rating(k_factor: float, initial: float):
+    """设置评分的 K 值与初始分"""
+    _rating_settings.update(k_factor=float(k_factor), initial=float(initial))
+
+def _new_camp_record() -> Dict[str, int]:
+    return {"games": 0, "wins": 0}
+
+def camp_rating_bias(games: float, wins: float):
+    """阵营强度修正：把该阵营历史胜率（加一平滑）换算成 Elo 分差，可传入数组"""
+    if np is not None and isinstance(games, np.ndarray):
+        return 400 * np.log10((wins + 1) / (games - wins + 1))
+    return 400 * math.log10((wins + 1) / (games - wins + 1))
+
+def rate_game(game: Dict[str, Any], ratings: Dict[str, float], camp_records: Dict[str, Dict[str, int]],
+              k_factor: float, initial: float) -> Tuple[Dict[str, float], Optional[float]]:
+    """按阵营组队计算一局的评分变化，O(玩家数)
+
+    每个阵营的实力 = 成员平均分 + 阵营修正，对手实力为其余阵营按人数加权的平均；
+    阵营内所有成员获得相同的分数变化。返回 (新评分, 胜方赛前预期胜率)，
+    并把本局计入 camp_records。
+    """
+    winner = game.get("winner")
+    # 不活跃归档的对局（含未开局、未分配身份的房间）不计分
+    if winner not in CAMP_ORDER:
+        return {}, None
+    teams: Dict[str, List[str]] = {}
+    for player_qq, player in game["players"].items():
+        if not player["original_role"]:
+            continue
+        teams.setdefault(get_player_camp(player).value, []).append(player_qq)
+    if len(teams) < 2:
+        return {}, None
+
+    strengths = {}
+    for camp, members in teams.items():
+        record = camp_records.get(camp, _new_camp_record())
+        mean = sum(ratings.get(qq, initial) for qq in members) / len(members)
+        strengths[camp] = mean + camp_rating_bias(record["games"], record["wins"])
+    player_total = len(game["players"])
+    strength_total = sum(strengths[camp] * len(members) for camp, members in teams.items())
+
+    new_ratings = {}
+    winner_expected = None
+    for camp, members in teams.items():
+        size = len(members)
+        opponent = (strength_total - strengths[camp] * size) / (player_total - size)
+        expected = 1 / (1 + 10 ** ((opponent - strengths[camp]) / 400))
+        won = camp == winner
+        if won:
+            winner_expected = expected
+        delta = k_factor * (won - expected)
+        for qq in members:
+            new_ratings[qq] = ratings.get(qq, initial) + delta
+
+        record = camp_records.setdefault(camp, _new_camp_record())
+        record["games"] += 1
+        record["wins"] += won
+    return new_ratings, winner_expected
+
+def _recompute_ratings_sequential(games: List[Dict[str, Any]], k_factor: float, initial: float):
+    """逐局重放，未安装 NumPy 时使用"""
+    ratings: Dict[str, float] = {}
+    rated_games: Dict[str, int] = {}
+    camp_records: Dict[str, Dict[str, int]] = {}
+    winner_expected = []
+    for game in games:
+        new_ratings, expected = rate_game(game, ratings, camp_records, k_factor, initial)
+        ratings.update(new_ratings)
+        for qq in new_ratings:
+            rated_games[qq] = rated_games.get(qq, 0) + 1
+        if expected is not None:
+            winner_expected.append(expected)
+    return ratings, rated_games, camp_records, winner_expected
+
+def _recompute_ratings_vectorized(games: List[Dict[str, Any]], k_factor: float, initial: float):
+    """分层批量重放，结果与逐局重放一致
+
+    每局的层号 = 其玩家上一局层号的最大值 + 1，同一层内的对局没有共同玩家，
+    可以整层一起更新；阵营修正只依赖此前的胜负次数，用前缀和一次算出。
+    """
+    player_index: Dict[str, int] = {}
+    last_level: Dict[int, int] = {}
+    team_level, team_game, team_camp, team_won, team_size = [], [], [], [], []
+    row_player, row_team = [], []
+
+    for game_id, game in enumerate(games):
+        # 与 rate_game 相同：先看胜方，未开局的房间没有分配身份，不能计算阵营
+        if game.get("winner") not in CAMP_ORDER:
+            continue
+        teams: Dict[str, List[int]] = {}
+        for player_qq, player in game["players"].items():
+            if not player["original_role"]:
+                continue
+            index = player_index.setdefault(player_qq, len(player_index))
+            teams.setdefault(get_player_camp(player).value, []).append(index)
+        if len(teams) < 2:
+            continue
+
+        level = 1 + max(last_level.get(index, -1) for members in teams.values() for index in members)
+        for camp, members in teams.items():
+            team_id = len(team_level)
+            team_level.append(level)
+            team_game.append(game_id)
+            team_camp.append(CAMP_ORDER.index(camp))
+            team_won.append(camp == game["winner"])
+            team_size.append(len(members))
+            for index in members:
+                last_level[index] = level
+                row_player.append(index)
+                row_team.append(team_id)
+
+    ratings = np.full(len(player_index), float(initial))
+    qq_list = list(player_index)
+    if not team_level:
+        return {}, {}, {}, []
+
+    team_level = np.array(team_level)
+    team_game = np.array(team_game)
+    team_camp = np.array(team_camp)
+    team_won = np.array(team_won, dtype=float)
+    team_size = np.array(team_size, dtype=float)
+    row_player = np.array(row_player)
+    row_team = np.array(row_team)
+
+    # 每个阵营按时间顺序的前缀胜负次数 -> 赛前阵营修正
+    games_before = np.zeros(len(team_level))
+    wins_before = np.zeros(len(team_level))
+    for camp in range(len(CAMP_ORDER)):
+        selected = np.flatnonzero(team_camp == camp)
+        games_before[selected] = np.arange(len(selected))
+        wins_before[selected] = np.cumsum(team_won[selected]) - team_won[selected]
+    team_bias = camp_rating_bias(games_before, wins_before)
+
+    # 按层号排序后每层的阵营行、玩家行都是连续区间
+    team_order = np.argsort(team_level, kind="stable")
+    row_order = np.argsort(team_level[row_team], kind="stable")
+    team_bounds = np.searchsorted(team_level[team_order], np.arange(team_level.max() + 2))
+    row_bounds = np.searchsorted(team_level[row_team][row_order], np.arange(team_level.max() + 2))
+    team_position = np.empty(len(team_level), dtype=int)
+    team_position[team_order] = np.arange(len(team_level))
+
+    winner_expected = []
+    for level in range(team_level.max() + 1):
+        teams = team_order[team_bounds[level]:team_bounds[level + 1]]
+        rows = row_order[row_bounds[level]:row_bounds[level + 1]]
+        local_team = team_position[row_team[rows]] - team_bounds[level]
+        players = row_player[rows]
+
+        sizes = team_size[teams]
+        means = np.bincount(local_team, weights=ratings[players], minlength=len(teams)) / sizes
+        strengths = means + team_bias[teams]
+        _, local_game = np.unique(team_game[teams], return_inverse=True)
+        player_total = np.bincount(local_game, weights=sizes)[local_game]
+        strength_total = np.bincount(local_game, weights=strengths * sizes)[local_game]
+        opponents = (strength_total - strengths * sizes) / (player_total - sizes)
+        expected = 1 / (1 + 10 ** ((opponents - strengths) / 400))
+        won = team_won[teams]
+        winner_expected.extend(expected[won == 1].tolist())
+        ratings[players] += k_factor * (won - expected)[local_team]
+
+    rated_counts = np.bincount(row_player, minlength=len(player_index))
+    camp_records = {}
+    for camp_id, camp in enumerate(CAMP_ORDER):
+        selected = team_camp == camp_id
+        if selected.any():
+            camp_records[camp] = {"games": int(selected.sum()), "wins": int(team_won[selected].sum())}
+    rated = {qq_list[i]: float(ratings[i]) for i in np.flatnonzero(rated_counts)}
+    rated_games = {qq_list[i]: int(rated_counts[i]) for i in np.flatnonzero(rated_counts)}
+    return rated, rated_games, camp_records, winner_expected
+
+def recompute_ratings(games: List[Dict[str, Any]], k_factor: float, initial: float):
+    """按时间顺序重放全部对局，返回 (评分, 已评局数, 阵营胜负记录, 胜方赛前预期胜率列表)"""
+    games = sorted(games, key=lambda game: game.get("ended_time") or "")
+    if np is not None:
+        return _recompute_ratings_vectorized(games, k_factor, initial)
+    return _recompute_ratings_sequential(games, k_factor, initial)
+
+# ==================== 文件 I/O ====================
+def _resolve_future(future: concurrent.futures.Future, result: Any):
+    """设置结果；等待方（如被取消的 asyncio 任务）已取消的 Future 跳过，写入等操作本身照常完成"""
+    try:
+        if not future.cancelled():
+            future.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        pass
+
+def _reject_future(future: concurrent.futures.Future, error: BaseException):
+    try:
+        if not future.done():
+            future.set_exception(error)
+    except concurrent.futures.InvalidStateError:
+        pass
+
+class FileIOExecutor:
+    """专用文件 I/O 线程池
+
+    同一路径的操作按路径哈希固定到同一条线程，按提交顺序执行，因此对同一文件的写入不会乱序；
+    写入采用临时文件+重命名保证原子性，每批写入统一 fsync 后再重命名。
+    """
+
+    def __init__(self, lanes: int = 4, fsync: bool = True, batch_size: int = 64):
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.last_error: Optional[Tuple[float, str, str]] = None
+        self._queues = [queue.Queue() for _ in range(max(1, lanes))]
+        for index, lane_queue in enumerate(self._queues):
+            threading.Thread(target=self._run_lane, args=(lane_queue,),
+                             name=f"wwg-io-{index}", daemon=True).start()
+
+    def _submit(self, op: str, path: str, data: Optional[bytes] = None) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        lane = zlib.crc32(path.encode("utf-8")) % len(self._queues)
+        self._queues[lane].put((op, path, data, future))
+        return future
+
+    def write(self, path: str, data: bytes) -> concurrent.futures.Future:
+        """原子写入文件"""
+        return self._submit("write", path, data)
+
+    def remove(self, path: str) -> concurrent.futures.Future:
+        """删除文件（文件不存在时忽略）"""
+        return self._submit("remove", path)
+
+    def read(self, path: str) -> concurrent.futures.Future:
+        """读取文件内容，文件不存在时结果为None"""
+        return self._submit("read", path)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待此前提交的所有操作完成"""
+        barriers = []
+        for lane_queue in self._queues:
+            future = concurrent.futures.Future()
+            lane_queue.put(("barrier", "", None, future))
+            barriers.append(future)
+        done, not_done = concurrent.futures.wait(barriers, timeout=timeout)
+        return not not_done
+
+    def pending_count(self) -> int:
+        """排队中的操作数"""
+        return sum(lane_queue.qsize() for lane_queue in self._queues)
+
+    def _run_lane(self, lane_queue: queue.Queue):
+        while True:
+            batch = [lane_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(lane_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._process_batch(batch)
+            except Exception as e:
+                # 一批出错不能结束本线程，否则之后分到这条线程的操作都不会执行
+                storage_logger.exception("文件I/O批处理错误: %s", e)
+                for _, path, _, future in batch:
+                    _reject_future(future, e)
+
+    def _process_batch(self, batch: List[Tuple[str, str, Optional[bytes], concurrent.futures.Future]]):
+        # 同一批内对同一路径的多次写入只保留最后一次
+        pending: Dict[str, Tuple[bytes, List[concurrent.futures.Future]]] = {}
+
+        for op, path, data, future in batch:
+            if op == "write":
+                _, futures = pending.pop(path, (None, []))
+                futures.append(future)
+                pending[path] = (data, futures)
+                continue
+
+            if op == "barrier":
+                self._commit(pending)
+                pending = {}
+                _resolve_future(future, True)
+                continue
+
+            if path in pending:
+                if op == "remove":
+                    # 被后续删除覆盖的写入无需落盘
+                    for write_future in pending.pop(path)[1]:
+                        _resolve_future(write_future, True)
+                else:
+                    self._commit({path: pending.pop(path)})
+
+            try:
+                if op == "remove":
+                    if os.path.exists(path):
+                        os.remove(path)
+                    _resolve_future(future, True)
+                elif op == "read":
+                    # 等待方已取消的读取无需再读
+                    if future.cancelled():
+                        continue
+                    if os.path.exists(path):
+                        with open(path, 'rb') as f:
+                            _resolve_future(future, f.read())
+                    else:
+                        _resolve_future(future, None)
+            except Exception as e:
+                self._record_error(path, e)
+                _reject_future(future, e)
+
+        self._commit(pending)
+
+    def _commit(self, pending: Dict[str, Tuple[bytes, List[concurrent.futures.Future]]]):
+        """写临时文件 -> 批量 fsync -> 重命名 -> 每个目录 fsync 一次"""
+        if not pending:
+            return
+
+        written = []
+        for path, (data, futures) in pending.items():
+            temp_path = f"{path}.tmp"
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                written.append((path, temp_path, futures))
+            except Exception as e:
+                self._fail(path, futures, e)
+
+        committed = []
+        for path, temp_path, futures in written:
+            try:
+                if self.fsync:
+                    fd = os.open(temp_path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                os.replace(temp_path, path)
+                committed.append((path, futures))
+            except Exception as e:
+                self._fail(path, futures, e)
+
+        if self.fsync and os.name != "nt":
+            for directory in {os.path.dirname(path) for path, _ in committed}:
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    self._record_error(directory, e)
+
+        for _, futures in committed:
+            for future in futures:
+                _resolve_future(future, True)
+
+    def _fail(self, path: str, futures: List[concurrent.futures.Future], error: Exception):
+        self._record_error(path, error)
+        for future in futures:
+            _reject_future(future, error)
+
+    def _record_error(self, path: str, error: Exception):
+        self.last_error = (time.time(), path, str(error))
+        storage_logger.error("文件操作失败: %s", error, extra={"path": path})
+
+_io_executor: Optional[FileIOExecutor] = None
+_io_executor_pid: Optional[int] = None
+_io_settings = {"lanes": 4, "fsync": True}
+
+def configure_io_executor(lanes: int, fsync: bool):
+    """设置 I/O 线程数与是否 fsync，之前提交的操作先完成再切换"""
+    global _io_executor
+    _io_settings.update(lanes=lanes, fsync=fsync)
+    if _io_executor is not None and _io_executor_pid == os.getpid():
+        _io_executor.flush()
+    _io_executor = None
+
+def get_io_executor() -> FileIOExecutor:
+    """获取当前进程的 I/O 执行器（fork 出的分片进程会重新创建线程）"""
+    global _io_executor, _io_executor_pid
+    if _io_executor is None or _io_executor_pid != os.getpid():
+        _io_executor = FileIOExecutor(_io_settings["lanes"], _io_settings["fsync"])
+        _io_executor_pid = os.getpid()
+    return _io_executor
+
 # ==================== 消息发送工具类 ====================
 class MessageSender:
     """消息发送工具类，封装正确的API调用方式"""
     
+    # 设置为列表后消息只写入该列表（分片进程中由主进程统一转发）
+    outbox: Optional[List[Tuple[str, str, str]]] = None
+    
     @staticmethod
     async def send_private_message(user_id: str, message: str) -> bool:
         """发送私聊消息"""
+        if MessageSender.outbox is not None:
+            MessageSender.outbox.append(("private", user_id, message))
+            return True
+        
         try:
             # 获取用户的私聊流
             stream = chat_api.get_stream_by_user_id(user_id, "qq")
             if not stream:
-                print(f"❌ 未找到用户 {user_id} 的私聊流")
+                message_logger.warning("未找到私聊流", extra={"user": user_id})
                 return False
             
             # 使用正确的API发送消息
+            start = time.perf_counter()
             success = await send_api.text_to_stream(
                 text=message,
                 stream_id=stream.stream_id,
                 storage_message=True
             )
+            latency_ms = round((time.perf_counter() - start) * 1000, 1)
             
             if success:
-                print(f"✅ 私聊消息发送成功: {user_id}")
+                message_logger.debug("私聊消息发送成功", extra={"user": user_id, "latency_ms": latency_ms})
             else:
-                print(f"❌ 私聊消息发送失败: {user_id}")
+                message_logger.warning("私聊消息发送失败", extra={"user": user_id, "latency_ms": latency_ms})
             
             return success
             
         except Exception as e:
-            print(f"❌ 发送私聊消息异常: {e}")
+            message_logger.error("发送私聊消息异常: %s", e, extra={"user": user_id})
             return False
     
     @staticmethod
     async def send_group_message(group_id: str, message: str) -> bool:
         """发送群聊消息"""
+        if MessageSender.outbox is not None:
+            MessageSender.outbox.append(("group", group_id, message))
+            return True
+        
         try:
             # 获取群聊流
             stream = chat_api.get_stream_by_group_id(group_id, "qq")
             if not stream:
-                print(f"❌ 未找到群组 {group_id} 的聊天流")
+                message_logger.warning("未找到群聊流", extra={"group": group_id})
                 return False
             
             # 使用正确的API发送消息
+            start = time.perf_counter()
             success = await send_api.text_to_stream(
                 text=message,
                 stream_id=stream.stream_id,
                 storage_message=True
             )
+            latency_ms = round((time.perf_counter() - start) * 1000, 1)
             
             if success:
-                print(f"✅ 群聊消息发送成功: {group_id}")
+                message_logger.debug("群聊消息发送成功", extra={"group": group_id, "latency_ms": latency_ms})
             else:
-                print(f"❌ 群聊消息发送失败: {group_id}")
+                message_logger.warning("群聊消息发送失败", extra={"group": group_id, "latency_ms": latency_ms})
             
             return success
             
         except Exception as e:
-            print(f"❌ 发送群聊消息异常: {e}")
+            message_logger.error("发送群聊消息异常: %s", e, extra={"group": group_id})
+            return False
+
+# ==================== 事件总线 ====================
+class GameEventType(Enum):
+    PHASE_CHANGE = "phase_change"
+    ACTION_SUBMITTED = "action_submitted"
+    DEATH = "death"
+    VOTE = "vote"
+    GAME_END = "game_end"
+
+class GameEvent(NamedTuple):
+    type: GameEventType
+    room_id: str
+    data: Dict[str, Any]
+    timestamp: float
+    seq: int = 0
+
+# 订阅者队列满时的处理策略
+EVENT_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+class EventSubscription:
+    """一个订阅者：独立的有界队列和消费任务，处理慢只会积压或丢弃自己的事件"""
+
+    def __init__(self, name: str, handler, event_types: Optional[Set[GameEventType]],
+                 maxsize: int, policy: str, block_timeout: float):
+        if policy not in EVENT_POLICIES:
+            raise ValueError(f"未知的队列策略: {policy}")
+        self.name = name
+        self.handler = handler
+        self.event_types = event_types
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        # block 策略下队列满时暂存的事件，由发布方在安全点等待写入
+        self.backlog: deque = deque()
+        self.delivered = 0
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def offer(self, event: GameEvent) -> bool:
+        """非阻塞投递，返回 False 表示产生了需要发布方等待的积压"""
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        if self.backlog:
+            self.backlog.append(event)
+            return False
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.policy == "drop_oldest":
+            self.queue.get_nowait()
+            self.queue.put_nowait(event)
+            self.dropped += 1
+        elif self.policy == "drop_newest":
+            self.dropped += 1
+        else:
+            self.backlog.append(event)
             return False
+        return True
+
+    async def drain_backlog(self):
+        """把积压事件写入队列，最多等待 block_timeout 秒，超时的部分丢弃"""
+        deadline = time.monotonic() + self.block_timeout
+        while self.backlog:
+            try:
+                await asyncio.wait_for(self.queue.put(self.backlog[0]),
+                                       max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                self.dropped += len(self.backlog)
+                self.backlog.clear()
+                return
+            self.backlog.popleft()
+
+    async def _run(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                result = self.handler(event)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                events_logger.exception("事件订阅者 %s 处理 %s 失败: %s", self.name, event.type.value, e,
+                                        extra={"room": event.room_id})
+            self.delivered += 1
+
+class EventBus:
+    """进程内游戏事件总线
+
+    publish 是同步且不阻塞的，可以在游戏逻辑中任意位置调用；没有订阅者时几乎没有开销。
+    只有 block 策略的订阅者队列满时，发布方才会在命令处理结束后（回复已发出）
+    调用 relieve_backpressure 等待，且等待时间有上限。
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.subscriptions = {}
+            cls._instance.seq = 0
+            cls._instance.pressured = False
+            # 非 None 时事件只记录到列表（分片进程把事件带回主进程再发布）
+            cls._instance.capture = None
+        return cls._instance
+
+    @property
+    def active(self) -> bool:
+        return bool(self.subscriptions) or self.capture is not None
+
+    def subscribe(self, name: str, handler, event_types: Optional[Set[GameEventType]] = None,
+                  maxsize: int = 256, policy: str = "drop_oldest", block_timeout: float = 1.0) -> EventSubscription:
+        """注册订阅者，handler 可以是普通函数或协程函数；同名订阅会被替换"""
+        self.unsubscribe(name)
+        subscription = EventSubscription(name, handler, event_types, maxsize, policy, block_timeout)
+        self.subscriptions[name] = subscription
+        return subscription
+
+    def unsubscribe(self, name: str):
+        subscription = self.subscriptions.pop(name, None)
+        if subscription and subscription.task:
+            subscription.task.cancel()
+
+    def publish(self, event_type: GameEventType, room_id: str, **data):
+        """发布事件"""
+        if not self.active:
+            return
+        self.publish_event(GameEvent(event_type, room_id, data, time.time()))
+
+    def publish_event(self, event: GameEvent):
+        """发布已构造的事件（分片转发的事件保留原时间戳）"""
+        if self.capture is not None:
+            self.capture.append((event.type.value, event.room_id, event.data, event.timestamp))
+            return
+        self.seq += 1
+        event = event._replace(seq=self.seq)
+        for subscription in list(self.subscriptions.values()):
+            if subscription.event_types is None or event.type in subscription.event_types:
+                if not subscription.offer(event):
+                    self.pressured = True
+
+    async def relieve_backpressure(self):
+        """等待 block 策略订阅者消化积压"""
+        if not self.pressured:
+            return
+        self.pressured = False
+        for subscription in list(self.subscriptions.values()):
+            if subscription.backlog:
+                await subscription.drain_backlog()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """各订阅者的队列深度、积压、已处理与丢弃数"""
+        return {name: {"queued": sub.queue.qsize(), "backlog": len(sub.backlog), "policy": sub.policy,
+                       "delivered": sub.delivered, "dropped": sub.dropped}
+                for name, sub in self.subscriptions.items()}
+
+# ==================== 观战 ====================
+SPECTATOR_PHASE_TEXT = {
+    GamePhase.NIGHT.value: "🌙 第 {day_count} 夜开始",
+    GamePhase.WITCH_SAVE_PHASE.value: "💊 女巫正在决定是否使用解药",
+    GamePhase.DAY.value: "☀️ 第 {day_count} 天白天，开始投票",
+    GamePhase.HUNTER_REVENGE.value: "🔫 猎人正在决定开枪目标",
+    GamePhase.ENDED.value: "🏁 游戏结束"
+}
+
+SPECTATOR_WINNER_TEXT = {
+    Camp.VILLAGE.value: "🏠 村庄阵营",
+    Camp.WOLF.value: "🐺 狼人阵营",
+    Camp.THIRD_PARTY.value: "🎭 第三方阵营",
+    Camp.LOVER.value: "💕 情侣",
+    "inactive": "无（长时间无操作）"
+}
+
+SPECTATOR_DEATH_TEXT = {
+    DeathReason.WOLF_KILL.value: "夜晚死亡",
+    DeathReason.POISON.value: "夜晚死亡",
+    DeathReason.SKILL.value: "夜晚死亡",
+    DeathReason.VOTE.value: "被投票放逐",
+    DeathReason.HUNTER_SHOOT.value: "被猎人带走",
+    DeathReason.WHITE_WOLF.value: "被白狼王带走",
+    DeathReason.LOVER_SUICIDE.value: "殉情",
+    DeathReason.SUICIDE.value: "自杀"
+}
+
+def render_spectator_event(event: GameEvent, reveal_roles: bool) -> Optional[str]:
+    """把事件渲染成观战文本；不公开身份时隐藏身份和夜晚行动，返回 None 表示不展示"""
+    data = event.data
+    if event.type == GameEventType.PHASE_CHANGE:
+        text = SPECTATOR_PHASE_TEXT.get(data["phase"])
+        return text.format(day_count=data["day_count"]) if text else None
+    if event.type == GameEventType.DEATH:
+        text = f"💀 {data['number']}号 {data['name']} {SPECTATOR_DEATH_TEXT.get(data['reason'], '出局')}"
+        if reveal_roles and data["role"] in ROLES:
+            text += f"（{ROLES[data['role']]['name']}）"
+        return text
+    if event.type == GameEventType.VOTE:
+        return f"🗳️ {data['voter_number']}号 投票给 {data['target_number']}号"
+    if event.type == GameEventType.ACTION_SUBMITTED:
+        if not reveal_roles:
+            return None
+        role_name = ROLES[data["role"]]["name"] if data["role"] in ROLES else data["role"]
+        return f"🎯 {role_name}({data['number']}号) {data['action']} {data['args']}".rstrip()
+    if event.type == GameEventType.GAME_END:
+        # 对局已结束，身份总是公开
+        roles = "、".join(f"{number}号{ROLES[role]['name'] if role in ROLES else role}"
+                         for number, role in sorted(data["roles"].items(), key=lambda item: int(item[0])))
+        return f"🏆 胜方: {SPECTATOR_WINNER_TEXT.get(data['winner'], data['winner'])}\n🎭 身份: {roles}"
+    return None
+
+class SpectatorHub:
+    """观战：订阅事件总线，按房间缓存事件，延迟后按周期批量推送
+
+    每个周期每个房间只渲染一次，同一段文本发给该房间的所有观战者。
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.watchers = {}  # 房间号 -> 观战者QQ集合
+            cls._instance.watching = {}  # 观战者QQ -> 房间号
+            cls._instance.pending = {}  # 房间号 -> deque[GameEvent]，等待延迟结束
+            cls._instance.out_players = {}  # 房间号 -> 已出局玩家，出局者才能观战本房间
+            cls._instance.delay = 30.0
+            cls._instance.reveal_roles = False
+            cls._instance.task = None
+        return cls._instance
+
+    def start(self, delay: float, interval: float, reveal_roles: bool):
+        self.delay = delay
+        self.reveal_roles = reveal_roles
+        EventBus().subscribe("spectators", self._on_event, maxsize=4096)
+        self.task = asyncio.create_task(self._run(interval))
+
+    def stop(self):
+        EventBus().unsubscribe("spectators")
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def watch(self, qq: str, room_id: str):
+        self.unwatch(qq)
+        self.watchers.setdefault(room_id, set()).add(qq)
+        self.watching[qq] = room_id
+
+    def unwatch(self, qq: str) -> Optional[str]:
+        room_id = self.watching.pop(qq, None)
+        if room_id is not None:
+            self.watchers[room_id].discard(qq)
+            if not self.watchers[room_id]:
+                del self.watchers[room_id]
+                self.pending.pop(room_id, None)
+        return room_id
+
+    async def prune(self, live_rooms):
+        """房间被销毁（没有结束事件）时通知并移除观战者"""
+        for room_id in list(self.watchers.keys()):
+            if room_id in live_rooms or room_id in self.pending:
+                continue
+            spectators = list(self.watchers[room_id])
+            for qq in spectators:
+                self.unwatch(qq)
+            self.out_players.pop(room_id, None)
+            await asyncio.gather(*(MessageSender.send_private_message(qq, f"📴 房间 {room_id} 已关闭，观战结束")
+                                   for qq in spectators))
+
+    def export_state(self) -> Dict[str, Any]:
+        """导出观战者和尚未推送的事件（插件重载前调用，订阅队列中未处理的事件一并导出）"""
+        subscription = EventBus().subscriptions.get("spectators")
+        if subscription:
+            while not subscription.queue.empty():
+                self._on_event(subscription.queue.get_nowait())
+        return {
+            "watchers": {room_id: sorted(qqs) for room_id, qqs in self.watchers.items()},
+            "out_players": {room_id: sorted(qqs) for room_id, qqs in self.out_players.items()},
+            "pending": [(event.type.value, event.room_id, event.data, event.timestamp)
+                        for events in self.pending.values() for event in events]
+        }
+
+    def clear(self):
+        """清空观战者与待推送事件（已由 export_state 交接出去后调用）"""
+        self.watchers.clear()
+        self.watching.clear()
+        self.out_players.clear()
+        self.pending.clear()
+
+    def restore_state(self, state: Dict[str, Any]):
+        """恢复 export_state 导出的内容，待推送事件保留原时间戳，延迟照常计算"""
+        for room_id, qqs in state.get("watchers", {}).items():
+            for qq in qqs:
+                self.watch(qq, room_id)
+        for room_id, qqs in state.get("out_players", {}).items():
+            self.out_players.setdefault(room_id, set()).update(qqs)
+        for event_type, room_id, data, timestamp in state.get("pending", []):
+            self.pending.setdefault(room_id, deque()).append(
+                GameEvent(GameEventType(event_type), room_id, data, timestamp))
+
+    def _on_event(self, event: GameEvent):
+        if event.type == GameEventType.DEATH:
+            self.out_players.setdefault(event.room_id, set()).add(event.data["player"])
+        elif event.type == GameEventType.GAME_END:
+            self.out_players.pop(event.room_id, None)
+        # 只缓存有人观战的房间
+        if event.room_id in self.watchers:
+            self.pending.setdefault(event.room_id, deque()).append(event)
+
+    async def _run(self, interval: float):
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                spectator_logger.exception("观战推送错误: %s", e)
+
+    async def flush(self, now: Optional[float] = None):
+        """推送所有已过延迟的事件"""
+        due_before = (now if now is not None else time.time()) - self.delay
+        for room_id in list(self.pending.keys()):
+            events = self.pending[room_id]
+            lines = []
+            ended = False
+            while events and events[0].timestamp <= due_before:
+                event = events.popleft()
+                ended = ended or event.type == GameEventType.GAME_END
+                text = render_spectator_event(event, self.reveal_roles)
+                if text:
+                    lines.append(text)
+            if not events:
+                del self.pending[room_id]
+            if not lines:
+                continue
+
+            message = f"👀 观战 {room_id}（延迟{self.delay:.0f}秒）\n" + "\n".join(lines)
+            spectators = list(self.watchers.get(room_id, ()))
+            if ended:
+                message += "\n📴 观战已结束"
+                for qq in spectators:
+                    self.unwatch(qq)
+            await asyncio.gather(*(MessageSender.send_private_message(qq, message) for qq in spectators))
+
+# ==================== 准入控制 ====================
+class AdmissionControl:
+    """命令准入：按用户令牌桶限流、按全局/群限制同时存在的房间数，并统计被拒绝的负载
+
+    在命令处理最前面检查，被拒绝的命令不会做任何房间查找、渲染或写盘。
+    分片模式下只在主进程检查。
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.rate = 0.0  # 每秒补充的令牌数，0 为不限流
+            cls._instance.burst = 1.0
+            cls._instance.max_rooms = 0
+            cls._instance.max_rooms_per_group = 0
+            cls._instance.buckets = {}  # QQ号 -> [令牌数, 上次补充时间, 本轮是否已提示]
+            cls._instance.shed = {"rate_limited": 0, "room_cap": 0, "group_room_cap": 0}
+        return cls._instance
+
+    def configure(self, per_minute: float, burst: int, max_rooms: int, max_rooms_per_group: int):
+        self.rate = max(0.0, per_minute) / 60
+        self.burst = float(max(1, burst))
+        self.max_rooms = max(0, max_rooms)
+        self.max_rooms_per_group = max(0, max_rooms_per_group)
+        self.buckets.clear()
+
+    def allow_command(self, user_id: str) -> Tuple[bool, bool]:
+        """消耗一个令牌，返回 (是否放行, 是否需要提示)；同一轮限流只提示一次，避免提示本身刷屏"""
+        if self.rate <= 0:
+            return True, False
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            self.buckets[user_id] = [self.burst - 1, now, False]
+            return True, False
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            bucket[2] = False
+            return True, False
+
+        bucket[0] = tokens
+        notify = not bucket[2]
+        bucket[2] = True
+        return False, notify
+
+    def prune(self):
+        """移除已回满的令牌桶，与新用户等价"""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        for user_id, (tokens, last, _) in list(self.buckets.items()):
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self.buckets[user_id]
+
+    def room_rejection(self, game_manager: "WerewolfGameManager", group_id: str) -> Optional[str]:
+        """检查能否再建一个房间，超出上限时返回提示文本"""
+        if game_manager.draining:
+            return "🔧 插件正在重载，暂不接受新建房间，请稍后再试"
+        if not self.max_rooms and not self.max_rooms_per_group:
+            return None
+        group_id = str(group_id)
+        router = ShardRouter.get_active()
+        if router:
+            total = len(router.room_members)
+            in_group = sum(1 for room_group in router.room_groups.values() if room_group == group_id)
+        else:
+            total = len(game_manager.games) + len(game_manager.paged_rooms)
+            in_group = sum(1 for game in game_manager.games.values() if game.get("group_id") == group_id)
+            in_group += sum(1 for stub in game_manager.paged_rooms.values() if stub.group_id == group_id)
+
+        if self.max_rooms and total >= self.max_rooms:
+            self.shed["room_cap"] += 1
+            return f"❌ 当前进行中的房间已达上限（{self.max_rooms}个），请稍后再试"
+        if self.max_rooms_per_group and in_group >= self.max_rooms_per_group:
+            self.shed["group_room_cap"] += 1
+            return f"❌ 本群进行中的房间已达上限（{self.max_rooms_per_group}个），请先完成或销毁已有房间"
+        return None
+
+# ==================== 命令去重 ====================
+class CommandDedupeCache:
+    """短时去重缓存：记录每名玩家最近一次成功的游戏内行动及其回复
+
+    同一玩家在同一房间、同一阶段内重复提交完全相同的行动（平台重试或重复发送）时，
+    直接重发上次的回复，不再校验、修改状态或写盘。每名玩家只保留最近一条，
+    因此 "kill 3 -> kill 4 -> kill 3" 中的第三条不会被误判为重复。
+    键中含行动完成后的房间状态版本，其他人（如同阵营狼人改选目标）修改过房间后不再视为重复。
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.ttl = 30.0
+            cls._instance.entries = {}  # QQ号 -> (键, 过期时间, 回复列表, 命令结果)，按写入顺序排列
+            cls._instance.hits = 0
+        return cls._instance
+
+    def get(self, user_id: str, key: Tuple) -> Optional[Tuple[List[str], Tuple[bool, Optional[str], bool]]]:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] != key or entry[1] < time.monotonic():
+            return None
+        self.hits += 1
+        return entry[2], entry[3]
+
+    def put(self, user_id: str, key: Tuple, replies: List[str], result: Tuple[bool, Optional[str], bool]):
+        if self.ttl <= 0:
+            return
+        now = time.monotonic()
+        self.entries.pop(user_id, None)
+        self.entries[user_id] = (key, now + self.ttl, replies, result)
+        # 按写入顺序排列，过期时间单调递增，只需从头部清理
+        for stale_user in list(self.entries):
+            if self.entries[stale_user][1] >= now:
+                break
+            del self.entries[stale_user]
+
+# ==================== 命令录制 ====================
+class CommandTraceRecorder:
+    """把每条 /wwg 命令（用户、群、文本、时间、耗时，开局命令附随机种子）追加写入 NDJSON 轨迹文件
+
+    与日志相同，记录经队列交给后台线程写出；轨迹可用命令行工具 replay 回放。
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.path = None
+            cls._instance._listener = None
+            # 独立于 werewolf 日志树，只输出 JSON 行
+            cls._instance.logger = logging.getLogger("werewolf_trace")
+            cls._instance.logger.propagate = False
+            cls._instance.logger.setLevel(logging.INFO)
+        return cls._instance
+
+    @property
+    def enabled(self) -> bool:
+        return self._listener is not None
+
+    def start(self, directory: str):
+        """开始录制到 directory 下的新文件"""
+        if self.enabled:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"trace-{datetime.datetime.now():%Y%m%d-%H%M%S}.ndjson")
+        target = logging.FileHandler(self.path, encoding="utf-8")
+        target.setFormatter(logging.Formatter("%(message)s"))
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self._listener = logging.handlers.QueueListener(log_queue, target)
+        self._listener.start()
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+
+    def record(self, entry: Dict[str, Any]):
+        if self.enabled:
+            self.logger.info(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+
+def load_command_trace(path: str) -> List[Dict[str, Any]]:
+    """读取轨迹文件，按时间排序"""
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+# ==================== 匹配队列 ====================
+class MatchmakingLobby:
+    """按群排队匹配
+
+    每个群一个 deque 保存 (票号, QQ)；tickets 索引记录每名玩家当前有效的票号。
+    离队只删除索引，出队时跳过票号失效的条目，入队/离队/出队均为 O(1) 均摊。
+    """
+
+    def __init__(self):
+        self.queues: Dict[str, deque] = {}
+        self.tickets: Dict[str, Tuple[str, int, str, float]] = {}  # QQ -> (群号, 票号, 昵称, 入队时间)
+        self.counts: Dict[str, int] = {}
+        self._next_ticket = 0
+
+    def enqueue(self, qq: str, group_id: str, name: str) -> int:
+        """加入队列，返回该群当前排队人数"""
+        self._next_ticket += 1
+        self.tickets[qq] = (group_id, self._next_ticket, name, time.time())
+        self.queues.setdefault(group_id, deque()).append((self._next_ticket, qq))
+        self.counts[group_id] = self.counts.get(group_id, 0) + 1
+        return self.counts[group_id]
+
+    def remove(self, qq: str) -> Optional[str]:
+        """离开队列，返回原所在群号"""
+        ticket = self.tickets.pop(qq, None)
+        if ticket is None:
+            return None
+        group_id = ticket[0]
+        self.counts[group_id] -= 1
+        # 失效条目过多时整理一次，避免反复进出队让 deque 无限增长
+        group_queue = self.queues[group_id]
+        if len(group_queue) > 2 * self.counts[group_id] + 32:
+            self.queues[group_id] = deque(entry for entry in group_queue if self._is_live(entry))
+        return group_id
+
+    def _is_live(self, entry: Tuple[int, str]) -> bool:
+        ticket = self.tickets.get(entry[1])
+        return ticket is not None and ticket[1] == entry[0]
+
+    def waiting(self, group_id: str) -> int:
+        return self.counts.get(group_id, 0)
+
+    def _front(self, group_id: str) -> Optional[Tuple[int, str]]:
+        """丢弃队首失效条目后返回队首"""
+        group_queue = self.queues.get(group_id)
+        while group_queue and not self._is_live(group_queue[0]):
+            group_queue.popleft()
+        return group_queue[0] if group_queue else None
+
+    def oldest_wait(self, group_id: str) -> float:
+        """队首玩家已等待的秒数"""
+        front = self._front(group_id)
+        return time.time() - self.tickets[front[1]][3] if front else 0.0
+
+    def take(self, group_id: str, count: int, skip=None) -> List[Tuple[str, str, float]]:
+        """按入队顺序取出至多 count 名玩家 (QQ, 昵称, 入队时间)，skip(QQ) 为真的玩家直接移出队列"""
+        players = []
+        while len(players) < count and self._front(group_id):
+            _, qq = self.queues[group_id].popleft()
+            _, _, name, joined_time = self.tickets[qq]
+            self.remove(qq)
+            if skip is None or not skip(qq):
+                players.append((qq, name, joined_time))
+        return players
+
+    def export(self) -> Dict[str, List[Tuple[str, str, float]]]:
+        """按入队顺序导出各群排队中的玩家 (QQ, 昵称, 入队时间)，不改变队列"""
+        exported = {}
+        for group_id, group_queue in self.queues.items():
+            players = [(entry[1], self.tickets[entry[1]][2], self.tickets[entry[1]][3])
+                       for entry in group_queue if self._is_live(entry)]
+            if players:
+                exported[group_id] = players
+        return exported
+
+    def restore(self, group_id: str, players: List[Tuple[str, str, float]]):
+        """把 take 取出但未能成局的玩家按原顺序放回队首（已在队列中的玩家跳过）"""
+        group_queue = self.queues.setdefault(group_id, deque())
+        for qq, name, joined_time in reversed(players):
+            if qq in self.tickets:
+                continue
+            self._next_ticket += 1
+            self.tickets[qq] = (group_id, self._next_ticket, name, joined_time)
+            group_queue.appendleft((self._next_ticket, qq))
+            self.counts[group_id] = self.counts.get(group_id, 0) + 1
+
+def allocate_room_id(taken) -> str:
+    """生成不与 taken 中已有房间冲突的房间号（同一秒内批量建房时会用到随机号）"""
+    room_id = generate_room_id()
+    while room_id in taken:
+        room_id = f"WWG{random.randint(0, 999999):06d}"
+    return room_id
+
+async def form_lobby_rooms(game_manager: "WerewolfGameManager", group_id: str, room_size: int,
+                           min_size: Optional[int] = None, room_id_hints: Optional[List[str]] = None) -> List[str]:
+    """排队人数达到 room_size 时自动建房；给定 min_size 时把不少于 min_size 的剩余玩家也组成一局
+
+    已在其他房间中的玩家出队时会被跳过。返回新建的房间号。
+    room_id_hints 为回放轨迹时按顺序沿用的录制时房间号。
+    """
+    room_id_hints = list(room_id_hints or [])
+    lobby = game_manager.lobby
+    router = ShardRouter.get_active()
+
+    def in_game(qq: str) -> bool:
+        if router:
+            return qq in router.user_rooms
+        return any(qq in game["players"] and game["phase"] != GamePhase.ENDED.value
+                   for game in game_manager.games.values()) or \
+            any(qq in stub.members and stub.phase != GamePhase.ENDED.value
+                for stub in game_manager.paged_rooms.values())
+
+    formed = []
+    while True:
+        waiting = lobby.waiting(group_id)
+        if waiting >= room_size:
+            size = room_size
+        elif min_size is not None and waiting >= min_size:
+            size = waiting
+        else:
+            break
+
+        # 房间数已达上限时继续排队，等有房间结束后由清理循环再次尝试
+        if AdmissionControl().room_rejection(game_manager, group_id):
+            break
+
+        # 排队期间已进入其他房间的玩家在出队时剔除，人数不足则放回等待
+        players = lobby.take(group_id, size, skip=in_game)
+        if len(players) < size:
+            lobby.restore(group_id, players)
+            continue
+
+        members = [(qq, name) for qq, name, _ in players]
+        taken = router.room_members if router else game_manager.room_ids()
+        room_id = room_id_hints.pop(0) if room_id_hints else None
+        if room_id is None or room_id in taken:
+            room_id = allocate_room_id(taken)
+        if router:
+            await router.form_room(room_id, group_id, members)
+        else:
+            game_manager.create_lobby_room(room_id, group_id, members)
+
+        preset = ROLE_PRESETS[size]
+        await MessageSender.send_group_message(group_id, (
+            f"🎮 匹配成功！已自动创建房间 {room_id}（{size}人）\n"
+            f"🎭 角色配置: " + "、".join(f"{ROLES[role]['name']}×{count}" for role, count in preset.items()) + "\n"
+            f"👥 玩家: " + "、".join(f"{index}号 {name}" for index, (_, name) in enumerate(members, 1)) + "\n"
+            f"👤 房主 {members[0][1]} 使用 /wwg start 开始游戏"
+        ))
+        formed.append(room_id)
+    return formed
 
 # ==================== 游戏管理器 ====================
+class RoomStub(NamedTuple):
+    """被换出内存的房间：只保留查找玩家和超时清理所需的字段，完整状态在 games/{房间号}.json"""
+    room_id: str
+    group_id: str
+    phase: str
+    members: frozenset
+    deadline: float  # 超过该时间仍未换入则按不活跃归档
+
+class RoomReadSnapshot(NamedTuple):
+    """房间的只读快照：每次保存房间时整体替换，只读命令读取它而不碰正在修改的房间"""
+    version: int  # 对应的 state_version
+    room_id: str
+    host: str
+    host_name: str  # 房主在房间内的昵称，与玩家列表一致，随房间版本更新
+    phase: str
+    player_count: int
+    players: Tuple[Tuple[int, str, str], ...]  # (号码, 昵称, 状态)
+    roles: Tuple[Tuple[str, int], ...]  # (角色, 数量)
+
 class WerewolfGameManager:
     _instance = None
     
@@ -255,12 +2559,28 @@ class WerewolfGameManager:
             cls._instance.games = {}
             cls._instance.player_profiles = {}
             cls._instance.last_activity = {}
+            cls._instance.render_cache = {}
+            cls._instance.read_snapshots = {}  # 房间号 -> RoomReadSnapshot，换出后仍保留，状态查询无需换入
+            cls._instance.profile_snapshots = {}  # QQ -> 最近一次保存的档案编码，档案查询读取它
+            cls._instance.leaderboards = {}  # 作用域 -> {指标: Leaderboard}，首次查询时构建
+            cls._instance.role_balance = RoleBalanceStats()  # 首次查询时补读已有归档
+            cls._instance.camp_records = {}  # 阵营 -> 历史胜负次数，用于评分的阵营修正
+            cls._instance.lobby = MatchmakingLobby()
+            cls._instance.observed_state = {}  # 房间号 -> (阶段, 出局玩家)，用于发布阶段变化和死亡事件
+            cls._instance.paged_rooms = {}  # 房间号 -> RoomStub，空闲后换出到磁盘的房间
+            cls._instance.last_access = {}  # 房间号 -> 最近一次有命令访问的时间，换出时跳过刚访问过的房间
+            cls._instance.paging_stats = {"paged_out": 0, "paged_in": 0}
+            cls._instance.draining = False  # 插件重载前排空，不再接受新建房间
+            cls._instance.last_archive_seq = 0  # 最近分配的归档序号
+            cls._instance.defer_profile_saves = False  # 分片进程中为 True：档案只记为待保存，由主进程写文件
+            cls._instance.unsaved_profiles = set()
             cls._instance._load_profiles()
+            cls._instance._load_camp_records()
         return cls._instance
     
     def _load_profiles(self):
         """加载玩家档案"""
-        profiles_dir = os.path.join(os.path.dirname(__file__), "users")
+        profiles_dir = os.path.join(DATA_DIR, "users")
         os.makedirs(profiles_dir, exist_ok=True)
         
         for filename in os.listdir(profiles_dir):
@@ -270,40 +2590,78 @@ class WerewolfGameManager:
                     with open(file_path, 'r', encoding='utf-8') as f:
                         profile = json.load(f)
                         qq = filename[:-5]  # 去掉.json后缀
-                        self.player_profiles[qq] = profile
+                        # v1 档案在内存中迁移，下次保存时写回 v2 格式
+                        self.player_profiles[qq] = migrate_profile(profile)
                 except Exception as e:
-                    print(f"加载玩家档案 {filename} 失败: {e}")
+                    storage_logger.warning("加载玩家档案 %s 失败: %s", filename, e)
     
     def _save_profile(self, qq: str):
         """保存玩家档案"""
         if qq not in self.player_profiles:
             return
+        if self.defer_profile_saves:
+            # 档案文件只由主进程写，避免两个进程的 I/O 线程交错覆盖同一文件
+            self.unsaved_profiles.add(qq)
+            return
         
-        profiles_dir = os.path.join(os.path.dirname(__file__), "users")
-        os.makedirs(profiles_dir, exist_ok=True)
-        
-        file_path = os.path.join(profiles_dir, f"{qq}.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(self.player_profiles[qq], f, ensure_ascii=False, indent=2)
+        # 在调用线程序列化，落盘交给 I/O 线程
+        file_path = os.path.join(DATA_DIR, "users", f"{qq}.json")
+        data = json.dumps(self.player_profiles[qq], ensure_ascii=False, indent=2).encode("utf-8")
+        # 编码后的字节不可变，直接作为只读快照发布
+        self.profile_snapshots[qq] = data
+        get_io_executor().write(file_path, data)
+    
+    def get_profile_snapshot(self, qq: str) -> Optional[Dict[str, Any]]:
+        """读取档案的只读副本（最近一次保存的版本），从未保存过的档案退回读取内存中的档案"""
+        data = self.profile_snapshots.get(qq)
+        if data is not None:
+            return json.loads(data)
+        return self.player_profiles.get(qq)
+    
+    def _load_camp_records(self):
+        """加载评分用的阵营胜负记录"""
+        file_path = os.path.join(DATA_DIR, "ratings.json")
+        if not os.path.exists(file_path):
+            return
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                self.camp_records = json.load(f).get("camps", {})
+        except Exception as e:
+            storage_logger.warning("加载评分记录失败: %s", e)
+    
+    def _save_camp_records(self):
+        """保存评分用的阵营胜负记录"""
+        data = json.dumps({"camps": self.camp_records}, ensure_ascii=False, indent=2).encode("utf-8")
+        get_io_executor().write(os.path.join(DATA_DIR, "ratings.json"), data)
     
     def get_or_create_profile(self, qq: str, name: str) -> Dict[str, Any]:
         """获取或创建玩家档案"""
         if qq not in self.player_profiles:
-            self.player_profiles[qq] = {
-                "qq": qq,
-                "name": name,  # 使用传入的名称
-                "total_games": 0,
-                "wins": 0,
-                "losses": 0,
-                "kills": 0,
-                "votes": 0,
-                "recent_win_rate": 0,
-                "recent_games": [],
-                "created_time": datetime.datetime.now().isoformat()
-            }
+            self.player_profiles[qq] = new_profile(qq, name)
             self._save_profile(qq)
         return self.player_profiles[qq]
     
+    def get_leaderboard(self, metric: str, scope: str, k: int, min_games: int) -> List[str]:
+        """查询榜单前 K 名，榜单不存在或缓冲区不足时才全量构建"""
+        boards = self.leaderboards.setdefault(scope, {})
+        board = boards.get(metric)
+        if board is None or board.k != k or board.min_games != min_games:
+            board = boards[metric] = Leaderboard(metric, k, min_games)
+            board.complete = False
+        if not board.is_ready():
+            board.rebuild((qq, get_rank_counter(profile, scope))
+                          for qq, profile in self.player_profiles.items())
+        return board.top()
+    
+    def update_leaderboards(self, qq: str):
+        """玩家战绩变化后增量更新已构建的榜单（全服及其参与过的群）"""
+        profile = self.player_profiles.get(qq)
+        if not profile:
+            return
+        for scope in [RANK_GLOBAL_SCOPE, *profile.get("group_stats", {})]:
+            for board in self.leaderboards.get(scope, {}).values():
+                board.update(qq, board.score(get_rank_counter(profile, scope)))
+    
     def create_game(self, room_id: str, host_qq: str, group_id: str, host_name: str) -> Dict[str, Any]:
         """创建新游戏并自动加入房主"""
         game = {
@@ -355,6 +2713,7 @@ class WerewolfGameManager:
             "winner": None,
             "game_code": None,
             "phase_start_time": time.time(),
+            "state_version": 0,  # 房间状态版本，每次保存递增，用于渲染缓存失效
             "saved_players": set()  # 新增：被女巫解药拯救的玩家
         }
         
@@ -381,6 +2740,17 @@ class WerewolfGameManager:
         self._save_game_file(room_id)
         return game
     
+    def create_lobby_room(self, room_id: str, group_id: str, players: List[Tuple[str, str]]) -> Dict[str, Any]:
+        """用匹配队列取出的玩家建房，首位玩家为房主，按人数套用预设角色配置"""
+        host_qq, host_name = players[0]
+        game = self.create_game(room_id, host_qq, group_id, host_name)
+        game["settings"]["player_count"] = len(players)
+        game["settings"]["roles"] = {**{role: 0 for role in game["settings"]["roles"]}, **ROLE_PRESETS[len(players)]}
+        for player_qq, player_name in players[1:]:
+            self.join_game(room_id, player_qq, player_name)
+        self._save_game_file(room_id)
+        return game
+    
     def join_game(self, room_id: str, player_qq: str, player_name: str) -> bool:
         """玩家加入游戏"""
         if room_id not in self.games:
@@ -422,23 +2792,21 @@ class WerewolfGameManager:
             return False
         
         # 删除游戏文件
-        games_dir = os.path.join(os.path.dirname(__file__), "games")
-        file_path = os.path.join(games_dir, f"{room_id}.json")
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"删除游戏文件失败: {e}")
+        get_io_executor().remove(os.path.join(DATA_DIR, "games", f"{room_id}.json"))
         
         # 从内存中移除
         del self.games[room_id]
         if room_id in self.last_activity:
             del self.last_activity[room_id]
+        self.render_cache.pop(room_id, None)
+        self.read_snapshots.pop(room_id, None)
+        self.observed_state.pop(room_id, None)
+        self.last_access.pop(room_id, None)
         
         return True
     
-    def start_game(self, room_id: str) -> bool:
-        """开始游戏"""
+    def start_game(self, room_id: str, seed: Optional[int] = None) -> bool:
+        """开始游戏，seed 决定身份分配（回放轨迹时传入录制的种子）"""
         if room_id not in self.games:
             return False
         
@@ -454,7 +2822,10 @@ class WerewolfGameManager:
         if len(roles_to_assign) != len(game["players"]):
             return False
         
-        random.shuffle(roles_to_assign)
+        if seed is None:
+            seed = random.getrandbits(32)
+        game["rng_seed"] = seed
+        random.Random(seed).shuffle(roles_to_assign)
         
         for i, player_qq in enumerate(game["player_order"]):
             game["players"][player_qq]["role"] = roles_to_assign[i]
@@ -462,27 +2833,119 @@ class WerewolfGameManager:
         
         game["phase"] = GamePhase.NIGHT.value
         game["day_count"] = 1  # 第一夜
+        game["first_night_deaths"] = []  # 供平衡性统计计算首夜死亡率
         game["started_time"] = datetime.datetime.now().isoformat()
         game["phase_start_time"] = time.time()
+        self.prepare_night_actions(game)
         self.last_activity[room_id] = time.time()
         self._save_game_file(room_id)
+        game_logger.info("对局开始，%d 名玩家", len(game["players"]),
+                         extra={"room": room_id, "phase": game["phase"], "group": game.get("group_id")})
         return True
-    
+
+    def prepare_night_actions(self, game: Dict[str, Any]):
+        """入夜时计算本夜必须提交的行动键及对应玩家，之后随行动提交逐个移除"""
+        # 其他狼人全部出局后隐狼觉醒，接替狼人刀人
+        if not game["hidden_wolf_awakened"]:
+            has_hidden_wolf = False
+            has_other_wolf = False
+            for player in game["players"].values():
+                if player["status"] != PlayerStatus.ALIVE.value:
+                    continue
+                if player["role"] == "hidden_wolf":
+                    has_hidden_wolf = True
+                elif ROLES[player["role"]]["camp"] == Camp.WOLF:
+                    has_other_wolf = True
+            if has_hidden_wolf and not has_other_wolf:
+                game["hidden_wolf_awakened"] = True
+
+        pending = {}
+        for player in game["players"].values():
+            if player["status"] != PlayerStatus.ALIVE.value:
+                continue
+
+            role = get_acting_role(game, player)
+            if not ROLES[role]["night_action"] or role == "witch":  # 女巫特殊处理
+                continue
+            if role == "cupid" and game["day_count"] != 1:  # 丘比特仅首夜
+                continue
+            if role == "painter" and game["day_count"] < 2:  # 画皮第二夜起
+                continue
+
+            pending.setdefault(NIGHT_ACTION_KEYS[role], []).append(player["qq"])
+
+        game["pending_night_actions"] = pending
+        game["night_reminder_sent"] = False
+
     def _save_game_file(self, room_id: str):
         """保存游戏文件"""
         if room_id not in self.games:
             return
         
         game = self.games[room_id]
-        games_dir = os.path.join(os.path.dirname(__file__), "games")
-        os.makedirs(games_dir, exist_ok=True)
+        game["state_version"] = game.get("state_version", 0) + 1
+        self._publish_state_events(room_id, game)
+        self._publish_read_snapshot(room_id, game)
         
-        file_path = os.path.join(games_dir, f"{room_id}.json")
+        # 在调用线程编码快照，落盘交给 I/O 线程
+        file_path = os.path.join(DATA_DIR, "games", f"{room_id}.json")
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(game, f, ensure_ascii=False, indent=2)
+            data = encode_game_snapshot(game)
         except Exception as e:
-            print(f"保存游戏文件失败: {e}")
+            storage_logger.error("保存游戏文件失败: %s", e, extra={"room": room_id, "phase": game.get("phase")})
+            return
+        get_io_executor().write(file_path, data)
+    
+    def _publish_state_events(self, room_id: str, game: Dict[str, Any]):
+        """与上次保存时比较，发布新的死亡和阶段变化事件；所有状态修改都会经过保存，无需在各处单独发布"""
+        out = {qq for qq, player in game["players"].items() if player["status"] != PlayerStatus.ALIVE.value}
+        previous_phase, previous_out = self.observed_state.get(room_id, (GamePhase.SETUP.value, set()))
+        self.observed_state[room_id] = (game["phase"], out)
+        
+        bus = EventBus()
+        if not bus.active:
+            return
+        for qq in out - previous_out:
+            player = game["players"][qq]
+            bus.publish(GameEventType.DEATH, room_id, player=qq, number=player["number"], name=player["name"],
+                        role=player["original_role"], status=player["status"], reason=player["death_reason"],
+                        killer=player["killer"], day_count=game["day_count"])
+        if game["phase"] != previous_phase:
+            bus.publish(GameEventType.PHASE_CHANGE, room_id, phase=game["phase"], previous=previous_phase,
+                        day_count=game["day_count"])
+    
+    def _publish_read_snapshot(self, room_id: str, game: Dict[str, Any]) -> RoomReadSnapshot:
+        """生成并发布房间的只读快照；读者拿到的旧快照不受之后的修改影响"""
+        host = game["players"].get(game["host"])
+        snapshot = RoomReadSnapshot(
+            game.get("state_version", 0), room_id, game["host"],
+            host["name"] if host else f"玩家{game['host'][:5]}", game["phase"], game["settings"]["player_count"],
+            tuple((player["number"], player["name"], player["status"]) for player in game["players"].values()),
+            tuple((role_id, count) for role_id, count in game["settings"]["roles"].items() if count > 0))
+        self.read_snapshots[room_id] = snapshot
+        return snapshot
+    
+    def get_read_snapshot(self, room_id: str) -> Optional[RoomReadSnapshot]:
+        """读取房间的只读快照；尚未发布过（如刚恢复的房间）且房间在内存中时现场生成"""
+        snapshot = self.read_snapshots.get(room_id)
+        if snapshot is None and room_id in self.games:
+            snapshot = self._publish_read_snapshot(room_id, self.games[room_id])
+        return snapshot
+    
+    def get_rendered(self, room_id: str, key: str, builder) -> str:
+        """获取按房间状态版本缓存的渲染文本，版本变化后重新渲染"""
+        game = self.games.get(room_id)
+        version = game.get("state_version", 0) if game is not None else self.read_snapshots[room_id].version
+        cache = self.render_cache.get(room_id)
+        if cache is None or cache["version"] != version:
+            cache = {"version": version, "texts": {}}
+            self.render_cache[room_id] = cache
+        
+        text = cache["texts"].get(key)
+        if text is None:
+            text = builder()
+            cache["texts"][key] = text
+        return text
     
     def archive_game(self, room_id: str):
         """归档游戏"""
@@ -494,125 +2957,254 @@ class WerewolfGameManager:
         # 生成对局码
         game_code = hashlib.md5(f"{room_id}{time.time()}".encode()).hexdigest()[:12]
         game["game_code"] = game_code
-        
-        # 更新玩家档案
-        for player_qq, player in game["players"].items():
-            if player_qq in self.player_profiles:
+        # 归档序号：单调递增，作为导出游标，不受文件落盘先后影响
+        self.last_archive_seq = max(time.time_ns(), self.last_archive_seq + 1)
+        game["archive_seq"] = self.last_archive_seq
+        game_logger.info("对局结束 %s，胜利阵营 %s", game_code, game.get("winner"),
+                         extra={"room": room_id, "phase": game["phase"], "group": game.get("group_id")})
+        # 尚未首次读取归档时由首次读取统一计入，避免与之后并入月度汇总的计数重复
+        if self.role_balance.rollups_loaded:
+            self.role_balance.ingest(game)
+        
+        # 按赛前评分计算本局评分变化
+        initial = _rating_settings["initial"]
+        ratings = {qq: profile.get("rating", initial) for qq, profile in self.player_profiles.items()
+                   if qq in game["players"]}
+        new_ratings, _ = rate_game(game, ratings, self.camp_records, _rating_settings["k_factor"], initial)
+        if new_ratings:
+            self._save_camp_records()
+        
+        # 更新玩家档案，被改动的档案（含击杀者/投票者）最后统一保存并更新榜单
+        touched = credit_archived_game(game, self.player_profiles.get)
+        for player_qq, rating in new_ratings.items():
+            if player_qq in touched:
                 profile = self.player_profiles[player_qq]
-                profile["total_games"] += 1
-                
-                # 判断胜负
-                player_camp = ROLES[player["original_role"]]["camp"]
-                if player["is_lover"]:
-                    player_camp = Camp.LOVER
-                
-                is_winner = False
-                if game["winner"] == "village" and player_camp == Camp.VILLAGE:
-                    is_winner = True
-                elif game["winner"] == "wolf" and player_camp == Camp.WOLF:
-                    is_winner = True
-                elif game["winner"] == "lover" and player_camp == Camp.LOVER:
-                    is_winner = True
-                elif game["winner"] == "third_party" and player_camp == Camp.THIRD_PARTY:
-                    is_winner = True
-                
-                if is_winner:
-                    profile["wins"] += 1
-                else:
-                    profile["losses"] += 1
-                
-                # 统计击杀和票杀
-                if player["killer"] == player_qq:  # 自杀不算
-                    pass
-                elif player["death_reason"] in [DeathReason.HUNTER_SHOOT.value, DeathReason.POISON.value]:
-                    killer_profile = self.player_profiles.get(player["killer"])
-                    if killer_profile:
-                        killer_profile["kills"] += 1
-                elif player["death_reason"] == DeathReason.VOTE.value:
-                    # 票杀统计给所有投票的玩家
-                    for voter_qq in game.get("votes", {}).keys():
-                        if game["votes"][voter_qq] == player["number"]:
-                            voter_profile = self.player_profiles.get(voter_qq)
-                            if voter_profile:
-                                voter_profile["votes"] += 1
-                
-                # 更新最近游戏记录
-                profile["recent_games"].append({
-                    "game_code": game_code,
-                    "role": player["original_role"],
-                    "won": is_winner,
-                    "timestamp": game["ended_time"]
-                })
-                if len(profile["recent_games"]) > 10:
-                    profile["recent_games"] = profile["recent_games"][-10:]
-                
-                # 计算最近胜率
-                recent_wins = sum(1 for g in profile["recent_games"] if g["won"])
-                profile["recent_win_rate"] = recent_wins / len(profile["recent_games"]) if profile["recent_games"] else 0
-                
-                self._save_profile(player_qq)
-        
-        # 移动文件到finished文件夹
-        games_dir = os.path.join(os.path.dirname(__file__), "games")
-        finished_dir = os.path.join(games_dir, "finished")
-        os.makedirs(finished_dir, exist_ok=True)
+                profile["rating"] = rating
+                profile["rated_games"] = profile.get("rated_games", 0) + 1
         
-        source_file = os.path.join(games_dir, f"{room_id}.json")
-        target_file = os.path.join(finished_dir, f"{game_code}.json")
+        for player_qq in touched:
+            self._save_profile(player_qq)
+            self.update_leaderboards(player_qq)
         
+        # 以最终状态写入finished文件夹，再删除进行中的游戏文件
+        games_dir = os.path.join(DATA_DIR, "games")
+        io_executor = get_io_executor()
         try:
-            if os.path.exists(source_file):
-                os.rename(source_file, target_file)
+            io_executor.write(os.path.join(games_dir, "finished", f"{game_code}.json"), encode_game_snapshot(game))
         except Exception as e:
-            print(f"移动游戏文件失败: {e}")
+            storage_logger.error("归档游戏文件失败: %s", e, extra={"room": room_id, "phase": game.get("phase")})
+        io_executor.remove(os.path.join(games_dir, f"{room_id}.json"))
+        
+        # 结束前的最后变化（如终局投票出局）未必保存过，先补发再发布结束事件
+        self._publish_state_events(room_id, game)
+        EventBus().publish(GameEventType.GAME_END, room_id, winner=game["winner"], game_code=game_code,
+                           day_count=game["day_count"], group_id=game.get("group_id"),
+                           roles={player["number"]: player["original_role"] for player in game["players"].values()})
         
         # 从内存中移除
         del self.games[room_id]
         if room_id in self.last_activity:
             del self.last_activity[room_id]
+        self.render_cache.pop(room_id, None)
+        self.read_snapshots.pop(room_id, None)
+        self.observed_state.pop(room_id, None)
+        self.last_access.pop(room_id, None)
         
         return game_code
     
-    def get_archived_game(self, game_code: str) -> Optional[Dict[str, Any]]:
+    async def get_archived_game(self, game_code: str) -> Optional[Dict[str, Any]]:
         """获取已归档的游戏"""
-        finished_dir = os.path.join(os.path.dirname(__file__), "games", "finished")
-        file_path = os.path.join(finished_dir, f"{game_code}.json")
+        file_path = os.path.join(DATA_DIR, "games", "finished", f"{game_code}.json")
         
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"读取归档游戏 {game_code} 失败: {e}")
+        try:
+            data = await asyncio.wrap_future(get_io_executor().read(file_path))
+            if data is not None:
+                return decode_game_snapshot(data)
+        except Exception as e:
+            storage_logger.warning("读取归档游戏 %s 失败: %s", game_code, e)
         return None
     
-    def cleanup_inactive_games(self):
+    def _inactive_timeout(self, phase: str) -> int:
+        """不活跃多久后归档"""
+        return 1800 if phase != GamePhase.SETUP.value else 1200
+    
+    async def cleanup_inactive_games(self):
         """清理不活跃的游戏"""
         current_time = time.time()
         rooms_to_remove = []
         
         for room_id, last_active in self.last_activity.items():
+            if room_id in self.paged_rooms:
+                if current_time > self.paged_rooms[room_id].deadline:
+                    rooms_to_remove.append(room_id)
+                continue
             if room_id not in self.games:
                 continue
                 
             game = self.games[room_id]
-            timeout = 1800 if game["phase"] != GamePhase.SETUP.value else 1200
+            timeout = self._inactive_timeout(game["phase"])
             
             if current_time - last_active > timeout:
                 rooms_to_remove.append(room_id)
         
         for room_id in rooms_to_remove:
+            # 归档需要完整状态，换出的房间先换入；读取期间不阻塞事件循环
+            if room_id in self.paged_rooms:
+                await self.ensure_resident(room_id)
+                # 换入期间房间可能已被命令推进
+                game = self.games.get(room_id)
+                if game and time.time() - self.last_activity.get(room_id, 0) <= self._inactive_timeout(game["phase"]):
+                    continue
             # 归档游戏而不是直接删除
             if room_id in self.games:
                 game = self.games[room_id]
                 game["winner"] = "inactive"
                 game["ended_time"] = datetime.datetime.now().isoformat()
+                cleanup_logger.info("房间长时间不活跃，已归档", extra={"room": room_id, "phase": game["phase"]})
                 self.archive_game(room_id)
+    
+    def room_ids(self) -> Set[str]:
+        """全部未结束房间（含已换出的）"""
+        return self.games.keys() | self.paged_rooms.keys()
+    
+    def find_room_of(self, qq: str) -> Optional[str]:
+        """查找玩家所在房间（含已换出的）"""
+        for room_id, game in self.games.items():
+            if qq in game["players"]:
+                return room_id
+        for room_id, stub in self.paged_rooms.items():
+            if qq in stub.members:
+                return room_id
+        return None
+    
+    def _game_file_path(self, room_id: str) -> str:
+        return os.path.join(DATA_DIR, "games", f"{room_id}.json")
+    
+    def page_out_idle_rooms(self, idle_seconds: float) -> int:
+        """把超过 idle_seconds 没有状态变化、也没有命令访问的房间换出到磁盘，返回换出的房间数"""
+        current_time = time.time()
+        paged = 0
+        for room_id in list(self.games.keys()):
+            game = self.games[room_id]
+            last_active = self.last_activity.get(room_id, current_time)
+            if current_time - max(last_active, self.last_access.get(room_id, 0)) < idle_seconds:
+                continue
+            
+            # 每次修改都会写快照，这里再写一次以防有未经保存的修改；同一路径的读写在同一线程按序执行，换入必定读到这一版
+            try:
+                data = encode_game_snapshot(game)
+            except Exception as e:
+                storage_logger.error("换出房间失败: %s", e, extra={"room": room_id, "phase": game.get("phase")})
+                continue
+            get_io_executor().write(self._game_file_path(room_id), data)
+            
+            self.paged_rooms[room_id] = RoomStub(room_id, game.get("group_id"), game["phase"],
+                                                 frozenset(game["players"]),
+                                                 last_active + self._inactive_timeout(game["phase"]))
+            del self.games[room_id]
+            self.render_cache.pop(room_id, None)
+            self.last_access.pop(room_id, None)
+            paged += 1
+        
+        if paged:
+            self.paging_stats["paged_out"] += paged
+            storage_logger.debug("换出 %d 个空闲房间，驻留 %d 个", paged, len(self.games))
+        return paged
+    
+    def _install_paged_room(self, room_id: str, data: Optional[bytes]) -> bool:
+        """用读到的快照替换存根"""
+        if room_id not in self.paged_rooms:
+            return room_id in self.games
+        if data is None:
+            # 快照丢失的房间无法恢复，丢弃存根
+            storage_logger.error("换入房间失败: 快照文件不存在", extra={"room": room_id})
+            del self.paged_rooms[room_id]
+            self.last_activity.pop(room_id, None)
+            self.read_snapshots.pop(room_id, None)
+            self.observed_state.pop(room_id, None)
+            return False
+        self.games[room_id] = decode_game_snapshot(data)
+        del self.paged_rooms[room_id]
+        self.paging_stats["paged_in"] += 1
+        return True
+    
+    async def ensure_resident(self, room_id: Optional[str]) -> bool:
+        """命令处理前调用：房间已换出时从磁盘换入，并记录访问时间"""
+        if not room_id:
+            return False
+        if room_id in self.paged_rooms:
+            try:
+                data = await asyncio.wrap_future(get_io_executor().read(self._game_file_path(room_id)))
+                # 并发的命令可能已先一步换入
+                if not self._install_paged_room(room_id, data):
+                    return False
+            except Exception as e:
+                storage_logger.error("换入房间失败: %s", e, extra={"room": room_id})
+                return False
+        if room_id in self.games:
+            self.last_access[room_id] = time.time()
+            return True
+        return False
+    
+    def drain_rooms(self) -> Dict[str, Dict[str, Any]]:
+        """插件重载前调用：所有驻留房间的快照一次性提交写入，返回全部房间（含已换出的）的调度信息
+        
+        快照只提交到 I/O 队列，由调用方统一 flush，同一线程内的写入合并为一批 fsync。
+        """
+        current_time = time.time()
+        rooms = {}
+        for room_id, game in self.games.items():
+            try:
+                data = encode_game_snapshot(game)
+            except Exception as e:
+                storage_logger.error("交接房间失败: %s", e, extra={"room": room_id, "phase": game.get("phase")})
+                continue
+            get_io_executor().write(self._game_file_path(room_id), data)
+            last_active = self.last_activity.get(room_id, current_time)
+            rooms[room_id] = {"group_id": game.get("group_id"), "phase": game["phase"],
+                              "members": list(game["players"]), "last_activity": last_active,
+                              "deadline": last_active + self._inactive_timeout(game["phase"])}
+        for room_id, stub in self.paged_rooms.items():
+            rooms[room_id] = {"group_id": stub.group_id, "phase": stub.phase, "members": list(stub.members),
+                              "last_activity": self.last_activity.get(room_id, current_time),
+                              "deadline": stub.deadline}
+        for room_id, info in rooms.items():
+            info["out"] = sorted(self.observed_state.get(room_id, ("", set()))[1])
+        return rooms
+    
+    async def restore_rooms(self, rooms: Dict[str, Dict[str, Any]], preload_within: float) -> int:
+        """按 drain_rooms 的调度信息恢复房间：先全部登记为换出状态，
+        再并发换入 preload_within 秒内有过活动的房间，其余等有命令时再换入。返回换入的房间数"""
+        current_time = time.time()
+        preload = []
+        for room_id, info in rooms.items():
+            if room_id in self.games:
+                continue
+            self.paged_rooms[room_id] = RoomStub(room_id, info["group_id"], info["phase"],
+                                                 frozenset(info["members"]), info["deadline"])
+            self.last_activity[room_id] = info["last_activity"]
+            # 沿用重载前的出局名单，避免换入后重复发布死亡事件
+            self.observed_state[room_id] = (info["phase"], set(info.get("out", [])))
+            if current_time - info["last_activity"] < preload_within:
+                preload.append(room_id)
+        loaded = await asyncio.gather(*(self.ensure_resident(room_id) for room_id in preload))
+        return sum(loaded)
 
 # ==================== 游戏逻辑处理器 ====================
 class GameLogicProcessor:
     def __init__(self, game_manager: WerewolfGameManager):
         self.game_manager = game_manager
+        # 内置角色的结算方法，不在表中的行动键按自定义角色结算
+        self.night_handlers = {
+            "cupid": self._process_cupid_action,
+            "guard": self._process_guard_action,
+            "wolf_kill": self._process_wolf_action,
+            "seer": self._process_seer_action,
+            "witch_poison": self._process_witch_poison_action,
+            "spiritualist": self._process_spiritualist_action,
+            "magician": self._process_magician_action,
+            "painter": self._process_painter_action
+        }
     
     async def process_night_actions(self, room_id: str) -> bool:
         """处理夜晚行动"""
@@ -707,20 +3299,28 @@ class GameLogicProcessor:
     
     async def _check_all_night_actions_completed(self, game: Dict[str, Any], room_id: str) -> bool:
         """检查是否所有玩家都已完成夜晚行动"""
-        # 获取所有需要夜晚行动的玩家
-        night_action_players = []
-        for player in game["players"].values():
-            if (player["status"] == PlayerStatus.ALIVE.value and
-                ROLES[player["role"]]["night_action"] and
-                player["role"] != "witch"):  # 女巫特殊处理
-                night_action_players.append(player)
-        
-        # 检查这些玩家是否都已完成行动
-        for player in night_action_players:
-            role_action_key = self._get_role_action_key(player["role"])
-            if role_action_key not in game["night_actions"]:
-                return False
-        
+        # 入夜时已计算好待提交的行动键，提交时逐个移除
+        if "pending_night_actions" not in game:
+            self.game_manager.prepare_night_actions(game)
+            for action_key in game["night_actions"]:
+                game["pending_night_actions"].pop(action_key, None)
+
+        return not game["pending_night_actions"]
+
+    async def remind_pending_night_actions(self, room_id: str, delay: float) -> bool:
+        """提醒入夜超过指定时间仍未行动的玩家（每夜一次）"""
+        game = self.game_manager.games.get(room_id)
+        if not game or game["phase"] != GamePhase.NIGHT.value:
+            return False
+
+        if game.get("night_reminder_sent") or time.time() - game["phase_start_time"] < delay:
+            return False
+
+        game["night_reminder_sent"] = True
+        for player_qqs in game.get("pending_night_actions", {}).values():
+            for player_qq in player_qqs:
+                await self._send_private_message(game, player_qq,
+                                               f"⏰ 第 {game['day_count']} 夜你还未行动，其他玩家正在等待你的选择")
         return True
     
     async def _calculate_potential_deaths(self, game: Dict[str, Any], room_id: str) -> List[Tuple[int, str]]:
@@ -744,51 +3344,19 @@ class GameLogicProcessor:
     
     async def _process_all_night_actions(self, game: Dict[str, Any], room_id: str) -> bool:
         """处理所有夜晚行动"""
-        # 按角色优先级处理行动
-        actions_processed = {
-            "cupid": False,
-            "guard": False,
-            "wolf": False,
-            "seer": False,
-            "witch_poison": False,
-            "spiritualist": False,
-            "magician": False,
-            "painter": False
-        }
-        
-        # 丘比特行动（仅第一夜）
-        if game["day_count"] == 1:
-            await self._process_cupid_action(game, room_id)
-            actions_processed["cupid"] = True
-        
-        # 守卫行动
-        await self._process_guard_action(game, room_id)
-        actions_processed["guard"] = True
-        
-        # 狼人行动
-        await self._process_wolf_action(game, room_id)
-        actions_processed["wolf"] = True
-        
-        # 预言家行动
-        await self._process_seer_action(game, room_id)
-        actions_processed["seer"] = True
-        
-        # 女巫毒药行动
-        await self._process_witch_poison_action(game, room_id)
-        actions_processed["witch_poison"] = True
-        
-        # 通灵师行动
-        await self._process_spiritualist_action(game, room_id)
-        actions_processed["spiritualist"] = True
-        
-        # 魔术师行动
-        await self._process_magician_action(game, room_id)
-        actions_processed["magician"] = True
-        
-        # 画皮行动（第二夜及以后）
-        if game["day_count"] >= 2:
-            await self._process_painter_action(game, room_id)
-            actions_processed["painter"] = True
+        # 按 NIGHT_RESOLUTION_ORDER 的优先级依次结算
+        for _, action_key in NIGHT_RESOLUTION_ORDER:
+            # 丘比特仅第一夜，画皮第二夜起
+            if action_key == "cupid" and game["day_count"] != 1:
+                continue
+            if action_key == "painter" and game["day_count"] < 2:
+                continue
+            
+            handler = self.night_handlers.get(action_key)
+            if handler:
+                await handler(game, room_id)
+            else:
+                await self._process_custom_action(game, room_id, action_key)
         
         # 执行死亡
         await self._execute_deaths(game, room_id)
@@ -805,6 +3373,7 @@ class GameLogicProcessor:
         game["witch_used_save_this_night"] = False
         game["witch_used_poison_this_night"] = False
         game["saved_players"] = set()  # 清空拯救记录
+        game["night_protected"] = []
         
         self.game_manager.last_activity[room_id] = time.time()
         self.game_manager._save_game_file(room_id)
@@ -882,8 +3451,8 @@ class GameLogicProcessor:
             target_player = self._get_player_by_number(game, target_num)
             
             if target_player and target_player["status"] == PlayerStatus.ALIVE.value:
-                # 检查守卫保护
-                if target_num == game.get("guard_protected"):
+                # 检查守卫及自定义守护角色的保护
+                if target_num == game.get("guard_protected") or target_num in game.get("night_protected", ()):
                     # 被守护，不死亡
                     await self._send_group_message(game, 
                                                  f"🛡️ 玩家 {target_num} 号被守护，狼人袭击失败！")
@@ -922,10 +3491,7 @@ class GameLogicProcessor:
             seer_player = self._get_player_by_role(game, "seer")
             
             if target_player and seer_player:
-                target_role = target_player["role"]
-                camp = ROLES[target_role]["camp"]
-                
-                result = "好人" if camp == Camp.VILLAGE else "狼人"
+                result = "好人" if CHECK_CAMPS[target_player["role"]] == Camp.VILLAGE else "狼人"
                 await self._send_private_message(game, seer_player["qq"],
                                                f"🔮 玩家 {target_num} 号的阵营是: {result}")
         except ValueError:
@@ -1042,9 +3608,49 @@ class GameLogicProcessor:
         except ValueError:
             pass
     
+    async def _process_custom_action(self, game: Dict[str, Any], room_id: str, action_key: str):
+        """按配置的行动类型结算自定义角色"""
+        action = CUSTOM_ROLE_ACTIONS.get(action_key)
+        target_text = game["night_actions"].get(action_key)
+        if not action or not target_text:
+            return
+        
+        try:
+            target_num = int(target_text)
+        except ValueError:
+            return
+        target_player = self._get_player_by_number(game, target_num)
+        actor = self._get_player_by_role(game, action.role)
+        if not target_player or not actor:
+            return
+        
+        if action.kind == "check":
+            if action.reveal == "role":
+                result = ROLES[target_player["role"]]["name"]
+            else:
+                result = "好人" if CHECK_CAMPS[target_player["role"]] == Camp.VILLAGE else "狼人"
+            await self._send_private_message(game, actor["qq"], f"🔍 玩家 {target_num} 号的查验结果是: {result}")
+        
+        elif action.kind == "protect":
+            game.setdefault("night_protected", []).append(target_num)
+            await self._send_private_message(game, actor["qq"], f"🛡️ 你守护了玩家 {target_num} 号")
+        
+        elif action.kind == "kill":
+            if target_player["status"] != PlayerStatus.ALIVE.value:
+                return
+            if target_num == game.get("guard_protected") or target_num in game.get("night_protected", ()):
+                return
+            game["death_queue"].append({
+                "player_qq": target_player["qq"],
+                "reason": DeathReason.SKILL.value,
+                "killer": actor["qq"]
+            })
+            await self._send_private_message(game, actor["qq"], f"🗡️ 你对玩家 {target_num} 号发动了技能")
+    
     async def _execute_deaths(self, game: Dict[str, Any], room_id: str):
         """执行死亡"""
         death_messages = []
+        first_night_deaths = game.setdefault("first_night_deaths", []) if game["day_count"] == 1 else None
         
         for death in game["death_queue"]:
             player = game["players"][death["player_qq"]]
@@ -1052,6 +3658,8 @@ class GameLogicProcessor:
                 player["status"] = PlayerStatus.DEAD.value
                 player["death_reason"] = death["reason"]
                 player["killer"] = death["killer"]
+                if first_night_deaths is not None:
+                    first_night_deaths.append(player["qq"])
                 
                 # 检查情侣殉情
                 if player["is_lover"] and player["lover_partner"]:
@@ -1060,6 +3668,8 @@ class GameLogicProcessor:
                         lover["status"] = PlayerStatus.DEAD.value
                         lover["death_reason"] = DeathReason.LOVER_SUICIDE.value
                         lover["killer"] = player["qq"]
+                        if first_night_deaths is not None:
+                            first_night_deaths.append(lover["qq"])
                         death_messages.append(f"💔 玩家 {lover['number']} 号 {lover['name']} 因情侣死亡而殉情")
                 
                 death_messages.append(f"💀 玩家 {player['number']} 号 {player['name']} 死亡")
@@ -1149,6 +3759,7 @@ class GameLogicProcessor:
         game["witch_save_candidates"] = []
         game["witch_used_save_this_night"] = False
         game["witch_used_poison_this_night"] = False
+        self.game_manager.prepare_night_actions(game)
         self.game_manager.last_activity[room_id] = time.time()
         self.game_manager._save_game_file(room_id)
         
@@ -1205,12 +3816,9 @@ class GameLogicProcessor:
             "third_party": "🎭 第三方阵营胜利！"
         }.get(game["winner"], "游戏结束")
         
-        result_message = f"🎮 游戏结束！{winner_text}\n\n玩家身份揭示：\n"
-        
-        for player in game["players"].values():
-            role_name = ROLES[player["original_role"]]["name"]
-            status = "存活" if player["status"] == PlayerStatus.ALIVE.value else "死亡"
-            result_message += f"{player['number']}号 {player['name']} - {role_name} ({status})\n"
+        result_message = self.game_manager.get_rendered(
+            room_id, "reveal",
+            lambda: f"🎮 游戏结束！{winner_text}\n\n玩家身份揭示：\n" + render_player_reveal(game))
         
         await self._send_group_message(game, result_message)
         
@@ -1237,17 +3845,7 @@ class GameLogicProcessor:
     
     def _get_role_action_key(self, role: str) -> str:
         """获取角色行动键"""
-        action_keys = {
-            "seer": "seer",
-            "witch": "witch_poison",  # 女巫毒药行动键
-            "wolf": "wolf_kill",
-            "guard": "guard",
-            "magician": "magician",
-            "spiritualist": "spiritualist",
-            "cupid": "cupid",
-            "painter": "painter"
-        }
-        return action_keys.get(role, "")
+        return NIGHT_ACTION_KEYS.get(role, "")
     
     def _get_phase_timeout(self, phase: str) -> str:
         """获取阶段超时时间描述"""
@@ -1277,18 +3875,14 @@ class GameLogicProcessor:
         
         await self._send_group_message(game, message)
         
-        # 私聊通知有行动的玩家
-        for player in game["players"].values():
-            if (player["status"] == PlayerStatus.ALIVE.value and
-                ROLES[player["role"]]["night_action"]):
-                
-                role_info = ROLES[player["role"]]
-                command = role_info["command"]
-                description = role_info["description"]
-                
-                if command:
-                    detailed_message = self._get_detailed_role_message(player, game)
-                    await self._send_private_message(game, player["qq"], detailed_message)
+        # 私聊通知有行动的玩家（进度在本轮通知中只统计一次）
+        alive_players = [p for p in game["players"].values() if p["status"] == PlayerStatus.ALIVE.value]
+        progress = (len([p for p in alive_players if p["has_acted"]]), len(alive_players))
+        for player in alive_players:
+            role_info = ROLES[get_acting_role(game, player)]
+            if role_info["night_action"] and role_info["command"]:
+                detailed_message = self._get_detailed_role_message(player, game, progress)
+                await self._send_private_message(game, player["qq"], detailed_message)
     
     async def _send_day_start_message(self, game: Dict[str, Any], room_id: str):
         """发送白天开始消息"""
@@ -1299,23 +3893,19 @@ class GameLogicProcessor:
         
         await self._send_group_message(game, message)
     
-    def _get_detailed_role_message(self, player: Dict[str, Any], game: Dict[str, Any]) -> str:
-        """获取详细的角色消息"""
-        role = player["role"]
-        role_info = ROLES[role]
-        command = role_info["command"]
+    def _get_detailed_role_message(self, player: Dict[str, Any], game: Dict[str, Any],
+                                   progress: Optional[Tuple[int, int]] = None) -> str:
+        """获取详细的角色消息（基于预编译的角色模板）"""
+        role = get_acting_role(game, player)
         
         # 计算已完成行动的玩家数量
-        acted_count = len([p for p in game["players"].values() 
-                          if p["has_acted"] and p["status"] == PlayerStatus.ALIVE.value])
-        total_players = len([p for p in game["players"].values() if p["status"] == PlayerStatus.ALIVE.value])
-        
-        message = f"🌙 第 {game['day_count']} 夜行动\n"
-        message += f"你的身份：{role_info['name']}\n"
-        message += f"你的号码：{player['number']}号\n\n"
-        message += f"🎯 角色能力：{role_info['description']}\n\n"
+        if progress is None:
+            alive_players = [p for p in game["players"].values() if p["status"] == PlayerStatus.ALIVE.value]
+            progress = (len([p for p in alive_players if p["has_acted"]]), len(alive_players))
+        acted_count, total_players = progress
         
         # 特殊角色的额外信息
+        extra = ""
         if role == "witch":
             witch_status = game["witch_status"]
             status_text = {
@@ -1324,7 +3914,7 @@ class GameLogicProcessor:
                 WitchStatus.HAS_POISON_ONLY.value: "☠️ 你只有毒药",
                 WitchStatus.USED_BOTH.value: "❌ 你已无药可用"
             }.get(witch_status, "💊 状态未知")
-            message += f"{status_text}\n\n"
+            extra = f"{status_text}\n\n"
         
         elif role == "wolf":
             # 显示狼队友信息
@@ -1337,29 +3927,285 @@ class GameLogicProcessor:
                     wolf_teammates.append(f"{p['number']}号")
             
             if wolf_teammates:
-                message += f"🐺 你的狼队友：{', '.join(wolf_teammates)}\n\n"
+                extra = f"🐺 你的狼队友：{', '.join(wolf_teammates)}\n\n"
             else:
-                message += "🐺 你是唯一的狼人\n\n"
+                extra = "🐺 你是唯一的狼人\n\n"
         
         elif role == "guard":
             last_target = game.get("last_guard_target")
             if last_target:
-                message += f"🛡️ 上一夜你守护了 {last_target} 号玩家，今晚不能守护同一人\n\n"
+                extra = f"🛡️ 上一夜你守护了 {last_target} 号玩家，今晚不能守护同一人\n\n"
         
         elif role == "painter" and game["day_count"] >= 2:
-            message += "🎨 从第二夜开始，你可以伪装成已出局玩家的身份\n\n"
-        
-        message += f"📊 当前进度：{acted_count}/{total_players} 位玩家已完成行动\n\n"
-        message += f"📝 使用命令：/wwg {command} <目标号码>\n"
-        
-        if role == "magician":
-            message += "💡 示例：/wwg swap 3 5 （交换3号和5号）"
-        elif role == "cupid":
-            message += "💡 示例：/wwg choose 2 4 （选择2号和4号成为情侣）"
+            extra = "🎨 从第二夜开始，你可以伪装成已出局玩家的身份\n\n"
+        
+        return NIGHT_ROLE_TEMPLATES[role].format(
+            day_count=game["day_count"],
+            number=player["number"],
+            extra=extra,
+            acted_count=acted_count,
+            total_players=total_players
+        )
+
+# ==================== 性能剖析 ====================
+PROFILER_MODES = ("cprofile", "sample")
+
+class ProfileSession:
+    """单条命令的剖析：cprofile 为确定性剖析，sample 由后台线程定时采样事件循环线程的调用栈
+
+    命令在 await 处让出时，事件循环中其他协程的耗时也会计入本次剖析。
+    """
+    # 同一进程内同时只允许一个会话（cProfile 无法嵌套启用）
+    _lock = threading.Lock()
+
+    def __init__(self, mode: str, interval: float = 0.005):
+        self.mode = mode
+        self.interval = interval
+        self.profile = None
+        self.stacks: Dict[str, int] = {}
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = 0.0
+
+    def start(self) -> bool:
+        """开始剖析，已有会话进行中时返回 False"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        self._started = time.perf_counter()
+        if self.mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
         else:
-            message += "💡 示例：/wwg check 3 （查验3号玩家）"
-        
-        return message
+            self._thread = threading.Thread(target=self._sample, args=(threading.get_ident(),),
+                                            name="wwg-profiler", daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self) -> Dict[str, Any]:
+        """结束剖析，返回可跨进程传递的原始结果"""
+        try:
+            stats = None
+            if self.profile is not None:
+                self.profile.disable()
+                self.profile.create_stats()
+                stats = self.profile.stats
+            if self._thread is not None:
+                self._stop_event.set()
+                self._thread.join()
+            return {"mode": self.mode, "stats": stats, "stacks": self.stacks,
+                    "elapsed": time.perf_counter() - self._started}
+        finally:
+            self._lock.release()
+
+    def _sample(self, thread_id: int):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if self._stop_event.is_set():
+                # 此时事件循环线程已在 stop() 中等待本线程，丢弃这次采样
+                break
+            if names:
+                # 折叠栈格式：根在前，分号分隔，可直接交给 flamegraph.pl
+                key = ";".join(reversed(names))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+class CommandProfiler:
+    """按比例或按房间对命令执行剖析，并在主进程聚合结果（分片模式下由分片进程剖析后回传）"""
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.mode = None
+            cls._instance.rate = 1.0
+            cls._instance.interval = 0.005
+            cls._instance.room_id = None
+            cls._instance.enabled_time = 0.0
+            cls._instance._reset()
+        return cls._instance
+
+    def _reset(self):
+        self.stats: Optional[pstats.Stats] = None
+        self.stacks: Dict[str, int] = {}
+        self.commands: Dict[str, List[float]] = {}
+        self.skipped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode is not None
+
+    def enable(self, mode: str, rate: float, room_id: Optional[str], interval: float = 0.005):
+        """开启剖析（会清空之前聚合的结果）"""
+        self.mode = mode
+        self.rate = rate
+        self.interval = interval
+        self.room_id = room_id
+        self.enabled_time = time.time()
+        self._reset()
+
+    def disable(self):
+        self.mode = None
+
+    def should_profile(self, room_id: Optional[str]) -> Optional[str]:
+        """决定本条命令是否剖析，返回剖析模式"""
+        if self.mode is None:
+            return None
+        if self.room_id and room_id != self.room_id:
+            return None
+        if self.rate < 1.0 and random.random() >= self.rate:
+            return None
+        return self.mode
+
+    def record(self, label: str, raw: Optional[Dict[str, Any]]):
+        """聚合一次剖析结果，raw 为 None 表示因已有会话进行中而跳过"""
+        if raw is None:
+            self.skipped += 1
+            return
+        self.commands.setdefault(label, []).append(raw["elapsed"])
+        if raw["stats"]:
+            stats = pstats.Stats()
+            stats.stats = raw["stats"]
+            stats.get_top_level_stats()
+            if self.stats is None:
+                self.stats = stats
+            else:
+                self.stats.add(stats)
+        for stack, count in raw["stacks"].items():
+            self.stacks[stack] = self.stacks.get(stack, 0) + count
+
+    @property
+    def profiled_count(self) -> int:
+        return sum(len(durations) for durations in self.commands.values())
+
+    def dump(self) -> List[str]:
+        """把聚合结果写入 DATA_DIR/profiles，返回写出的文件路径"""
+        base_path = os.path.join(DATA_DIR, "profiles", f"profile-{datetime.datetime.now():%Y%m%d-%H%M%S}")
+        paths = []
+        io_executor = get_io_executor()
+        if self.stats is not None:
+            # 与 pstats.Stats.dump_stats 格式相同，可用 python -m pstats / snakeviz 打开
+            paths.append(f"{base_path}.pstats")
+            io_executor.write(paths[-1], marshal.dumps(self.stats.stats))
+        if self.stacks:
+            paths.append(f"{base_path}.collapsed")
+            lines = [f"{stack} {count}" for stack, count in sorted(self.stacks.items())]
+            io_executor.write(paths[-1], ("\n".join(lines) + "\n").encode("utf-8"))
+        return paths
+
+    def summary(self, limit: int = 5) -> str:
+        """按命令统计耗时，并列出最耗时的函数"""
+        lines = []
+        for label, durations in sorted(self.commands.items(), key=lambda item: -sum(item[1])):
+            lines.append(f"{label}: {len(durations)} 次，平均 {sum(durations) / len(durations) * 1000:.1f}ms，"
+                         f"最长 {max(durations) * 1000:.1f}ms")
+
+        hot = []
+        if self.stats is not None:
+            # (文件, 行号, 函数) -> (原始调用数, 调用数, 自身耗时, 累计耗时, 调用者)，按自身耗时排序
+            for (filename, lineno, func), (_, ncalls, tottime, _, _) in self.stats.stats.items():
+                hot.append((tottime, f"{os.path.basename(filename)}:{lineno}({func}) "
+                                     f"{tottime * 1000:.1f}ms / {ncalls} 次"))
+        else:
+            leaves = {}
+            for stack, count in self.stacks.items():
+                leaf = stack.rsplit(";", 1)[-1]
+                leaves[leaf] = leaves.get(leaf, 0) + count
+            hot = [(count, f"{leaf} {count} 次采样") for leaf, count in leaves.items()]
+        if hot:
+            lines.append("热点:")
+            lines.extend(f"  {text}" for _, text in heapq.nlargest(limit, hot))
+        return "\n".join(lines)
+
+# ==================== 事件循环监控 ====================
+class LoopMonitor:
+    """事件循环延迟探针
+
+    探针协程按固定间隔 sleep，实际唤醒时间与预定时间之差即为循环延迟，保存最近 window 个样本。
+    另有看门狗线程：预定唤醒时间过去 slow_threshold 仍未唤醒，说明有回调长时间占用事件循环，
+    此时直接采样事件循环线程的调用栈，记录正在执行的函数与最近开始的命令。
+    """
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.samples = deque(maxlen=600)
+            cls._instance.slow_callbacks = deque(maxlen=20)
+            cls._instance.current_command = None
+            cls._instance.interval = 0.5
+            cls._instance.slow_threshold = 0.2
+            cls._instance.task = None
+            cls._instance._expected = None
+            cls._instance._stalled = None
+            cls._instance._stop_event = threading.Event()
+        return cls._instance
+
+    def start(self, interval: float, slow_threshold: float, window: int):
+        self.stop()
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.samples = deque(self.samples, maxlen=max(10, window))
+        self._stop_event = threading.Event()
+        self.task = asyncio.create_task(self._probe(threading.get_ident()))
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self._stop_event.set()
+        self._expected = None
+
+    async def _probe(self, loop_thread_id: int):
+        threading.Thread(target=self._watchdog, args=(loop_thread_id, self._stop_event),
+                         name="wwg-loop-watchdog", daemon=True).start()
+        try:
+            while True:
+                self._expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, time.monotonic() - self._expected)
+                self.samples.append(lag)
+                stalled, self._stalled = self._stalled, None
+                if stalled is not None:
+                    # 看门狗记录的是卡顿中途的状态，这里补上完整的延迟
+                    stalled["lag_ms"] = round(lag * 1000, 1)
+                    monitor_logger.warning("事件循环阻塞 %.0fms，执行中: %s", lag * 1000, stalled["where"],
+                                           extra={"command": stalled["command"], "latency_ms": stalled["lag_ms"]})
+        finally:
+            self._expected = None
+
+    def _watchdog(self, loop_thread_id: int, stop_event: threading.Event):
+        while not stop_event.wait(self.slow_threshold / 2):
+            expected = self._expected
+            if expected is None or self._stalled is not None:
+                continue
+            if time.monotonic() - expected < self.slow_threshold:
+                continue
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = []
+            while frame is not None and len(stack) < 64:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            # 优先报告插件内最深的调用（子命令处理或持久化函数），否则报告栈顶
+            plugin_frames = [code.co_name for code in stack if code.co_filename == __file__]
+            where = " <- ".join(plugin_frames[:3]) if plugin_frames else (
+                f"{os.path.basename(stack[0].co_filename)}:{stack[0].co_name}" if stack else "未知")
+            self._stalled = {"time": time.time(), "where": where, "command": self.current_command,
+                             "lag_ms": round((time.monotonic() - expected) * 1000, 1)}
+            self.slow_callbacks.append(self._stalled)
+
+    def percentiles(self) -> Optional[Dict[str, float]]:
+        """最近样本的延迟分位数（毫秒）"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+
+        def pick(q: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+        return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(ordered[-1] * 1000, 1)}
 
 # ==================== 测试命令 ====================
 class TestPrivateMessageCommand(BaseCommand):
@@ -1406,6 +4252,10 @@ class WerewolfGameCommand(BaseCommand):
         "/wwg - 显示帮助\n"
         "/wwg host - 创建房间并自动加入\n"
         "/wwg join <房间号> - 加入房间\n"
+        "/wwg queue - 加入本群匹配队列，人满自动建房\n"
+        "/wwg leave - 离开匹配队列\n"
+        "/wwg watch <房间号> - 观战（私聊延迟推送，已出局玩家可观战本局）\n"
+        "/wwg unwatch - 停止观战\n"
         "/wwg status - 查看房间状态\n"
         "/wwg destroy - 销毁房间（仅房主）\n"
         "/wwg settings players <数量> - 设置玩家数(6-18)\n"
@@ -1413,6 +4263,9 @@ class WerewolfGameCommand(BaseCommand):
         "/wwg start - 开始游戏\n"
         "/wwg profile [QQ号] - 查看游戏档案\n"
         "/wwg archive <对局码> - 查询对局记录\n"
+        "/wwg rank [wins|winrate|kills|votes] [group|群号] - 查看排行榜\n"
+        "/wwg stats roles - 查看各角色胜率与首夜死亡率\n"
+        "/wwg stats preset <人数> - 查看某人数配置的阵营/角色/座位胜率\n"
         "/wwg name set <昵称> - 设置游戏昵称\n"  # 新增
         "/wwg name view - 查看当前昵称\n"  # 新增
         "/wwg test_private <QQ号> [消息] - 测试私聊消息发送\n"
@@ -1430,16 +4283,41 @@ class WerewolfGameCommand(BaseCommand):
         "/wwg shoot <号码> - 猎人开枪\n"
         "/wwg explode <号码> - 白狼王自爆\n"
         "/wwg skip - 跳过行动\n"
+        "\n🛠️ 管理员命令:\n"
+        "/wwg export [group=群号] [since=日期] [until=日期] [cursor=游标] - 导出归档对局(NDJSON)\n"
+        "/wwg profiler on [cprofile|sample] [rate=比例] [room=房间号] - 开启命令剖析\n"
+        "/wwg profiler status|dump|off - 查看/导出剖析结果，off 关闭并导出\n"
+        "/wwg health - 查看事件循环延迟、房间数、队列深度与最近持久化错误\n"
     )
     intercept_message = True
     
+    # 分片模式下由主进程预先分配的房间号
+    room_id_hint: Optional[str] = None
+    # 开局使用的随机种子，由录制轨迹的主进程预先生成，或回放时取自轨迹
+    seed_hint: Optional[int] = None
+    # 匹配队列自动建房沿用的房间号（回放时取自轨迹），以及本命令建成的房间号（供录制）
+    lobby_room_hints: Optional[List[str]] = None
+    formed_rooms: Optional[List[str]] = None
+    # 不为 None 时记录本命令发出的回复（供去重缓存重发）
+    reply_log: Optional[List[str]] = None
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.game_manager = WerewolfGameManager()
         self.game_processor = GameLogicProcessor(self.game_manager)
     
+    async def send_text(self, text: str, *args, **kwargs) -> bool:
+        if self.reply_log is not None:
+            self.reply_log.append(text)
+        return await super().send_text(text, *args, **kwargs)
+    
     async def execute(self) -> Tuple[bool, Optional[str], bool]:
         """执行命令"""
+        start = time.perf_counter()
+        started_at = time.time()
+        subcommand = args = ""
+        shed = False  # 被限流或房间上限拒绝，回放时跳过
+        recorder = CommandTraceRecorder()
         try:
             # 安全获取匹配组
             matched_groups = self.matched_groups or {}
@@ -1450,37 +4328,149 @@ class WerewolfGameCommand(BaseCommand):
             subcommand = subcommand.lower() if subcommand else ""
             args = args or ""
             
-            # 特殊处理destroy命令，确保它被正确路由
-            if subcommand == "destroy":
-                return await self._destroy_game()
-            
-            if not subcommand:
-                return await self._show_help()
-            elif subcommand == "host":
-                return await self._host_game()
-            elif subcommand == "join":
-                return await self._join_game(args)
-            elif subcommand == "status":
-                return await self._show_status()
-            elif subcommand == "settings":
-                return await self._handle_settings(args)
-            elif subcommand == "start":
-                return await self._start_game()
-            elif subcommand == "profile":
-                return await self._show_profile(args)
-            elif subcommand == "archive":
-                return await self._show_archive(args)
-            elif subcommand == "test_private":
-                return await self._handle_test_private(args)
-            elif subcommand == "name":  # 新增昵称设置命令
-                return await self._handle_name_command(args)
-            else:
-                # 游戏内行动命令
-                return await self._handle_game_action(subcommand, args)
+            # 限流与建房上限在任何房间查找或写盘之前检查（管理员不受限流影响）
+            user_id = str(self.message.message_info.user_info.user_id)
+            admission = AdmissionControl()
+            allowed, notify = admission.allow_command(user_id)
+            if not allowed and not self._is_admin():
+                shed = True
+                admission.shed["rate_limited"] += 1
+                if notify:
+                    await self.send_text("⏳ 操作过于频繁，请稍后再试")
+                return False, "命令限流", True
+            group_info = self.message.message_info.group_info
+            if subcommand == "host" and group_info:
+                rejection = admission.room_rejection(self.game_manager, group_info.group_id)
+                if rejection:
+                    shed = True
+                    await self.send_text(rejection)
+                    return False, "房间数已达上限", True
+            
+            # 录制时预先生成开局种子，分片模式下随请求下发，使轨迹能复现身份分配
+            if recorder.enabled and subcommand == "start" and self.seed_hint is None:
+                self.seed_hint = random.getrandbits(32)
+            
+            # 看门狗发现事件循环卡顿时据此报告最近开始的命令
+            LoopMonitor().current_command = f"/wwg {subcommand}".rstrip()
+            
+            # 开启剖析时按比例/目标房间决定是否剖析本条命令
+            router = ShardRouter.get_active()
+            profiler = CommandProfiler()
+            profile_mode = None
+            if profiler.enabled and subcommand != "profiler":
+                profile_mode = profiler.should_profile(self._get_target_room(router, subcommand, args))
+            
+            # 分片模式：房间相关命令转发到房间所在的分片进程
+            if router and subcommand not in SHARD_LOCAL_SUBCOMMANDS:
+                routed = await router.forward(self, subcommand, args, profile_mode)
+                if routed is not None:
+                    return routed
+            
+            # 房间相关命令处理前，把已换出的房间换回内存
+            # 状态查询读取换出时保留的只读快照，无需换入
+            if subcommand not in SHARD_LOCAL_SUBCOMMANDS:
+                room_id = self._get_target_room(None, subcommand, args)
+                if subcommand != "status" or room_id not in self.game_manager.read_snapshots:
+                    await self.game_manager.ensure_resident(room_id)
+            
+            if profile_mode:
+                session = ProfileSession(profile_mode, profiler.interval)
+                if session.start():
+                    try:
+                        return await self._dispatch_subcommand(subcommand, args)
+                    finally:
+                        profiler.record(f"/wwg {subcommand}".rstrip(), session.stop())
+                profiler.record(f"/wwg {subcommand}".rstrip(), None)
+            return await self._dispatch_subcommand(subcommand, args)
                 
         except Exception as e:
             await self.send_text(f"❌ 命令执行出错: {str(e)}")
             return False, f"命令执行出错: {str(e)}", True
+        finally:
+            # 回复已发出，此时再等待阻塞型订阅者消化积压
+            await EventBus().relieve_backpressure()
+            if recorder.enabled:
+                group_info = self.message.message_info.group_info
+                entry = {"t": started_at, "user": str(self.message.message_info.user_info.user_id),
+                         "group": str(group_info.group_id) if group_info else None,
+                         "text": f"/wwg {subcommand} {args}".strip(),
+                         "ms": round((time.perf_counter() - start) * 1000, 3)}
+                if subcommand in ("host", "start"):
+                    entry["room"] = self._get_target_room(ShardRouter.get_active(), subcommand, args)
+                if subcommand == "queue":
+                    # 回放时按录制时的满员人数建房，建成的房间沿用录制时的房间号
+                    entry["room_size"] = self.get_config("lobby.room_size", 9)
+                    if self.formed_rooms:
+                        entry["rooms"] = self.formed_rooms
+                if self.seed_hint is not None:
+                    entry["seed"] = self.seed_hint
+                if shed:
+                    entry["shed"] = True
+                recorder.record(entry)
+            if command_logger.isEnabledFor(logging.DEBUG):
+                command_logger.debug("命令完成", extra={
+                    "command": f"/wwg {subcommand}".rstrip(),
+                    "user": str(self.message.message_info.user_info.user_id),
+                    "room": self._get_target_room(ShardRouter.get_active(), subcommand, args),
+                    "latency_ms": round((time.perf_counter() - start) * 1000, 1)
+                })
+    
+    def _get_target_room(self, router: Optional["ShardRouter"], subcommand: str, args: str) -> Optional[str]:
+        """命令所针对的房间，用于按房间剖析和日志"""
+        if subcommand in ("join", "watch"):
+            return args.strip()
+        user_id = str(self.message.message_info.user_info.user_id)
+        if router:
+            return router.user_rooms.get(user_id)
+        return self._find_user_game(user_id)
+    
+    async def _dispatch_subcommand(self, subcommand: str, args: str) -> Tuple[bool, Optional[str], bool]:
+        """按子命令分发"""
+        # 特殊处理destroy命令，确保它被正确路由
+        if subcommand == "destroy":
+            return await self._destroy_game()
+        
+        if not subcommand:
+            return await self._show_help()
+        elif subcommand == "host":
+            return await self._host_game()
+        elif subcommand == "join":
+            return await self._join_game(args)
+        elif subcommand == "queue":
+            return await self._join_queue()
+        elif subcommand == "leave":
+            return await self._leave_queue()
+        elif subcommand == "watch":
+            return await self._watch_room(args)
+        elif subcommand == "unwatch":
+            return await self._unwatch_room()
+        elif subcommand == "status":
+            return await self._show_status()
+        elif subcommand == "settings":
+            return await self._handle_settings(args)
+        elif subcommand == "start":
+            return await self._start_game()
+        elif subcommand == "profile":
+            return await self._show_profile(args)
+        elif subcommand == "archive":
+            return await self._show_archive(args)
+        elif subcommand == "rank":
+            return await self._show_rank(args)
+        elif subcommand == "stats":
+            return await self._show_balance_stats(args)
+        elif subcommand == "test_private":
+            return await self._handle_test_private(args)
+        elif subcommand == "name":  # 新增昵称设置命令
+            return await self._handle_name_command(args)
+        elif subcommand == "export":
+            return await self._export_archive(args)
+        elif subcommand == "profiler":
+            return await self._handle_profiler(args)
+        elif subcommand == "health":
+            return await self._show_health()
+        else:
+            # 游戏内行动命令
+            return await self._handle_game_action(subcommand, args)
     
     async def _handle_test_private(self, args: str):
         """处理测试私聊命令"""
@@ -1544,7 +4534,7 @@ class WerewolfGameCommand(BaseCommand):
         group_id = group_info.group_id
         
         # 生成房间号
-        room_id = f"WWG{int(time.time()) % 1000000:06d}"
+        room_id = self.room_id_hint or allocate_room_id(self.game_manager.room_ids())
         
         game = self.game_manager.create_game(room_id, str(user_id), str(group_id), user_name)
         
@@ -1601,6 +4591,90 @@ class WerewolfGameCommand(BaseCommand):
             await self.send_text("❌ 加入房间失败，可能房间已满或不存在")
             return False, "加入房间失败", True
     
+    async def _join_queue(self):
+        """加入本群匹配队列"""
+        user_id = str(self.message.message_info.user_info.user_id)
+        group_info = self.message.message_info.group_info
+        if not group_info:
+            await self.send_text("❌ 请在群聊中加入匹配队列")
+            return False, "非群聊环境", True
+        
+        # 分片模式下房间在其他进程，用主进程的玩家-房间索引判断
+        router = ShardRouter.get_active()
+        if (user_id in router.user_rooms) if router else self._has_unfinished_game(user_id):
+            await self.send_text("❌ 你已有未完成的游戏，请先完成当前游戏或销毁房间")
+            return False, "玩家有未完成游戏", True
+        
+        group_id = str(group_info.group_id)
+        lobby = self.game_manager.lobby
+        queued_group = lobby.tickets.get(user_id, (None,))[0]
+        if queued_group is not None:
+            await self.send_text(f"❌ 你已在{'本群' if queued_group == group_id else '其他群'}的匹配队列中，可使用 /wwg leave 离开")
+            return False, "已在匹配队列中", True
+        
+        room_size = min(18, max(6, self.get_config("lobby.room_size", 9)))
+        waiting = lobby.enqueue(user_id, group_id, self._get_user_nickname(user_id))
+        await self.send_text(f"✅ 已加入匹配队列（{waiting}/{room_size}），人满后自动建房")
+        self.formed_rooms = await form_lobby_rooms(self.game_manager, group_id, room_size,
+                                                   room_id_hints=self.lobby_room_hints)
+        return True, "加入匹配队列", True
+    
+    async def _leave_queue(self):
+        """离开匹配队列"""
+        user_id = str(self.message.message_info.user_info.user_id)
+        if self.game_manager.lobby.remove(user_id) is None:
+            await self.send_text("❌ 你不在匹配队列中")
+            return False, "不在匹配队列中", True
+        
+        await self.send_text("✅ 已离开匹配队列")
+        return True, "离开匹配队列", True
+    
+    async def _watch_room(self, args: str):
+        """观战房间"""
+        room_id = args.strip()
+        if not room_id:
+            await self.send_text("❌ 请提供房间号，格式: /wwg watch <房间号>")
+            return False, "缺少房间号", True
+        
+        hub = SpectatorHub()
+        if hub.task is None:
+            await self.send_text("❌ 观战功能未启用")
+            return False, "观战未启用", True
+        
+        # 分片模式下房间成员来自主进程的索引
+        router = ShardRouter.get_active()
+        if router:
+            members = router.room_members.get(room_id)
+        elif room_id in self.game_manager.paged_rooms:
+            members = list(self.game_manager.paged_rooms[room_id].members)
+        else:
+            members = list(self.game_manager.games[room_id]["players"]) if room_id in self.game_manager.games else None
+        if members is None:
+            await self.send_text("❌ 房间不存在")
+            return False, "房间不存在", True
+        
+        # 仍存活的本局玩家不能观战，避免获取额外信息
+        user_id = str(self.message.message_info.user_info.user_id)
+        if user_id in members and user_id not in hub.out_players.get(room_id, ()):
+            await self.send_text("❌ 你仍在本局游戏中，出局后才能观战")
+            return False, "存活玩家不能观战", True
+        
+        hub.watch(user_id, room_id)
+        spoiler = "公开身份与夜晚行动" if hub.reveal_roles else "不公开身份"
+        await self.send_text(f"👀 开始观战 {room_id}，事件将延迟{hub.delay:.0f}秒私聊推送（{spoiler}）\n使用 /wwg unwatch 停止观战")
+        return True, f"观战 {room_id}", True
+    
+    async def _unwatch_room(self):
+        """停止观战"""
+        user_id = str(self.message.message_info.user_info.user_id)
+        room_id = SpectatorHub().unwatch(user_id)
+        if room_id is None:
+            await self.send_text("❌ 你没有在观战")
+            return False, "未在观战", True
+        
+        await self.send_text(f"✅ 已停止观战 {room_id}")
+        return True, "停止观战", True
+    
     async def _show_status(self):
         """显示房间状态"""
         user_id = self.message.message_info.user_info.user_id
@@ -1611,31 +4685,36 @@ class WerewolfGameCommand(BaseCommand):
             await self.send_text("❌ 你不在任何游戏中")
             return False, "用户不在游戏中", True
         
-        game = self.game_manager.games[room_id]
+        # 读取最近一次保存时发布的只读快照，不读取可能正在结算中的房间；状态未变化时直接复用缓存的渲染结果
+        snapshot = self.game_manager.get_read_snapshot(room_id)
+        if snapshot is None:
+            await self.send_text("❌ 房间状态暂不可用，请稍后再试")
+            return False, "房间快照缺失", True
+        status_text = self.game_manager.get_rendered(room_id, "status", lambda: self._render_status(snapshot))
         
-        # 构建状态信息
-        status_text = f"📊 房间状态 - {room_id}\n"
-        status_text += f"👤 房主: {self._get_qq_nickname(game['host'])}\n"
-        status_text += f"🎯 玩家: {len(game['players'])}/{game['settings']['player_count']}\n"
-        status_text += f"📝 游戏阶段: {self._get_phase_display_name(game['phase'])}\n\n"
+        await self.send_text(status_text)
+        return True, "显示房间状态", True
+    
+    def _render_status(self, snapshot: RoomReadSnapshot) -> str:
+        """渲染房间状态信息"""
+        lines = [
+            f"📊 房间状态 - {snapshot.room_id}\n",
+            f"👤 房主: {snapshot.host_name}\n",
+            f"🎯 玩家: {len(snapshot.players)}/{snapshot.player_count}\n",
+            f"📝 游戏阶段: {self._get_phase_display_name(snapshot.phase)}\n\n",
+            "👥 当前玩家:\n"
+        ]
         
         # 玩家列表 - 修复：使用档案中的昵称而不是QQ号前五位
-        status_text += "👥 当前玩家:\n"
-        for player in game["players"].values():
-            status_icon = "💚" if player["status"] == PlayerStatus.ALIVE.value else "💀"
-            role_display = "???" if game["phase"] in [GamePhase.SETUP.value, GamePhase.NIGHT.value, GamePhase.DAY.value] else ROLES[player["original_role"]]["name"]
-            # 使用玩家档案中的昵称
-            player_nickname = player['name']
-            status_text += f"  {player['number']}号 - {player_nickname} {status_icon}\n"
+        for number, name, status in snapshot.players:
+            status_icon = "💚" if status == PlayerStatus.ALIVE.value else "💀"
+            lines.append(f"  {number}号 - {name} {status_icon}\n")
         
-        status_text += "\n🎭 角色设置:\n"
-        for role_id, count in game["settings"]["roles"].items():
-            if count > 0:
-                role_name = ROLES[role_id]["name"]
-                status_text += f"  {role_name} ({role_id}): {count}个\n"
+        lines.append("\n🎭 角色设置:\n")
+        for role_id, count in snapshot.roles:
+            lines.append(f"  {ROLES[role_id]['name']} ({role_id}): {count}个\n")
         
-        await self.send_text(status_text)
-        return True, "显示房间状态", True
+        return "".join(lines)
     
     async def _handle_name_command(self, args: str):
         """处理昵称设置命令"""
@@ -1699,7 +4778,8 @@ class WerewolfGameCommand(BaseCommand):
         for room_id, game in self.game_manager.games.items():
             if user_id in game["players"] and game["phase"] != GamePhase.ENDED.value:
                 return True
-        return False
+        return any(user_id in stub.members and stub.phase != GamePhase.ENDED.value
+                   for stub in self.game_manager.paged_rooms.values())
 
     def _get_user_nickname(self, user_id: str) -> str:
         """获取用户昵称 - 从玩家档案中获取"""
@@ -1744,7 +4824,7 @@ class WerewolfGameCommand(BaseCommand):
                 return f"玩家{qq_number[:5]}"
                 
         except Exception as e:
-            print(f"获取QQ昵称失败 {qq_number}: {e}")
+            command_logger.warning("获取QQ昵称失败: %s", e, extra={"user": qq_number})
             # 出错时显示QQ号前五位
             return f"玩家{qq_number[:5]}"
 
@@ -1888,7 +4968,7 @@ class WerewolfGameCommand(BaseCommand):
             await self.send_text("❌ 只有房主可以开始游戏")
             return False, "非房主开始游戏", True
         
-        success = self.game_manager.start_game(room_id)
+        success = self.game_manager.start_game(room_id, self.seed_hint)
         
         if success:
             # 发送首夜开始消息到群聊
@@ -1901,42 +4981,9 @@ class WerewolfGameCommand(BaseCommand):
             
             # 私聊发送详细的角色信息给所有玩家
             for player_qq, player in game["players"].items():
-                role = player["role"]
-                role_info = ROLES[role]
-                
-                message = f"🎮 游戏开始！\n\n"
-                message += f"📍 房间号: {room_id}\n"
-                message += f"🎯 你的身份: {role_info['name']}\n"
-                message += f"🔢 你的号码: {player['number']}号\n\n"
-                message += f"📖 角色描述: {role_info['description']}\n\n"
-                
-                # 特殊角色的额外信息
-                if role_info["camp"] == Camp.WOLF and role != "hidden_wolf":
-                    # 显示狼队友信息
-                    wolf_teammates = []
-                    for p in game["players"].values():
-                        if (p["qq"] != player_qq and 
-                            ROLES[p["role"]]["camp"] == Camp.WOLF and 
-                            p["role"] != "hidden_wolf"):
-                            wolf_teammates.append(f"{p['number']}号 {p['name']}")
-                    
-                    if wolf_teammates:
-                        message += f"🐺 你的狼队友:\n"
-                        for teammate in wolf_teammates:
-                            message += f"  • {teammate}\n"
-                        message += "\n"
-                
-                if role_info["command"]:
-                    if role == "magician":
-                        message += f"📝 使用命令: /wwg {role_info['command']} <号码1> <号码2>\n"
-                        message += f"💡 示例: /wwg swap 3 5 （交换3号和5号）"
-                    elif role == "cupid":
-                        message += f"📝 使用命令: /wwg {role_info['command']} <号码1> <号码2>\n"
-                        message += f"💡 示例: /wwg choose 2 4 （选择2号和4号成为情侣）"
-                    else:
-                        message += f"📝 使用命令: /wwg {role_info['command']} <目标号码>\n"
-                        message += f"💡 示例: /wwg check 3 （查验3号玩家）"
-                
+                message = self.game_manager.get_rendered(
+                    room_id, f"role_card:{player_qq}",
+                    lambda: self._render_role_card(room_id, game, player))
                 await MessageSender.send_private_message(player_qq, message)
             
             return True, "游戏开始", True
@@ -1944,11 +4991,31 @@ class WerewolfGameCommand(BaseCommand):
             await self.send_text("❌ 开始游戏失败，玩家数量不足或角色分配错误")
             return False, "开始游戏失败", True
     
+    def _render_role_card(self, room_id: str, game: Dict[str, Any], player: Dict[str, Any]) -> str:
+        """渲染开局身份卡（基于预编译的角色模板）"""
+        role = player["role"]
+        
+        # 特殊角色的额外信息
+        teammates = ""
+        if ROLES[role]["camp"] == Camp.WOLF and role != "hidden_wolf":
+            # 显示狼队友信息
+            wolf_teammates = []
+            for p in game["players"].values():
+                if (p["qq"] != player["qq"] and 
+                    ROLES[p["role"]]["camp"] == Camp.WOLF and 
+                    p["role"] != "hidden_wolf"):
+                    wolf_teammates.append(f"  • {p['number']}号 {p['name']}\n")
+            
+            if wolf_teammates:
+                teammates = "🐺 你的狼队友:\n" + "".join(wolf_teammates) + "\n"
+        
+        return ROLE_CARD_TEMPLATES[role].format(room_id=room_id, number=player["number"], teammates=teammates)
+    
     async def _show_profile(self, args):
         """显示玩家档案"""
         target_qq = args.strip() if args else str(self.message.message_info.user_info.user_id)
         
-        profile = self.game_manager.player_profiles.get(target_qq)
+        profile = self.game_manager.get_profile_snapshot(target_qq)
         if not profile:
             await self.send_text("❌ 未找到该玩家的游戏档案")
             return False, "未找到玩家档案", True
@@ -1959,12 +5026,145 @@ class WerewolfGameCommand(BaseCommand):
             f"胜利: {profile['wins']} | 失败: {profile['losses']}\n"
             f"胜率: {profile['wins'] / profile['total_games'] * 100 if profile['total_games'] > 0 else 0:.1f}%\n"
             f"最近10场胜率: {profile['recent_win_rate'] * 100:.1f}%\n"
-            f"击杀数: {profile['kills']} | 票杀数: {profile['votes']}"
+            f"击杀数: {profile['kills']} | 票杀数: {profile['votes']}\n"
+            f"技术评分: {profile.get('rating', _rating_settings['initial']):.0f}（已评{profile.get('rated_games', 0)}局）"
+        )
+        
+        recent_games = list(iter_recent_games(profile))
+        if recent_games:
+            profile_text += "\n最近对局: " + "".join("✅" if g["won"] else "❌" for g in recent_games)
+        
+        # 阵营与角色战绩（按对局数从多到少）
+        camp_names = {
+            Camp.VILLAGE.value: "🏠 村庄",
+            Camp.WOLF.value: "🐺 狼人",
+            Camp.THIRD_PARTY.value: "🎭 第三方",
+            Camp.LOVER.value: "💕 情侣"
+        }
+        breakdowns = (
+            ("\n\n🏳️ 阵营战绩:", profile.get("camp_stats", {}), lambda key: camp_names.get(key, key)),
+            ("\n\n🎭 角色战绩:", profile.get("role_stats", {}), lambda key: ROLES[key]["name"] if key in ROLES else key)
         )
+        for title, stats, display_name in breakdowns:
+            if not stats:
+                continue
+            profile_text += title
+            for key, counter in sorted(stats.items(), key=lambda item: -item[1]["games"]):
+                profile_text += (
+                    f"\n  {display_name(key)}: {counter['games']}局 {counter['wins']}胜 "
+                    f"({counter['wins'] / counter['games'] * 100:.1f}%) 存活{counter['survived']}局"
+                )
         
         await self.send_text(profile_text)
         return True, "显示玩家档案", True
     
+    async def _show_rank(self, args: str):
+        """显示排行榜"""
+        parts = args.split()
+        metric = parts[0].lower() if parts else "wins"
+        if metric not in RANK_METRICS:
+            await self.send_text("❌ 未知的榜单，可选: " + " | ".join(RANK_METRICS))
+            return False, "未知的榜单", True
+        
+        # 作用域：默认全服，group 表示本群，也可直接指定群号
+        scope = RANK_GLOBAL_SCOPE
+        scope_name = "全服"
+        if len(parts) > 1:
+            if parts[1].lower() == "group":
+                group_info = self.message.message_info.group_info
+                if not group_info:
+                    await self.send_text("❌ 请在群聊中查看本群排行榜，或直接指定群号")
+                    return False, "不在群聊中", True
+                scope = str(group_info.group_id)
+                scope_name = "本群"
+            else:
+                scope = parts[1]
+                scope_name = f"群 {scope}"
+        
+        top_k = max(1, self.get_config("rank.top_k", 10))
+        min_games = max(1, self.get_config("rank.winrate_min_games", 5))
+        ranking = self.game_manager.get_leaderboard(metric, scope, top_k, min_games)
+        if not ranking:
+            hint = f"（胜率榜至少需要{min_games}局）" if metric == "winrate" else ""
+            await self.send_text(f"📭 {scope_name}暂无{RANK_METRICS[metric]}榜数据{hint}")
+            return True, "排行榜为空", True
+        
+        rank_text = f"🏆 {RANK_METRICS[metric]}排行榜 - {scope_name}"
+        for index, qq in enumerate(ranking, 1):
+            profile = self.game_manager.player_profiles[qq]
+            counter = get_rank_counter(profile, scope)
+            if metric == "winrate":
+                value = f"{counter['wins'] / counter['total_games'] * 100:.1f}% ({counter['total_games']}局)"
+            elif metric == "wins":
+                value = f"{counter['wins']}胜 ({counter['total_games']}局)"
+            elif metric == "kills":
+                value = f"{counter['kills']}次击杀"
+            else:
+                value = f"{counter['votes']}次票杀"
+            rank_text += f"\n{index}. {profile['name']} - {value}"
+        
+        await self.send_text(rank_text)
+        return True, "显示排行榜", True
+    
+    async def _show_balance_stats(self, args: str):
+        """显示角色平衡性统计"""
+        parts = args.split()
+        if not parts or parts[0] not in ("roles", "preset") or (parts[0] == "preset" and len(parts) < 2):
+            await self.send_text("❌ 格式: /wwg stats roles 或 /wwg stats preset <人数>")
+            return False, "参数错误", True
+        
+        player_count = None
+        if parts[0] == "preset":
+            try:
+                player_count = int(parts[1])
+            except ValueError:
+                await self.send_text("❌ 人数必须是数字")
+                return False, "人数无效", True
+        
+        # 只补读尚未统计的归档文件，其余直接在内存列上聚合
+        balance = self.game_manager.role_balance
+        await asyncio.get_running_loop().run_in_executor(None, balance.sync_archive)
+        
+        if player_count is None:
+            game_total = len(balance.games["winner"])
+            title = f"📈 角色平衡性统计（共{game_total}局）"
+        else:
+            winners = balance.winner_summary(player_count)
+            game_total = sum(winners)
+            title = f"📈 {player_count}人局统计（共{game_total}局）"
+        if game_total == 0:
+            await self.send_text("📭 暂无已结束的对局数据")
+            return True, "暂无统计数据", True
+        
+        stats_text = title
+        camp_names = {
+            Camp.VILLAGE.value: "🏠 村庄",
+            Camp.WOLF.value: "🐺 狼人",
+            Camp.THIRD_PARTY.value: "🎭 第三方",
+            Camp.LOVER.value: "💕 情侣"
+        }
+        if player_count is not None:
+            stats_text += "\n阵营胜率: " + " | ".join(
+                f"{camp_names[camp]} {wins / game_total * 100:.1f}%"
+                for camp, wins in zip(CAMP_ORDER, winners) if wins
+            )
+        
+        stats_text += "\n\n🎭 角色:"
+        summary = balance.role_summary(player_count)
+        for role, games, wins, known, first_night in sorted(summary, key=lambda row: -row[1]):
+            role_name = ROLES[role]["name"] if role in ROLES else role
+            stats_text += f"\n  {role_name}: 出场{games}次 胜率{wins / games * 100:.1f}%"
+            if known:
+                stats_text += f" 首夜死亡{first_night / known * 100:.1f}%"
+        
+        if player_count is not None:
+            stats_text += "\n\n💺 座位胜率:"
+            for seat, games, wins in balance.seat_summary(player_count):
+                stats_text += f"\n  {seat}号: {wins / games * 100:.1f}% ({games}局)"
+        
+        await self.send_text(stats_text)
+        return True, "显示平衡性统计", True
+    
     async def _show_archive(self, args):
         """显示对局记录"""
         if not args:
@@ -1972,7 +5172,7 @@ class WerewolfGameCommand(BaseCommand):
             return False, "缺少对局码", True
         
         game_code = args.strip()
-        game = self.game_manager.get_archived_game(game_code)
+        game = await self.game_manager.get_archived_game(game_code)
         
         if not game:
             await self.send_text("❌ 未找到该对局记录")
@@ -1984,15 +5184,186 @@ class WerewolfGameCommand(BaseCommand):
         archive_text += f"结束时间: {game['ended_time']}\n"
         archive_text += f"胜利阵营: {game['winner']}\n\n"
         archive_text += "玩家信息:\n"
-        
-        for player in game["players"].values():
-            role_name = ROLES[player["original_role"]]["name"]
-            status = "存活" if player["status"] == PlayerStatus.ALIVE.value else "死亡"
-            archive_text += f"{player['number']}号 {player['name']} - {role_name} ({status})\n"
+        archive_text += render_player_reveal(game)
         
         await self.send_text(archive_text)
         return True, "显示对局记录", True
     
+    def _is_admin(self) -> bool:
+        """检查发送者是否为插件管理员"""
+        user_id = str(self.message.message_info.user_info.user_id)
+        return user_id in [str(qq) for qq in self.get_config("plugin.admin_qqs", [])]
+    
+    async def _export_archive(self, args: str):
+        """导出归档对局为 NDJSON 文件（仅管理员）"""
+        if not self._is_admin():
+            await self.send_text("❌ 只有管理员可以导出对局记录")
+            return False, "非管理员导出", True
+        
+        # 解析 key=value 形式的过滤条件
+        filters = {}
+        for part in args.split():
+            key, _, value = part.partition("=")
+            if key not in ("group", "since", "until", "cursor") or not value:
+                await self.send_text("❌ 导出参数格式错误，格式: /wwg export [group=群号] [since=日期] [until=日期] [cursor=游标]")
+                return False, "导出参数错误", True
+            filters[key] = value
+        
+        try:
+            _parse_export_time(filters.get("since"))
+            _parse_export_time(filters.get("until"))
+        except ValueError:
+            await self.send_text("❌ 日期格式错误，请使用 YYYY-MM-DD 或 ISO 时间")
+            return False, "导出日期格式错误", True
+        
+        exports_dir = os.path.join(DATA_DIR, "exports")
+        os.makedirs(exports_dir, exist_ok=True)
+        file_path = os.path.join(exports_dir, f"archive-{datetime.datetime.now():%Y%m%d-%H%M%S}.ndjson")
+        
+        def write_export():
+            with open(file_path, 'w', encoding='utf-8') as f:
+                return export_archive_ndjson(f, filters.get("since"), filters.get("until"),
+                                             filters.get("group"), filters.get("cursor"))
+        
+        # 逐局读取写入，放到线程中执行以免阻塞消息处理
+        count, last_cursor = await asyncio.get_running_loop().run_in_executor(None, write_export)
+        
+        await self.send_text(
+            f"📤 已导出 {count} 局对局记录\n"
+            f"文件: {file_path}\n"
+            f"续传游标: {last_cursor or '无'}"
+        )
+        return True, f"导出 {count} 局对局", True
+    
+    async def _handle_profiler(self, args: str):
+        """开关命令剖析、查看与导出结果（仅管理员）"""
+        if not self._is_admin():
+            await self.send_text("❌ 只有管理员可以使用剖析功能")
+            return False, "非管理员剖析", True
+        
+        usage = ("❌ 格式: /wwg profiler on [cprofile|sample] [rate=比例] [room=房间号]\n"
+                 "/wwg profiler off | status | dump")
+        parts = args.split()
+        action = parts[0].lower() if parts else "status"
+        profiler = CommandProfiler()
+        
+        if action == "on":
+            mode = "cprofile"
+            rate = self.get_config("profiler.rate", 0.1)
+            room_id = None
+            for part in parts[1:]:
+                key, _, value = part.partition("=")
+                try:
+                    if key.lower() in PROFILER_MODES and not value:
+                        mode = key.lower()
+                    elif key == "rate" and value:
+                        rate = float(value)
+                    elif key == "room" and value:
+                        room_id = value
+                    else:
+                        raise ValueError(part)
+                except ValueError:
+                    await self.send_text(usage)
+                    return False, "剖析参数错误", True
+            if not 0 < rate <= 1:
+                await self.send_text("❌ 剖析比例需在 (0, 1] 之间")
+                return False, "剖析比例错误", True
+            
+            interval = max(1, self.get_config("profiler.sample_interval_ms", 5)) / 1000
+            profiler.enable(mode, rate, room_id, interval)
+            target = f"房间 {room_id} 的" if room_id else ""
+            await self.send_text(f"🔬 已开启 {mode} 剖析，{target}命令按 {rate:.0%} 比例采样\n"
+                                 f"使用 /wwg profiler dump 导出，/wwg profiler off 关闭并导出")
+            return True, f"开启剖析 {mode}", True
+        
+        if action == "status":
+            if not profiler.enabled:
+                await self.send_text("🔬 剖析未开启")
+                return True, "剖析状态", True
+            target = profiler.room_id or "全部房间"
+            text = (f"🔬 {profiler.mode} 剖析中（{target}，比例 {profiler.rate:.0%}），"
+                    f"已剖析 {profiler.profiled_count} 条命令，因并发跳过 {profiler.skipped} 条")
+            summary = profiler.summary()
+            await self.send_text(f"{text}\n{summary}" if summary else text)
+            return True, "剖析状态", True
+        
+        if action in ("dump", "off"):
+            if action == "off":
+                profiler.disable()
+            if not profiler.profiled_count:
+                await self.send_text("🔬 剖析已关闭，没有剖析结果" if action == "off" else "🔬 还没有剖析结果")
+                return True, "无剖析结果", True
+            paths = profiler.dump()
+            if paths:
+                text = f"🔬 已导出 {profiler.profiled_count} 条命令的剖析结果:\n" + "\n".join(paths)
+            else:
+                text = f"🔬 {profiler.profiled_count} 条命令均短于采样间隔，未采到调用栈"
+            await self.send_text(f"{text}\n{profiler.summary()}")
+            return True, "导出剖析结果", True
+        
+        await self.send_text(usage)
+        return False, "剖析参数错误", True
+    
+    async def _show_health(self):
+        """显示事件循环延迟、房间数、队列深度和最近的持久化错误（仅管理员）"""
+        if not self._is_admin():
+            await self.send_text("❌ 只有管理员可以查看运行状态")
+            return False, "非管理员查看状态", True
+        
+        monitor = LoopMonitor()
+        lines = ["🩺 运行状态"]
+        
+        lag = monitor.percentiles()
+        if lag:
+            lines.append(f"事件循环延迟({len(monitor.samples)}个样本): p50 {lag['p50']}ms  p95 {lag['p95']}ms  "
+                         f"p99 {lag['p99']}ms  最大 {lag['max']}ms")
+        else:
+            lines.append("事件循环延迟: 探针未运行")
+        
+        router = ShardRouter.get_active()
+        if router:
+            rooms = len(router.room_members)
+            players = len(router.user_rooms)
+            lines.append(f"房间: {rooms} 个（{len(router.workers)} 个分片进程），游戏中玩家 {players} 人")
+        else:
+            paged = self.game_manager.paged_rooms
+            playing = sum(len(game["players"]) for game in self.game_manager.games.values())
+            playing += sum(len(stub.members) for stub in paged.values())
+            lines.append(f"房间: {len(self.game_manager.games) + len(paged)} 个（{len(paged)} 个已换出到磁盘），"
+                         f"游戏中玩家 {playing} 人")
+        lines.append(f"匹配队列: {len(self.game_manager.lobby.tickets)} 人排队")
+        shed = AdmissionControl().shed
+        lines.append(f"已拒绝: 限流命令 {shed['rate_limited']} 条，超全局房间上限 {shed['room_cap']} 次，"
+                     f"超群房间上限 {shed['group_room_cap']} 次")
+        
+        io_executor = get_io_executor()
+        lines.append(f"文件I/O队列: {io_executor.pending_count()} 个待处理")
+        retention = ArchiveRetention()
+        if retention.task:
+            last_pass = retention.stats["last_pass"]
+            lines.append(f"归档汇总: 已并入 {retention.stats['folded']} 局，删除明细 {retention.stats['removed']} 个，"
+                         f"上次检查 {f'{datetime.datetime.fromtimestamp(last_pass):%m-%d %H:%M}' if last_pass else '尚未执行'}")
+        for name, stats in EventBus().stats().items():
+            lines.append(f"事件订阅 {name}: 排队 {stats['queued']}，积压 {stats['backlog']}，丢弃 {stats['dropped']}")
+        
+        errors = [io_executor.last_error] + (list(router.io_errors.values()) if router else [])
+        errors = [error for error in errors if error]
+        if errors:
+            error_time, path, message = max(errors)
+            lines.append(f"最近持久化错误: {datetime.datetime.fromtimestamp(error_time):%m-%d %H:%M:%S} "
+                         f"{os.path.basename(path)}: {message}")
+        else:
+            lines.append("最近持久化错误: 无")
+        
+        if monitor.slow_callbacks:
+            lines.append("最近的事件循环阻塞:")
+            for stall in list(monitor.slow_callbacks)[-3:]:
+                lines.append(f"  {datetime.datetime.fromtimestamp(stall['time']):%H:%M:%S} {stall['lag_ms']}ms "
+                             f"{stall['where']}（最近命令 {stall['command'] or '无'}）")
+        
+        await self.send_text("\n".join(lines))
+        return True, "显示运行状态", True
+    
     async def _handle_game_action(self, action: str, args: str):
         """处理游戏内行动命令"""
         user_id = str(self.message.message_info.user_info.user_id)
@@ -2020,6 +5391,30 @@ class WerewolfGameCommand(BaseCommand):
             await self.send_text("❌ 你已出局，无法执行行动")
             return False, "玩家已出局", True
         
+        # 房间自上次行动后没有任何变化时，完全相同的重复提交直接重发上次的回复
+        dedupe = CommandDedupeCache()
+        dedupe_key = (room_id, game["phase"], game["day_count"], action, " ".join(args.split()))
+        cached = dedupe.get(user_id, dedupe_key + (game.get("state_version", 0),))
+        if cached is not None:
+            replies, result = cached
+            for text in replies:
+                await self.send_text(text)
+            command_logger.debug("重复行动已短路", extra={"room": room_id, "phase": game["phase"],
+                                                        "command": f"/wwg {action}", "user": user_id})
+            return result
+        
+        self.reply_log = []
+        try:
+            result = await self._dispatch_game_action(game, player, action, args, room_id)
+        finally:
+            replies, self.reply_log = self.reply_log, None
+        if result[0]:
+            dedupe.put(user_id, dedupe_key + (game.get("state_version", 0),), replies, result)
+        return result
+    
+    async def _dispatch_game_action(self, game: Dict[str, Any], player: Dict[str, Any], action: str,
+                                    args: str, room_id: str) -> Tuple[bool, Optional[str], bool]:
+        """按当前阶段分发游戏内行动"""
         # 检查游戏阶段
         current_phase = game["phase"]
         
@@ -2061,7 +5456,7 @@ class WerewolfGameCommand(BaseCommand):
     
     async def _handle_night_action(self, game: Dict[str, Any], player: Dict[str, Any], action: str, args: str, room_id: str):
         """处理夜晚行动"""
-        role = player["role"]
+        role = get_acting_role(game, player)
         role_info = ROLES[role]
         
         # 检查角色是否有夜晚行动能力
@@ -2099,6 +5494,7 @@ class WerewolfGameCommand(BaseCommand):
                     
                     game["night_actions"]["witch_poison"] = args
                     player["has_acted"] = True
+                    self._publish_action(room_id, player, action, args)
                     self.game_manager.last_activity[room_id] = time.time()
                     self.game_manager._save_game_file(room_id)
                     
@@ -2146,17 +5542,28 @@ class WerewolfGameCommand(BaseCommand):
                         return False, f"{role}目标2无效", True
                     
                     game["night_actions"][self._get_role_action_key(role)] = f"{target1} {target2}"
+                    game.get("pending_night_actions", {}).pop(self._get_role_action_key(role), None)
                     
                 else:
                     target_num = int(args)
                     target_player = self._get_player_by_number(game, target_num)
-                    if not target_player or target_player["status"] != PlayerStatus.ALIVE.value:
+                    targets = ROLE_TARGETS.get(role, "alive")
+                    if targets == "dead":
+                        if not target_player or target_player["status"] == PlayerStatus.ALIVE.value:
+                            await self.send_text("❌ 只能选择已出局的玩家")
+                            return False, f"{role}目标无效", True
+                    elif not target_player or target_player["status"] != PlayerStatus.ALIVE.value:
                         await self.send_text("❌ 目标玩家不存在或已出局")
                         return False, f"{role}目标无效", True
+                    elif targets == "other" and target_player["qq"] == player["qq"]:
+                        await self.send_text("❌ 不能选择自己")
+                        return False, f"{role}目标无效", True
                     
                     game["night_actions"][self._get_role_action_key(role)] = args
+                    game.get("pending_night_actions", {}).pop(self._get_role_action_key(role), None)
                 
                 player["has_acted"] = True
+                self._publish_action(room_id, player, action, args)
                 self.game_manager.last_activity[room_id] = time.time()
                 self.game_manager._save_game_file(room_id)
                 
@@ -2197,6 +5604,7 @@ class WerewolfGameCommand(BaseCommand):
                 return False, "女巫解药目标无效", True
             
             game["night_actions"]["witch_save"] = args
+            self._publish_action(room_id, player, "save", args)
             self.game_manager.last_activity[room_id] = time.time()
             self.game_manager._save_game_file(room_id)
             
@@ -2215,6 +5623,7 @@ class WerewolfGameCommand(BaseCommand):
             return False, "非女巫跳过解药", True
         
         game["night_actions"]["witch_skip"] = "true"
+        self._publish_action(room_id, player, "skip", "")
         self.game_manager.last_activity[room_id] = time.time()
         self.game_manager._save_game_file(room_id)
         
@@ -2245,6 +5654,8 @@ class WerewolfGameCommand(BaseCommand):
                 # 第一次投票
                 game["votes"][player["qq"]] = vote_target
                 await self.send_text(f"✅ 已投票给 {vote_target} 号玩家")
+            EventBus().publish(GameEventType.VOTE, room_id, voter=player["qq"], voter_number=player["number"],
+                               target_number=vote_target, previous=previous_vote)
             
             # 计算投票进度
             alive_players = [p for p in game["players"].values() if p["status"] == PlayerStatus.ALIVE.value]
@@ -2293,6 +5704,7 @@ class WerewolfGameCommand(BaseCommand):
             target_player["killer"] = player["qq"]
             
             game["white_wolf_exploded"] = True
+            self._publish_action(room_id, player, "explode", args)
             
             await self._send_group_message(game, 
                                          f"💥 白狼王 {player['number']} 号自爆，带走了 {target_num} 号玩家！")
@@ -2303,6 +5715,7 @@ class WerewolfGameCommand(BaseCommand):
             game["phase_start_time"] = time.time()
             game["votes"] = {}
             game["night_actions"] = {}
+            self.game_manager.prepare_night_actions(game)
             self.game_manager.last_activity[room_id] = time.time()
             self.game_manager._save_game_file(room_id)
             
@@ -2335,6 +5748,7 @@ class WerewolfGameCommand(BaseCommand):
             target_player["status"] = PlayerStatus.DEAD.value
             target_player["death_reason"] = DeathReason.HUNTER_SHOOT.value
             target_player["killer"] = player["qq"]
+            self._publish_action(room_id, player, "shoot", args)
             
             await self._send_group_message(game, 
                                          f"🔫 猎人 {player['number']} 号开枪带走了 {target_num} 号玩家！")
@@ -2345,6 +5759,7 @@ class WerewolfGameCommand(BaseCommand):
             game["phase_start_time"] = time.time()
             game["votes"] = {}
             game["night_actions"] = {}
+            self.game_manager.prepare_night_actions(game)
             self.game_manager.last_activity[room_id] = time.time()
             self.game_manager._save_game_file(room_id)
             
@@ -2355,12 +5770,14 @@ class WerewolfGameCommand(BaseCommand):
             await self.send_text("❌ 开枪目标必须是数字")
             return False, "开枪目标非数字", True
     
+    def _publish_action(self, room_id: str, player: Dict[str, Any], action: str, args: str):
+        """发布行动提交事件（含身份与目标，是否展示由订阅者决定）"""
+        EventBus().publish(GameEventType.ACTION_SUBMITTED, room_id, player=player["qq"], number=player["number"],
+                           role=player["role"], action=action, args=args)
+    
     def _find_user_game(self, user_id: str) -> Optional[str]:
         """查找用户所在的游戏房间"""
-        for room_id, game in self.game_manager.games.items():
-            if user_id in game["players"]:
-                return room_id
-        return None
+        return self.game_manager.find_room_of(user_id)
     
     def _get_player_by_number(self, game: Dict[str, Any], number: int) -> Optional[Dict[str, Any]]:
         """根据号码获取玩家"""
@@ -2371,17 +5788,7 @@ class WerewolfGameCommand(BaseCommand):
     
     def _get_role_action_key(self, role: str) -> str:
         """获取角色行动键"""
-        action_keys = {
-            "seer": "seer",
-            "witch": "witch_poison",
-            "wolf": "wolf_kill",
-            "guard": "guard",
-            "magician": "magician",
-            "spiritualist": "spiritualist",
-            "cupid": "cupid",
-            "painter": "painter"
-        }
-        return action_keys.get(role, "")
+        return NIGHT_ACTION_KEYS.get(role, "")
     
     async def _send_private_message(self, game: Dict[str, Any], qq: str, message: str):
         """发送私聊消息 - 使用正确的API"""
@@ -2396,6 +5803,379 @@ class WerewolfGameCommand(BaseCommand):
         message = f"🌙 第 {game['day_count']} 夜开始！请有夜晚行动能力的玩家使用相应命令行动。"
         await self._send_group_message(game, message)
 
+# ==================== 房间分片 ====================
+# 不依赖房间状态、始终在主进程执行的子命令
+SHARD_LOCAL_SUBCOMMANDS = {"", "profile", "archive", "rank", "stats", "queue", "leave", "watch", "unwatch",
+                           "name", "test_private", "export", "profiler", "health"}
+
+def get_room_shard(room_id: str, shard_count: int) -> int:
+    """按房间号哈希分配分片（crc32 在各进程间稳定）"""
+    return zlib.crc32(room_id.encode("utf-8")) % shard_count
+
+def build_routed_message(user_id: str, group_id: Optional[str]) -> SimpleNamespace:
+    """构造转发命令所需的最小消息对象（仅包含命令处理用到的字段）"""
+    return SimpleNamespace(message_info=SimpleNamespace(
+        user_info=SimpleNamespace(user_id=user_id),
+        group_info=SimpleNamespace(group_id=group_id) if group_id else None
+    ))
+
+class CapturedWerewolfCommand(WerewolfGameCommand):
+    """回复写入 MessageSender.outbox 而不直接发送的命令（分片进程与基准测试使用）"""
+
+    async def send_text(self, text: str, *args, **kwargs) -> bool:
+        if self.reply_log is not None:
+            self.reply_log.append(text)
+        MessageSender.outbox.append(("reply", "", text))
+        return True
+
+async def _handle_shard_request(game_manager: WerewolfGameManager, game_processor: GameLogicProcessor,
+                                request: Dict[str, Any], plugin_config: Dict[str, Any]) -> Dict[str, Any]:
+    """在分片进程中处理一个请求"""
+    MessageSender.outbox = []
+    EventBus().capture = []
+    rooms_before = game_manager.room_ids()
+    result = None
+    profile = None
+    io_error = None
+    handoff = None
+    touched_rooms = set()
+
+    # 主进程是玩家档案的权威来源，执行前同步相关档案
+    game_manager.player_profiles.update(request.get("profiles", {}))
+
+    if request["type"] == "command":
+        command = CapturedWerewolfCommand(
+            build_routed_message(request["user_id"], request["group_id"]), plugin_config)
+        command.set_matched_groups(request["matched_groups"])
+        command.room_id_hint = request["room_id_hint"]
+        command.seed_hint = request.get("seed_hint")
+        session = ProfileSession(*request["profile"]) if request.get("profile") else None
+        if session and session.start():
+            try:
+                result = await command.execute()
+            finally:
+                profile = session.stop()
+        else:
+            result = await command.execute()
+
+        room_id = command._find_user_game(request["user_id"])
+        if room_id:
+            touched_rooms.add(room_id)
+
+    elif request["type"] == "form_room":
+        game_manager.create_lobby_room(request["room_id"], request["group_id"], request["players"])
+        touched_rooms.add(request["room_id"])
+
+    elif request["type"] == "tick":
+        await game_manager.cleanup_inactive_games()
+        if request.get("page_idle"):
+            game_manager.page_out_idle_rooms(request["page_idle"])
+        for room_id in list(game_manager.games.keys()):
+            await game_processor.remind_pending_night_actions(room_id, request["reminder_delay"])
+        io_error = get_io_executor().last_error
+
+    elif request["type"] == "drain":
+        # 插件重载前：写出全部房间并等待落盘
+        handoff = game_manager.drain_rooms()
+        get_io_executor().flush(10)
+
+    elif request["type"] == "restore":
+        await game_manager.restore_rooms(request["rooms"], request["preload_within"])
+
+    # 变化的房间：成员列表，None 表示房间已销毁或归档
+    rooms_after = game_manager.room_ids()
+    touched_rooms |= rooms_after - rooms_before
+    rooms = {room_id: None for room_id in rooms_before - rooms_after}
+    for room_id in touched_rooms:
+        stub = game_manager.paged_rooms.get(room_id)
+        rooms[room_id] = list(stub.members) if stub else list(game_manager.games[room_id]["players"].keys())
+
+    unsaved = game_manager.unsaved_profiles
+    game_manager.unsaved_profiles = set()
+    profile_qqs = set(request.get("profiles", {}).keys()) | unsaved
+    for members in rooms.values():
+        profile_qqs.update(members or [])
+    profiles = {qq: game_manager.player_profiles[qq] for qq in profile_qqs if qq in game_manager.player_profiles}
+
+    outbox = MessageSender.outbox
+    MessageSender.outbox = []
+    events = EventBus().capture
+    EventBus().capture = []
+    return {"result": result, "outbox": outbox, "rooms": rooms, "profiles": profiles,
+            "unsaved_profiles": sorted(unsaved & profiles.keys()), "events": events,
+            "profile": profile, "io_error": io_error, "handoff": handoff}
+
+def _shard_worker_main(conn, data_dir: str, plugin_config: Dict[str, Any]):
+    """分片进程入口：独占所分配房间的游戏状态，逐个处理主进程转发的请求"""
+    global DATA_DIR
+    DATA_DIR = data_dir
+    ShardRouter._instance = None
+    CommandProfiler._instance = None
+    AdmissionControl._instance = None
+    CommandTraceRecorder._instance = None
+    MessageSender.outbox = []
+    # 父进程的日志写线程不会随 fork 复制，重新启动本进程的写线程
+    configure_logging(**_log_settings)
+
+    game_manager = WerewolfGameManager()
+    game_manager.defer_profile_saves = True
+    game_processor = GameLogicProcessor(game_manager)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+
+        try:
+            response = loop.run_until_complete(
+                _handle_shard_request(game_manager, game_processor, request, plugin_config))
+        except Exception as e:
+            shard_logger.exception("分片进程处理 %s 请求失败: %s", request.get("type"), e)
+            response = {"result": (False, f"命令执行出错: {str(e)}", True),
+                        "outbox": [("reply", "", f"❌ 命令执行出错: {str(e)}")],
+                        "rooms": {}, "profiles": {}}
+        conn.send(response)
+
+    loop.close()
+
+class ShardRouter:
+    """分片路由器：房间按房间号哈希分配到本地工作进程，插件进程只负责转发命令和消息"""
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.workers = []
+            cls._instance.user_rooms = {}
+            cls._instance.room_members = {}
+            # 各分片进程最近一次文件操作错误（随 tick 响应更新）
+            cls._instance.io_errors = {}
+            cls._instance.room_groups = {}  # 房间号 -> 群号，用于按群限制房间数
+            cls._instance.game_manager = WerewolfGameManager()
+        return cls._instance
+
+    @classmethod
+    def get_active(cls) -> Optional["ShardRouter"]:
+        """获取已启动的路由器，未启用分片时返回None"""
+        if cls._instance is not None and cls._instance.workers:
+            return cls._instance
+        return None
+
+    def start(self, worker_count: int, plugin_config: Dict[str, Any]):
+        """启动分片工作进程"""
+        if self.workers:
+            return
+
+        # 优先 fork，避免 spawn 时按模块名重新导入插件
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+
+        for index in range(worker_count):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_shard_worker_main,
+                                      args=(child_conn, DATA_DIR, plugin_config),
+                                      name=f"wwg-shard-{index}", daemon=True)
+            process.start()
+            child_conn.close()
+            self.workers.append({"process": process, "conn": parent_conn, "lock": asyncio.Lock()})
+
+    def stop(self):
+        """停止所有分片工作进程"""
+        for worker in self.workers:
+            try:
+                worker["conn"].send(None)
+            except Exception:
+                pass
+        for worker in self.workers:
+            worker["process"].join(timeout=5)
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+            worker["conn"].close()
+
+        self.workers = []
+        self.user_rooms.clear()
+        self.room_members.clear()
+        self.io_errors.clear()
+        self.room_groups.clear()
+
+    async def _request(self, shard: int, request: Dict[str, Any]) -> Dict[str, Any]:
+        """向分片发送请求并等待响应（管道读写放到线程中，不阻塞事件循环）"""
+        worker = self.workers[shard]
+        async with worker["lock"]:
+            def roundtrip():
+                worker["conn"].send(request)
+                return worker["conn"].recv()
+            response = await asyncio.get_running_loop().run_in_executor(None, roundtrip)
+
+        self._apply_response(response)
+        return response
+
+    def _apply_response(self, response: Dict[str, Any]):
+        """根据分片响应更新玩家-房间索引和玩家档案"""
+        for room_id, members in response["rooms"].items():
+            for player_qq in self.room_members.pop(room_id, []):
+                if self.user_rooms.get(player_qq) == room_id:
+                    del self.user_rooms[player_qq]
+            if members is not None:
+                self.room_members[room_id] = members
+                for player_qq in members:
+                    self.user_rooms[player_qq] = room_id
+            else:
+                self.room_groups.pop(room_id, None)
+
+        self.game_manager.player_profiles.update(response["profiles"])
+        unsaved = set(response.get("unsaved_profiles", []))
+        for qq in response["profiles"]:
+            if qq in unsaved:
+                # 分片不写档案文件，由主进程保存分片改动过的档案
+                self.game_manager._save_profile(qq)
+            else:
+                # 主进程的旧快照作废，改读整体替换后的档案
+                self.game_manager.profile_snapshots.pop(qq, None)
+            self.game_manager.update_leaderboards(qq)
+
+        # 分片中产生的游戏事件在主进程发布给订阅者
+        bus = EventBus()
+        for event_type, room_id, data, timestamp in response.get("events", []):
+            bus.publish_event(GameEvent(GameEventType(event_type), room_id, data, timestamp))
+
+    async def _relay(self, command: Optional[BaseCommand], outbox: List[Tuple[str, str, str]]):
+        """按原顺序转发分片产生的回复和消息"""
+        for kind, target, text in outbox:
+            if kind == "reply":
+                if command is not None:
+                    await command.send_text(text)
+            elif kind == "private":
+                await MessageSender.send_private_message(target, text)
+            else:
+                await MessageSender.send_group_message(target, text)
+
+    async def forward(self, command: "WerewolfGameCommand", subcommand: str, args: str,
+                      profile_mode: Optional[str] = None) -> Optional[Tuple[bool, Optional[str], bool]]:
+        """转发命令到房间所在分片；无法确定房间时返回None，由本进程直接处理
+
+        profile_mode 不为空时由分片进程剖析该命令，结果带回主进程聚合。
+        """
+        user_id = str(command.message.message_info.user_info.user_id)
+        group_info = command.message.message_info.group_info
+        group_id = str(group_info.group_id) if group_info else None
+
+        room_id_hint = None
+        if subcommand in ("host", "join"):
+            # 未完成游戏的检查需要全局视图，在主进程完成
+            if user_id in self.user_rooms:
+                await command.send_text("❌ 你已有未完成的游戏，请先完成当前游戏或销毁房间")
+                return False, "玩家有未完成游戏", True
+
+            if subcommand == "host":
+                if not group_info:
+                    return None
+                room_id = room_id_hint = command.room_id_hint or generate_room_id()
+                while room_id in self.room_members:
+                    room_id = room_id_hint = f"WWG{random.randint(0, 999999):06d}"
+            else:
+                room_id = args.strip()
+        else:
+            room_id = self.user_rooms.get(user_id)
+
+        if not room_id:
+            return None
+
+        # 发送者与房间成员的最新档案随请求一起下发
+        profile_qqs = set(self.room_members.get(room_id, [])) | {user_id}
+        profiles = {qq: self.game_manager.player_profiles[qq]
+                    for qq in profile_qqs if qq in self.game_manager.player_profiles}
+
+        response = await self._request(get_room_shard(room_id, len(self.workers)), {
+            "type": "command",
+            "user_id": user_id,
+            "group_id": group_id,
+            "matched_groups": dict(command.matched_groups or {}),
+            "room_id_hint": room_id_hint,
+            "seed_hint": command.seed_hint,
+            "profiles": profiles,
+            "profile": (profile_mode, CommandProfiler().interval) if profile_mode else None
+        })
+
+        if profile_mode:
+            CommandProfiler().record(f"/wwg {subcommand}", response.get("profile"))
+        if room_id_hint and room_id in self.room_members:
+            self.room_groups[room_id] = group_id
+        await self._relay(command, response["outbox"])
+        return response["result"]
+
+    async def form_room(self, room_id: str, group_id: str, players: List[Tuple[str, str]]):
+        """在房间所属分片中用匹配队列的玩家建房"""
+        profiles = {qq: self.game_manager.player_profiles[qq]
+                    for qq, _ in players if qq in self.game_manager.player_profiles}
+        response = await self._request(get_room_shard(room_id, len(self.workers)), {
+            "type": "form_room",
+            "room_id": room_id,
+            "group_id": group_id,
+            "players": players,
+            "profiles": profiles
+        })
+        if room_id in self.room_members:
+            self.room_groups[room_id] = str(group_id)
+        await self._relay(None, response["outbox"])
+
+    async def tick(self, reminder_delay: float, page_idle: float = 0):
+        """让各分片执行不活跃清理、夜晚提醒和空闲房间换出"""
+        for shard in range(len(self.workers)):
+            response = await self._request(shard, {"type": "tick", "reminder_delay": reminder_delay,
+                                                   "page_idle": page_idle})
+            self.io_errors[shard] = response.get("io_error")
+            await self._relay(None, response["outbox"])
+
+    async def drain(self) -> Dict[str, Dict[str, Any]]:
+        """让各分片写出全部房间并返回调度信息（插件重载前调用）"""
+        responses = await asyncio.gather(*(self._request(shard, {"type": "drain"})
+                                           for shard in range(len(self.workers))))
+        rooms = {}
+        for response in responses:
+            rooms.update(response.get("handoff") or {})
+        return rooms
+
+    async def restore(self, rooms: Dict[str, Dict[str, Any]], preload_within: float):
+        """把交接的房间按房间号分配回各分片，响应中的成员列表会重建玩家-房间索引"""
+        by_shard: Dict[int, Dict[str, Dict[str, Any]]] = {}
+        for room_id, info in rooms.items():
+            by_shard.setdefault(get_room_shard(room_id, len(self.workers)), {})[room_id] = info
+        await asyncio.gather(*(self._request(shard, {"type": "restore", "rooms": shard_rooms,
+                                                     "preload_within": preload_within})
+                               for shard, shard_rooms in by_shard.items()))
+        for room_id, info in rooms.items():
+            if room_id in self.room_members and info["group_id"]:
+                self.room_groups[room_id] = str(info["group_id"])
+
+# ==================== 重载交接 ====================
+# 插件禁用时写入，下次启用时读取并删除
+HANDOFF_FILE = "handoff.json"
+
+def write_handoff(state: Dict[str, Any]):
+    """提交交接文件写入（与房间快照走同一 I/O 队列，由调用方 flush）"""
+    state["saved_time"] = time.time()
+    data = json.dumps(state, ensure_ascii=False, separators=(",", ":"),
+                      default=_encode_snapshot_value).encode("utf-8")
+    get_io_executor().write(os.path.join(DATA_DIR, HANDOFF_FILE), data)
+
+async def read_handoff() -> Optional[Dict[str, Any]]:
+    """读取交接文件，不存在或损坏时返回None"""
+    path = os.path.join(DATA_DIR, HANDOFF_FILE)
+    try:
+        data = await asyncio.wrap_future(get_io_executor().read(path))
+        if data is None:
+            return None
+        return json.loads(data.decode("utf-8"), object_hook=_decode_snapshot_object)
+    except Exception as e:
+        storage_logger.error("读取交接文件失败: %s", e, extra={"path": path})
+        return None
+
 # ==================== 主插件类 ====================
 @register_plugin
 class WerewolfGamePlugin(BasePlugin):
@@ -2412,50 +6192,769 @@ class WerewolfGamePlugin(BasePlugin):
     
     config_section_descriptions = {
         "plugin": "插件基础配置",
-        "game": "游戏设置"
+        "game": "游戏设置",
+        "sharding": "房间分片（多进程）设置",
+        "storage": "存储设置",
+        "rank": "排行榜设置",
+        "rating": "技术评分设置",
+        "lobby": "匹配队列设置",
+        "spectator": "观战设置",
+        "profiler": "性能剖析设置",
+        "logging": "日志设置",
+        "monitor": "事件循环监控设置",
+        "paging": "空闲房间换出设置",
+        "admission": "限流与房间上限设置",
+        "dedupe": "重复命令去重设置",
+        "trace": "命令录制设置",
+        "custom_roles": "自定义角色与人数预设",
+        "retention": "归档保留设置"
     }
     
     config_schema = {
         "plugin": {
             "enabled": ConfigField(type=bool, default=True, description="是否启用插件"),
             "max_players": ConfigField(type=int, default=18, description="最大玩家数"),
-            "min_players": ConfigField(type=int, default=6, description="最小玩家数")
+            "min_players": ConfigField(type=int, default=6, description="最小玩家数"),
+            "admin_qqs": ConfigField(type=list, default=[], description="管理员QQ号列表")
         },
         "game": {
             "night_duration": ConfigField(type=int, default=300, description="夜晚持续时间(秒)"),
             "day_duration": ConfigField(type=int, default=300, description="白天持续时间(秒)"),
             "inactive_timeout": ConfigField(type=int, default=1200, description="不活动超时时间(秒)")
+        },
+        "sharding": {
+            "enabled": ConfigField(type=bool, default=False, description="是否将房间按房间号分配到多个工作进程"),
+            "workers": ConfigField(type=int, default=2, description="工作进程数")
+        },
+        "storage": {
+            "io_threads": ConfigField(type=int, default=4, description="文件I/O线程数"),
+            "fsync": ConfigField(type=bool, default=True, description="写入后是否fsync落盘")
+        },
+        "rank": {
+            "top_k": ConfigField(type=int, default=10, description="排行榜显示人数"),
+            "winrate_min_games": ConfigField(type=int, default=5, description="上胜率榜所需的最少对局数")
+        },
+        "rating": {
+            "k_factor": ConfigField(type=float, default=24.0, description="每局评分变化幅度(K值)"),
+            "initial": ConfigField(type=float, default=1500.0, description="新玩家初始评分")
+        },
+        "lobby": {
+            "room_size": ConfigField(type=int, default=9, description="匹配队列满多少人自动建房(6-18)"),
+            "max_wait": ConfigField(type=int, default=300, description="排队超过该秒数且人数不少于最小玩家数时，以现有人数建房(0为不启用)")
+        },
+        "spectator": {
+            "enabled": ConfigField(type=bool, default=True, description="是否启用观战"),
+            "delay": ConfigField(type=int, default=60, description="观战推送延迟(秒)"),
+            "interval": ConfigField(type=int, default=5, description="观战批量推送周期(秒)"),
+            "reveal_roles": ConfigField(type=bool, default=False, description="是否向观战者公开身份与夜晚行动")
+        },
+        "profiler": {
+            "rate": ConfigField(type=float, default=0.1, description="开启剖析时默认剖析的命令比例(0-1]"),
+            "sample_interval_ms": ConfigField(type=int, default=5, description="sample 模式的采样间隔(毫秒)")
+        },
+        "logging": {
+            "level": ConfigField(type=str, default="INFO", description="默认日志级别(DEBUG/INFO/WARNING/ERROR)"),
+            "levels": ConfigField(type=list, default=[], description="按子系统设置级别，如 [\"message=DEBUG\", \"storage=WARNING\"]，"
+                                  "子系统: message/storage/game/command/events/spectator/shard/cleanup/monitor"),
+            "file": ConfigField(type=str, default="", description="日志文件路径(相对插件目录)，留空输出到标准输出")
+        },
+        "monitor": {
+            "enabled": ConfigField(type=bool, default=True, description="是否启用事件循环延迟探针"),
+            "interval": ConfigField(type=float, default=0.5, description="探针间隔(秒)"),
+            "slow_threshold_ms": ConfigField(type=int, default=200, description="事件循环被占用超过该毫秒数时记录正在执行的函数"),
+            "window": ConfigField(type=int, default=600, description="计算延迟分位数使用的最近样本数")
+        },
+        "paging": {
+            "idle_seconds": ConfigField(type=int, default=600, description="房间无状态变化且无命令访问超过该秒数后换出到磁盘，下次有命令时自动换入(0为不换出)")
+        },
+        "admission": {
+            "user_rate": ConfigField(type=int, default=30, description="每名用户每分钟可执行的命令数(0为不限流)"),
+            "user_burst": ConfigField(type=int, default=8, description="每名用户可连续执行的命令数"),
+            "max_rooms": ConfigField(type=int, default=200, description="同时存在的房间数上限(0为不限)"),
+            "max_rooms_per_group": ConfigField(type=int, default=5, description="每个群同时存在的房间数上限(0为不限)")
+        },
+        "dedupe": {
+            "ttl": ConfigField(type=int, default=30, description="同一阶段内重复提交相同行动时直接返回上次回复的有效期(秒，0为不去重)")
+        },
+        "trace": {
+            "enabled": ConfigField(type=bool, default=False, description="是否把每条命令录制到 traces/ 目录，供命令行工具 replay 回放")
+        },
+        "custom_roles": {
+            "roles": ConfigField(type=list, default=[], description="自定义角色列表，每项为 {id, name, camp, action, command, targets, priority, check_mask, reveal, description}"),
+            "presets": ConfigField(type=list, default=[], description="人数预设列表，每项为 {size, roles = {角色代号 = 数量}}，覆盖匹配队列自动建房使用的默认配置")
+        },
+        "retention": {
+            "max_age_days": ConfigField(type=int, default=0, description="完成超过该天数的对局并入 games/rollups/ 下的月度汇总并删除明细(0为永久保留明细)"),
+            "batch_size": ConfigField(type=int, default=200, description="每批并入的对局数"),
+            "interval": ConfigField(type=int, default=3600, description="检查过期对局的间隔(秒)")
         }
     }
     
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        log_file = self.get_config("logging.file", "")
+        configure_logging(self.get_config("logging.level", "INFO"), self.get_config("logging.levels", []),
+                          os.path.join(DATA_DIR, log_file) if log_file else "")
+        configure_io_executor(max(1, self.get_config("storage.io_threads", 4)),
+                              self.get_config("storage.fsync", True))
+        configure_rating(self.get_config("rating.k_factor", 24.0), self.get_config("rating.initial", 1500.0))
+        CommandDedupeCache().ttl = max(0, self.get_config("dedupe.ttl", 30))
+        for error in register_custom_roles(self.get_config("custom_roles.roles", []),
+                                           self.get_config("custom_roles.presets", [])):
+            game_logger.warning("自定义角色配置已跳过: %s", error)
+        AdmissionControl().configure(self.get_config("admission.user_rate", 30),
+                                     self.get_config("admission.user_burst", 8),
+                                     self.get_config("admission.max_rooms", 200),
+                                     self.get_config("admission.max_rooms_per_group", 5))
         self.game_manager = WerewolfGameManager()
+        self.game_processor = GameLogicProcessor(self.game_manager)
         self.cleanup_task = None
     
     async def on_enable(self):
         """插件启用时"""
+        if self.get_config("sharding.enabled", False):
+            ShardRouter().start(max(1, self.get_config("sharding.workers", 2)), self.config)
+        if self.get_config("spectator.enabled", True):
+            SpectatorHub().start(max(0, self.get_config("spectator.delay", 60)),
+                                 max(1, self.get_config("spectator.interval", 5)),
+                                 self.get_config("spectator.reveal_roles", False))
+        if self.get_config("monitor.enabled", True):
+            LoopMonitor().start(max(0.05, self.get_config("monitor.interval", 0.5)),
+                                max(10, self.get_config("monitor.slow_threshold_ms", 200)) / 1000,
+                                self.get_config("monitor.window", 600))
+        if self.get_config("trace.enabled", False):
+            CommandTraceRecorder().start(os.path.join(DATA_DIR, "traces"))
+        if self.get_config("retention.max_age_days", 0) > 0:
+            ArchiveRetention().start(self.get_config("retention.max_age_days", 0),
+                                     self.get_config("retention.batch_size", 200),
+                                     max(60, self.get_config("retention.interval", 3600)))
+        self.game_manager.draining = False
+        await self._restore_handoff()
         self.cleanup_task = asyncio.create_task(self._cleanup_loop())
     
     async def on_disable(self):
-        """插件禁用时"""
+        """插件禁用时：停止接受新房间，写出全部房间并把调度时间、排队和待推送消息交接给下次启用"""
+        self.game_manager.draining = True
         if self.cleanup_task:
             self.cleanup_task.cancel()
+        handoff = {"spectators": SpectatorHub().export_state(), "lobby": self.game_manager.lobby.export()}
+        # 单例在同一进程内重新启用时仍在，交接出去的内容清空，否则恢复时会叠加一份
+        self.game_manager.lobby = MatchmakingLobby()
+        SpectatorHub().clear()
+        SpectatorHub().stop()
+        LoopMonitor().stop()
+        CommandTraceRecorder().stop()
+        ArchiveRetention().stop()
+        router = ShardRouter.get_active()
+        if router:
+            handoff["rooms"] = await router.drain()
+            router.stop()
+        else:
+            handoff["rooms"] = self.game_manager.drain_rooms()
+        write_handoff(handoff)
+        
+        # 等待排队中的文件写入完成
+        await asyncio.get_running_loop().run_in_executor(None, get_io_executor().flush, 10)
+        cleanup_logger.info("已交接 %d 个房间、%d 名排队玩家", len(handoff["rooms"]),
+                            sum(len(players) for players in handoff["lobby"].values()))
+    
+    async def _restore_handoff(self):
+        """恢复上次禁用时交接的房间、排队和观战；房间先登记为换出状态，只换入近期活跃的房间"""
+        handoff = await read_handoff()
+        if handoff is None:
+            return
+        start = time.perf_counter()
+        
+        # 不换出时全部换入
+        preload_within = self.get_config("paging.idle_seconds", 600) or float("inf")
+        rooms = handoff.get("rooms", {})
+        router = ShardRouter.get_active()
+        if router:
+            await router.restore(rooms, preload_within)
+        else:
+            await self.game_manager.restore_rooms(rooms, preload_within)
+        
+        for group_id, players in handoff.get("lobby", {}).items():
+            self.game_manager.lobby.restore(group_id, [tuple(player) for player in players])
+        if self.get_config("spectator.enabled", True):
+            SpectatorHub().restore_state(handoff.get("spectators", {}))
+        
+        get_io_executor().remove(os.path.join(DATA_DIR, HANDOFF_FILE))
+        cleanup_logger.info("已恢复交接的 %d 个房间", len(rooms),
+                            extra={"latency_ms": round((time.perf_counter() - start) * 1000, 1)})
     
     async def _cleanup_loop(self):
         """清理循环"""
         while True:
             try:
-                self.game_manager.cleanup_inactive_games()
+                # 夜晚过半仍未行动的玩家私聊提醒
+                reminder_delay = self.get_config("game.night_duration", 300) / 2
+                
+                # 空闲超过该时间的房间换出到磁盘（需晚于夜晚提醒，0 为不换出）
+                page_idle = self.get_config("paging.idle_seconds", 600)
+                if page_idle > 0:
+                    page_idle = max(page_idle, reminder_delay + 60)
+                
+                router = ShardRouter.get_active()
+                if router:
+                    await router.tick(reminder_delay, page_idle)
+                else:
+                    await self.game_manager.cleanup_inactive_games()
+                    for room_id in list(self.game_manager.games.keys()):
+                        await self.game_processor.remind_pending_night_actions(room_id, reminder_delay)
+                    if page_idle > 0:
+                        self.game_manager.page_out_idle_rooms(page_idle)
+                
+                AdmissionControl().prune()
+                
+                # 清理已关闭房间的观战者
+                await SpectatorHub().prune(router.room_members if router else self.game_manager.room_ids())
+                
+                # 排队过久的群以现有人数建房
+                max_wait = self.get_config("lobby.max_wait", 300)
+                if max_wait > 0:
+                    room_size = min(18, max(6, self.get_config("lobby.room_size", 9)))
+                    min_size = max(6, self.get_config("plugin.min_players", 6))
+                    lobby = self.game_manager.lobby
+                    for group_id in list(lobby.queues.keys()):
+                        if lobby.waiting(group_id) >= min_size and lobby.oldest_wait(group_id) >= max_wait:
+                            formed = await form_lobby_rooms(self.game_manager, group_id, room_size, min_size)
+                            # 不经命令触发的建房单独录制，回放时在同一时刻重演
+                            if formed:
+                                CommandTraceRecorder().record({"t": time.time(), "form": True, "group": group_id,
+                                                               "room_size": room_size, "min_size": min_size,
+                                                               "rooms": formed})
+                
                 await asyncio.sleep(60)  # 每分钟检查一次
             except asyncio.CancelledError:
                 break
             except Exception as e:
-                print(f"清理循环错误: {e}")
+                cleanup_logger.exception("清理循环错误: %s", e)
     
     def get_plugin_components(self) -> List[Tuple[ComponentInfo, Type]]:
         """返回插件组件"""
         return [
             (WerewolfGameCommand.get_command_info(), WerewolfGameCommand),
             (TestPrivateMessageCommand.get_command_info(), TestPrivateMessageCommand)
-        ]
\ No newline at end of file
+        ]
+# ==================== 命令行工具 ====================
+async def _execute_captured_command(user_id: str, group_id: Optional[str], text: str,
+                                    room_id_hint: Optional[str] = None,
+                                    seed_hint: Optional[int] = None,
+                                    lobby_room_hints: Optional[List[str]] = None,
+                                    config: Optional[Dict[str, Any]] = None) -> Tuple[bool, Optional[str], bool]:
+    """在插件进程外执行一条 /wwg 命令，回复和消息写入 MessageSender.outbox"""
+    import re
+    match = re.match(WerewolfGameCommand.command_pattern, text)
+    if not match:
+        return False, "命令格式错误", True
+
+    command = CapturedWerewolfCommand(build_routed_message(user_id, group_id), config or {})
+    command.set_matched_groups(match.groupdict())
+    command.room_id_hint = room_id_hint
+    command.seed_hint = seed_hint
+    command.lobby_room_hints = lobby_room_hints
+    return await command.execute()
+
+async def _drive_benchmark_room(room_index: int, rounds: int) -> int:
+    """驱动一个房间：建房、加入、反复设置与查询状态后销毁，返回执行的命令数"""
+    room_id = f"WWG{room_index:06d}"
+    group_id = f"bench{room_index}"
+    players = [str(900000000 + room_index * 100 + i) for i in range(6)]
+
+    commands = [(players[0], "/wwg host")]
+    commands += [(player_qq, f"/wwg join {room_id}") for player_qq in players[1:]]
+    for _ in range(rounds):
+        commands.append((players[0], "/wwg settings players 6"))
+        commands.append((players[0], "/wwg settings roles hunter 0"))
+        commands += [(player_qq, "/wwg status") for player_qq in players]
+    commands.append((players[0], "/wwg destroy"))
+
+    for user_id, text in commands:
+        await _execute_captured_command(user_id, group_id, text, room_id)
+        MessageSender.outbox.clear()
+    return len(commands)
+
+async def _run_shard_benchmark(rooms: int, rounds: int, worker_counts: List[int]):
+    """分别以不同工作进程数运行相同负载，输出吞吐量"""
+    MessageSender.outbox = []
+    baseline = None
+
+    for worker_count in worker_counts:
+        router = ShardRouter()
+        if worker_count > 0:
+            router.start(worker_count, {})
+
+        start = time.perf_counter()
+        counts = await asyncio.gather(*[_drive_benchmark_room(i, rounds) for i in range(rooms)])
+        elapsed = time.perf_counter() - start
+
+        router.stop()
+        WerewolfGameManager().games.clear()
+        get_io_executor().flush()
+
+        throughput = sum(counts) / elapsed
+        baseline = baseline or throughput
+        mode = f"{worker_count} 个分片进程" if worker_count > 0 else "单进程（不分片）"
+        print(f"{mode:<16} 命令数 {sum(counts):>6}  耗时 {elapsed:7.2f}s  "
+              f"吞吐 {throughput:9.1f} 命令/秒  相对 {throughput / baseline:5.2f}x")
+
+def _build_benchmark_game(player_count: int) -> Dict[str, Any]:
+    """构造一局进行到第二夜的游戏状态，包含集合、元组和枚举字段"""
+    game_manager = WerewolfGameManager()
+    room_id = f"WWG{player_count:06d}"
+    players = [str(800000000 + i) for i in range(player_count)]
+
+    game_manager.create_game(room_id, players[0], "bench", "玩家0")
+    game = game_manager.games[room_id]
+    game["settings"]["player_count"] = player_count
+    for i, player_qq in enumerate(players[1:], start=1):
+        game_manager.join_game(room_id, player_qq, f"玩家{i}")
+
+    roles = {"villager": player_count - 7, "seer": 1, "witch": 1, "hunter": 1,
+             "wolf": 2, "magician": 1, "double_faced": 1}
+    game["settings"]["roles"].update(roles)
+    game_manager.start_game(room_id)
+
+    game["day_count"] = 2
+    game["saved_players"] = {players[1], players[2]}
+    game["magician_swap"] = (1, 2)
+    game["night_actions"] = {"wolf_kill": "3", "seer": "4"}
+    game["votes"] = {player_qq: 1 for player_qq in players}
+    for player in game["players"].values():
+        if player["role"] == "double_faced":
+            player["camp"] = Camp.WOLF
+    return game
+
+def _run_snapshot_benchmark(player_count: int, iterations: int):
+    """对比旧版缩进 JSON 与紧凑快照的编解码耗时和体积"""
+    game = _build_benchmark_game(player_count)
+
+    # 旧格式无法直接编码集合与枚举，这里先手工转换以便对比
+    legacy_game = json.loads(json.dumps(game, default=lambda v: sorted(v) if isinstance(v, set) else v.value))
+
+    def measure(encode, decode, state):
+        data = encode(state)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            encode(state)
+        encode_time = (time.perf_counter() - start) / iterations
+        start = time.perf_counter()
+        for _ in range(iterations):
+            decode(data)
+        decode_time = (time.perf_counter() - start) / iterations
+        return len(data), encode_time, decode_time
+
+    results = {
+        "旧版 indent=2 JSON": measure(
+            lambda state: json.dumps(state, ensure_ascii=False, indent=2).encode("utf-8"),
+            lambda data: json.loads(data), legacy_game),
+        f"快照 v{SNAPSHOT_VERSION}": measure(encode_game_snapshot, decode_game_snapshot, game)
+    }
+
+    restored = decode_game_snapshot(encode_game_snapshot(game))
+    assert restored["saved_players"] == game["saved_players"]
+    assert restored["magician_swap"] == game["magician_swap"]
+
+    get_io_executor().flush()
+    print(f"{player_count} 人对局，{iterations} 次迭代")
+    for name, (size, encode_time, decode_time) in results.items():
+        print(f"{name:<20} 体积 {size:>7} 字节  编码 {encode_time * 1e6:8.1f}us  解码 {decode_time * 1e6:8.1f}us")
+
+async def _run_trace_replay(path: str, speed: float):
+    """按录制时的节奏（speed 倍速，0 为不等待）把轨迹逐条交给命令处理器，输出各子命令耗时"""
+    entries = [entry for entry in load_command_trace(path) if not entry.get("shed")]
+    if not entries:
+        print("轨迹为空")
+        return
+
+    MessageSender.outbox = []
+    replayed: Dict[str, List[float]] = {}
+    recorded: Dict[str, List[float]] = {}
+    trace_start = entries[0]["t"]
+    clock_start = time.monotonic()
+    behind = 0.0
+
+    for entry in entries:
+        if speed > 0:
+            delay = (entry["t"] - trace_start) / speed - (time.monotonic() - clock_start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                behind = max(behind, -delay)
+
+        # 清理循环中排队超时的建房
+        if entry.get("form"):
+            start = time.perf_counter()
+            await form_lobby_rooms(WerewolfGameManager(), entry["group"], entry["room_size"], entry["min_size"],
+                                   entry["rooms"])
+            replayed.setdefault("匹配超时建房", []).append(time.perf_counter() - start)
+            MessageSender.outbox.clear()
+            continue
+
+        parts = entry["text"].split()
+        label = " ".join(parts[:2])
+        # 建房沿用录制时的房间号（含匹配队列自动建的房），后续 join/watch 等命令才能找到同一房间
+        room_id_hint = entry.get("room") if label == "/wwg host" else None
+        start = time.perf_counter()
+        config = {"lobby": {"room_size": entry["room_size"]}} if "room_size" in entry else None
+        await _execute_captured_command(entry["user"], entry["group"], entry["text"], room_id_hint, entry.get("seed"),
+                                        entry.get("rooms"), config)
+        replayed.setdefault(label, []).append(time.perf_counter() - start)
+        if "ms" in entry:
+            recorded.setdefault(label, []).append(entry["ms"] / 1000)
+        MessageSender.outbox.clear()
+
+    elapsed = time.monotonic() - clock_start
+    get_io_executor().flush()
+
+    def percentile(values: List[float], q: float) -> float:
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    print(f"回放 {len(entries)} 条命令，用时 {elapsed:.2f}s"
+          + (f"，最多落后录制节奏 {behind:.2f}s" if behind > 0 else ""))
+    for label, values in sorted(replayed.items(), key=lambda item: -sum(item[1])):
+        original = recorded.get(label)
+        original_text = f"  录制平均 {sum(original) / len(original) * 1000:8.2f}ms" if original else ""
+        print(f"{label:<18} {len(values):>6} 次  平均 {sum(values) / len(values) * 1000:8.2f}ms  "
+              f"p95 {percentile(values, 0.95) * 1000:8.2f}ms  最大 {max(values) * 1000:8.2f}ms{original_text}")
+
+def compare_rating_paths(games: List[Dict[str, Any]], k_factor: float, initial: float) -> List[str]:
+    """分别用逐局与分层批量重放同一批对局，返回两者不一致之处（为空表示一致）"""
+    games = sorted(games, key=lambda game: game.get("ended_time") or "")
+    sequential = _recompute_ratings_sequential(games, k_factor, initial)
+    vectorized = _recompute_ratings_vectorized(games, k_factor, initial)
+    problems = []
+    seq_ratings, vec_ratings = sequential[0], vectorized[0]
+    if set(seq_ratings) != set(vec_ratings):
+        problems.append(f"评分玩家不同: 逐局 {len(seq_ratings)} 名，批量 {len(vec_ratings)} 名")
+    else:
+        worst = max((abs(seq_ratings[qq] - vec_ratings[qq]) for qq in seq_ratings), default=0.0)
+        if worst > 1e-6:
+            problems.append(f"评分最大相差 {worst:.6f}")
+    if sequential[1] != vectorized[1]:
+        problems.append("已评局数不同")
+    if sequential[2] != vectorized[2]:
+        problems.append(f"阵营记录不同: 逐局 {sequential[2]}，批量 {vectorized[2]}")
+    if len(sequential[3]) != len(vectorized[3]):
+        problems.append("计分局数不同")
+    return problems
+
+def _run_rating_recompute(k_factor: float, initial: float, dry_run: bool, verify: bool = False,
+                          force: bool = False):
+    """按时间顺序重放归档重算全部评分（需在机器人停止时运行，否则会被内存中的档案覆盖）
+
+    已并入月度汇总的对局无法重放；存在汇总时默认不写回，以免丢掉这部分对局的评分，除非指定 force。
+    """
+    games = [game for _, game in iter_archived_games()]
+    # 与档案重建相同，含未注册角色的对局无法计算阵营，整局跳过
+    unknown = sum(1 for game in games if has_unknown_roles(game))
+    if unknown:
+        games = [game for game in games if not has_unknown_roles(game)]
+        print(f"跳过 {unknown} 局含未注册角色的对局")
+    if verify:
+        if np is None:
+            print("未安装 NumPy，只有逐局重放，无需校验")
+        else:
+            problems = compare_rating_paths(games, k_factor, initial)
+            print("逐局与分层批量重放结果一致" if not problems else "逐局与分层批量重放结果不一致: " + "；".join(problems))
+            if problems:
+                return
+    start = time.perf_counter()
+    ratings, rated_games, camp_records, winner_expected = recompute_ratings(games, k_factor, initial)
+    elapsed = time.perf_counter() - start
+
+    mode = "NumPy 分层批量" if np is not None else "逐局"
+    print(f"重放 {len(games)} 局，{len(ratings)} 名玩家，用时 {elapsed:.3f} 秒（{mode}）")
+    rolled = sum(rollup["games"] for rollup in load_archive_rollups())
+    if rolled:
+        # 月度汇总不保留逐局的对阵与结果，无法重放
+        print(f"另有 {rolled} 局已并入月度汇总，不参与重放")
+    if winner_expected:
+        # 胜方赛前预期胜率的对数损失，越低说明参数的预测越准，可用于比较不同参数
+        log_loss = -sum(math.log(max(p, 1e-12)) for p in winner_expected) / len(winner_expected)
+        print(f"K={k_factor:g} 初始分={initial:g} 胜方预测对数损失: {log_loss:.4f}")
+    for camp, record in camp_records.items():
+        print(f"阵营 {camp}: {record['games']} 局 {record['wins']} 胜，"
+              f"修正 {camp_rating_bias(record['games'], record['wins']):+.1f}")
+    for qq, rating in sorted(ratings.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {qq}: {rating:.1f}（{rated_games[qq]}局）")
+
+    if dry_run:
+        return
+    if rolled and not force:
+        print("写回会丢掉已汇总对局对评分和阵营记录的影响，已取消；确认只按剩余明细重算请加 --force")
+        return
+    if unknown and not force:
+        print(f"有 {unknown} 局含未注册角色被跳过，写回会丢掉这些对局的评分，已取消；确认仍要写回请加 --force")
+        return
+    game_manager = WerewolfGameManager()
+    for qq, profile in game_manager.player_profiles.items():
+        profile["rating"] = ratings.get(qq, initial)
+        profile["rated_games"] = rated_games.get(qq, 0)
+        game_manager._save_profile(qq)
+    game_manager.camp_records = camp_records
+    game_manager._save_camp_records()
+    get_io_executor().flush()
+    print(f"已写回 {len(game_manager.player_profiles)} 份玩家档案")
+
+def _archive_order_keys(task: Tuple[str, List[str]]) -> List[Tuple[Tuple, str]]:
+    """进程池任务：读出一批归档的先后顺序键 -> [(键, 文件名)]
+
+    有归档序号的按序号；更早、没有序号的归档排在前面，按结束时间排序。无法读取的排在最前，重建时会被跳过。
+    """
+    finished_dir, filenames = task
+    keys = []
+    for filename in filenames:
+        try:
+            with open(os.path.join(finished_dir, filename), 'rb') as f:
+                game = decode_game_snapshot(f.read())
+        except Exception:
+            keys.append(((0, ""), filename))
+            continue
+        seq = game.get("archive_seq")
+        keys.append(((1, seq) if seq else (0, game.get("ended_time") or ""), filename))
+    return keys
+
+def _profile_deltas_for_files(task: Tuple[str, List[str]]) -> Tuple[int, int, Dict[str, Dict[str, Any]]]:
+    """进程池任务：按顺序读取一批归档对局并计入一组空白档案，返回 (计入局数, 跳过局数, QQ -> 部分档案)"""
+    finished_dir, filenames = task
+    partial: Dict[str, Dict[str, Any]] = {}
+    credited = skipped = 0
+    for filename in filenames:
+        try:
+            with open(os.path.join(finished_dir, filename), 'rb') as f:
+                game = decode_game_snapshot(f.read())
+            # 含未知角色（如未注册的自定义角色）的对局整局跳过，避免只计入一半
+            if has_unknown_roles(game):
+                skipped += 1
+                continue
+        except Exception:
+            skipped += 1
+            continue
+
+        names = {qq: player["name"] for qq, player in game["players"].items()}
+        touched = credit_archived_game(
+            game, lambda qq: partial.setdefault(qq, new_profile(qq, names.get(qq, qq))))
+        for qq in touched:
+            partial[qq]["name"] = names.get(qq, partial[qq]["name"])
+        credited += 1
+    return credited, skipped, partial
+
+def _merge_profile_delta(into: Dict[str, Any], part: Dict[str, Any]):
+    """把时间上靠后的部分档案并入 into：计数相加，最近对局按先后拼接后保留最新的若干局"""
+    _add_profile_counters(into, part)
+    recent_games = (list(iter_recent_games(into)) + list(iter_recent_games(part)))[-RECENT_GAMES_SIZE:]
+    into["recent_games"] = recent_games
+    into["recent_index"] = len(recent_games) % RECENT_GAMES_SIZE
+    into["recent_wins"] = sum(1 for entry in recent_games if entry["won"])
+    into["recent_win_rate"] = into["recent_wins"] / len(recent_games) if recent_games else 0
+    into["name"] = part["name"]
+
+def _run_profile_rebuild(workers: int, chunk_size: int, dry_run: bool, force: bool = False):
+    """从归档重建全部玩家档案（需在机器人停止时运行，否则会被内存中的档案覆盖）
+
+    先并行读出每局的归档序号定出先后（不依赖文件修改时间，复制或恢复目录后顺序不变），
+    再按先后切成批次，进程池并行把每批对局计入空白档案，主进程按批次顺序合并，
+    最后写入新目录并整体替换 users/。评分不在此重算，保留原值（可另行运行 rerate）。
+    已并入月度汇总的对局先按汇总计入统计，这部分对局不再出现在最近对局中。
+    有对局因无法读取或含未注册角色被跳过时不写回，除非指定 force。
+    """
+    # 汇总中的对局都早于仍保留明细的对局
+    rebuilt: Dict[str, Dict[str, Any]] = {}
+    rolled_codes: Set[str] = set()
+    for rollup in load_archive_rollups():
+        rolled_codes.update(rollup["game_codes"])
+        for qq, entry in rollup["players"].items():
+            part = new_profile(qq, entry["name"])
+            part.update(entry)
+            if qq in rebuilt:
+                _merge_profile_delta(rebuilt[qq], part)
+            else:
+                rebuilt[qq] = part
+
+    finished_dir = os.path.join(DATA_DIR, "games", "finished")
+    filenames = []
+    if os.path.isdir(finished_dir):
+        filenames = [entry.name for entry in os.scandir(finished_dir)
+                     if entry.is_file() and entry.name.endswith(".json") and entry.name[:-5] not in rolled_codes]
+
+    credited = skipped = 0
+    start = last_report = time.perf_counter()
+    pool = None
+    if workers > 0 and len(filenames) > chunk_size:
+        methods = multiprocessing.get_all_start_methods()
+        pool = multiprocessing.get_context("fork" if "fork" in methods else "spawn").Pool(workers)
+
+    try:
+        key_chunks = [(finished_dir, filenames[i:i + chunk_size]) for i in range(0, len(filenames), chunk_size)]
+        keyed = [item for part in (pool.imap(_archive_order_keys, key_chunks) if pool
+                                   else map(_archive_order_keys, key_chunks)) for item in part]
+        filenames = [name for _, name in sorted(keyed)]
+        chunks = [(finished_dir, filenames[i:i + chunk_size]) for i in range(0, len(filenames), chunk_size)]
+        # imap 按提交顺序返回，合并时最近对局的先后不会乱
+        results = pool.imap(_profile_deltas_for_files, chunks) if pool else map(_profile_deltas_for_files, chunks)
+
+        for done, (chunk_credited, chunk_skipped, partial) in enumerate(results, 1):
+            credited += chunk_credited
+            skipped += chunk_skipped
+            for qq, part in partial.items():
+                if qq in rebuilt:
+                    _merge_profile_delta(rebuilt[qq], part)
+                else:
+                    rebuilt[qq] = part
+
+            now = time.perf_counter()
+            if now - last_report >= 1 or done == len(chunks):
+                last_report = now
+                processed = credited + skipped
+                print(f"已处理 {processed}/{len(filenames)} 局（{processed / max(1, len(filenames)):.0%}），"
+                      f"{processed / max(now - start, 1e-9):.0f} 局/秒", file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.perf_counter() - start
+
+    # 现有档案的昵称、评分等非统计字段保留；没有任何归档对局的玩家统计清零
+    existing = WerewolfGameManager().player_profiles
+    drifted = 0
+    for qq, profile in existing.items():
+        fresh = rebuilt.setdefault(qq, new_profile(qq, profile.get("name", qq)))
+        if any(profile.get(key) != fresh[key] for key in ("total_games", "wins", "kills", "votes")):
+            drifted += 1
+        for key, value in profile.items():
+            if key not in REBUILT_PROFILE_FIELDS:
+                fresh[key] = value
+        fresh["schema_version"] = PROFILE_SCHEMA_VERSION
+
+    mode = f"{workers} 个进程" if pool is not None else "单进程"
+    if rolled_codes:
+        print(f"另从月度汇总计入 {len(rolled_codes)} 局")
+    print(f"计入 {credited} 局（跳过 {skipped} 局无法读取或含未知角色），{len(rebuilt)} 名玩家，"
+          f"用时 {elapsed:.2f} 秒，{(credited + skipped) / max(elapsed, 1e-9):.0f} 局/秒（{mode}）")
+    print(f"{drifted} 份现有档案的对局/胜场/击杀/票杀与归档不一致")
+    if dry_run:
+        return
+    if skipped and not force:
+        print(f"有 {skipped} 局被跳过，写回会丢掉这些对局的统计，已取消；确认仍要替换 users/ 请加 --force")
+        return
+
+    # 先完整写入新目录，再整体替换，中途失败不会留下新旧混杂的档案
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    users_dir = os.path.join(DATA_DIR, "users")
+    staging_dir = os.path.join(DATA_DIR, f"users.rebuild-{stamp}")
+    io_executor = get_io_executor()
+    error_before = io_executor.last_error
+    for qq, profile in rebuilt.items():
+        io_executor.write(os.path.join(staging_dir, f"{qq}.json"),
+                          json.dumps(profile, ensure_ascii=False, indent=2).encode("utf-8"))
+    io_executor.flush()
+    if io_executor.last_error != error_before:
+        print(f"写入新档案失败，未替换 users/: {io_executor.last_error}")
+        return
+
+    os.makedirs(staging_dir, exist_ok=True)
+    backup_dir = os.path.join(DATA_DIR, f"users.bak-{stamp}")
+    if os.path.isdir(users_dir):
+        os.rename(users_dir, backup_dir)
+    os.rename(staging_dir, users_dir)
+    print(f"已写入 {len(rebuilt)} 份玩家档案，原档案备份在 {backup_dir}")
+
+def _register_config_custom_roles():
+    """命令行工具不经过插件加载，从插件目录的 config.toml 注册自定义角色，使重放与重建能识别这些角色"""
+    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.toml")
+    if not os.path.exists(config_path):
+        return
+    try:
+        import tomllib as toml_parser
+    except ImportError:  # Python 3.10 及以下，使用 MaiBot 自带的 tomlkit
+        import tomlkit as toml_parser
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            section = toml_parser.loads(f.read()).get("custom_roles", {})
+    except Exception as e:
+        print(f"读取 {config_path} 失败，不注册自定义角色: {e}", file=sys.stderr)
+        return
+    for error in register_custom_roles(list(section.get("roles", [])), list(section.get("presets", []))):
+        print(f"忽略自定义角色配置: {error}", file=sys.stderr)
+
+def main(argv: Optional[List[str]] = None):
+    """命令行入口（需在 MaiBot 根目录下以 PYTHONPATH=. 运行）"""
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="狼人杀插件命令行工具")
+    subparsers = parser.add_subparsers(dest="tool", required=True)
+
+    bench_shards = subparsers.add_parser("bench-shards", help="房间分片吞吐量基准测试")
+    bench_shards.add_argument("--rooms", type=int, default=64, help="并发房间数")
+    bench_shards.add_argument("--rounds", type=int, default=20, help="每个房间的设置/查询轮数")
+    bench_shards.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4],
+                              help="要测试的工作进程数，0 表示不分片")
+
+    bench_snapshot = subparsers.add_parser("bench-snapshot", help="对局快照编解码基准测试")
+    bench_snapshot.add_argument("--players", type=int, default=18, help="对局人数")
+    bench_snapshot.add_argument("--iterations", type=int, default=2000, help="迭代次数")
+
+    export = subparsers.add_parser("export", help="以 NDJSON 流式导出已归档对局")
+    export.add_argument("--since", help="起始时间（含），YYYY-MM-DD 或 ISO 时间")
+    export.add_argument("--until", help="结束时间（不含），YYYY-MM-DD 或 ISO 时间")
+    export.add_argument("--group", help="只导出指定群号的对局")
+    export.add_argument("--cursor", help="从上次导出的游标之后继续")
+    export.add_argument("--output", default="-", help="输出文件，默认为标准输出")
+
+    rerate = subparsers.add_parser("rerate", help="按时间顺序重放归档，重算全部技术评分")
+    rerate.add_argument("--k-factor", type=float, default=24.0, help="每局评分变化幅度(K值)")
+    rerate.add_argument("--initial", type=float, default=1500.0, help="初始评分")
+    rerate.add_argument("--dry-run", action="store_true", help="只输出结果与预测误差，不写回档案")
+    rerate.add_argument("--verify", action="store_true", help="先校验逐局与分层批量重放结果一致，不一致时不写回")
+    rerate.add_argument("--force", action="store_true", help="存在月度汇总或有对局被跳过时仍按剩余明细重算并写回")
+
+    rebuild = subparsers.add_parser("rebuild-profiles", help="并行扫描全部归档对局，重建玩家档案的统计")
+    rebuild.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="进程数，0 为在本进程中执行")
+    rebuild.add_argument("--chunk-size", type=int, default=500, help="每个任务处理的对局数")
+    rebuild.add_argument("--dry-run", action="store_true", help="只统计与现有档案的差异，不写回")
+    rebuild.add_argument("--force", action="store_true", help="有对局被跳过时仍写回")
+
+    replay = subparsers.add_parser("replay", help="回放录制的命令轨迹并统计各命令耗时")
+    replay.add_argument("trace", help="traces/ 目录下的轨迹文件")
+    replay.add_argument("--speed", type=float, default=0,
+                        help="回放倍速，1 为按录制时的间隔，0（默认）为不等待")
+
+    args = parser.parse_args(argv)
+    _register_config_custom_roles()
+
+    global DATA_DIR
+    if args.tool == "export":
+        import sys
+        output = sys.stdout if args.output == "-" else open(args.output, 'w', encoding='utf-8')
+        try:
+            count, last_cursor = export_archive_ndjson(output, args.since, args.until, args.group, args.cursor)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        # 游标输出到标准错误，不混入 NDJSON 数据
+        print(f"导出 {count} 局，续传游标: {last_cursor or '无'}", file=sys.stderr)
+    elif args.tool == "rerate":
+        configure_rating(args.k_factor, args.initial)
+        _run_rating_recompute(args.k_factor, args.initial, args.dry_run, args.verify, args.force)
+    elif args.tool == "rebuild-profiles":
+        _run_profile_rebuild(max(0, args.workers), max(1, args.chunk_size), args.dry_run, args.force)
+    elif args.tool == "bench-shards":
+        with tempfile.TemporaryDirectory() as data_dir:
+            DATA_DIR = data_dir
+            asyncio.run(_run_shard_benchmark(args.rooms, args.rounds, args.workers))
+    elif args.tool == "replay":
+        # 在临时目录中从空状态回放，不影响真实数据
+        with tempfile.TemporaryDirectory() as data_dir:
+            DATA_DIR = data_dir
+            asyncio.run(_run_trace_replay(args.trace, args.speed))
+    elif args.tool == "bench-snapshot":
+        with tempfile.TemporaryDirectory() as data_dir:
+            DATA_DIR = data_dir
+            _run_snapshot_benchmark(args.players, args.iterations)
+
+if __name__ == "__main__":
+    main()